@@ -3,18 +3,30 @@ import time
 import logging
 import json
 import hashlib
-import sqlite3
 from datetime import datetime
-from threading import Lock
-from flask import Flask, request, jsonify, render_template, send_from_directory, Response, stream_with_context
+from flask import Flask, request, jsonify, render_template, send_from_directory, Response, stream_with_context, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from apscheduler.schedulers.background import BackgroundScheduler
 import requests
 
 from extensions import db
 from models import SystemConfig, Token, RequestLog
+from logging_utils import configure_logging
 import services
+import newapi_push
+import circuit_breaker
+from upstream_headers import get_pipeline
+import request_body
+import sse_peek
+import upstream_timeouts
+import client_watch
+import compression
+import live_feed
+import token_pool
+from token_pool import RouteToken
+import log_buffer
+import migrations
+import database
 
 # Initialize App
 app = Flask(__name__, static_folder='static', template_folder='static')
@@ -24,11 +36,29 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI', 'sqlite:/
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-me')
 
-# Initialize DB
-db.init_app(app)
-
-# Logging Setup
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# 请求体大小限制：全局上限（所有接口）+ 按 API Key 的上限（代理接口）
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', 100 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES or None
+API_KEY_MAX_REQUEST_BYTES = json.loads(os.environ.get('API_KEY_MAX_REQUEST_BYTES') or '{}')
+# 超过该大小的请求体写入临时文件，不常驻内存
+REQUEST_SPOOL_BYTES = int(os.environ.get('REQUEST_SPOOL_BYTES', 1024 * 1024))
+
+# Initialize DB（连接池 / SQLite WAL 见 database.py）
+database.init_app(app)
+# 管理面板实时事件：token 变更在 commit 后推送（见 live_feed.py）
+live_feed.install()
+# 代理路由使用精简的 token 记录，ORM 提交后同步（见 token_pool.py）
+token_pool.install()
+# 已过期 / 即将过期的 token 不参与路由，立即在后台刷新
+token_pool.pool.on_expired = services.schedule_refresh
+# 请求日志先进入内存环形缓冲区，后台批量落库（见 log_buffer.py）
+log_buffer.buffer.init_app(app)
+
+# 响应压缩（gzip / brotli，见 compression.py）
+compression.init_app(app)
+
+# Logging Setup (JSON lines via a background queue listener; LOG_LEVEL / LOG_FORMAT env)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Login Manager
@@ -49,68 +79,6 @@ def load_user(user_id):
         return User(id=str(config.id), username=config.admin_username)
     return None
 
-# --- SQLite schema migration (lightweight, no Alembic) ---
-
-def _sqlite_path_from_uri(uri: str) -> str | None:
-    if not uri:
-        return None
-    if uri.startswith('sqlite:///:memory:'):
-        return None
-    if uri.startswith('sqlite:///'):
-        # Works for both relative (sqlite:///instance/db.sqlite) and absolute (sqlite:////app/instance/db.sqlite)
-        return uri[len('sqlite:///'):]
-    return None
-
-def _sqlite_table_columns(cursor, table_name: str) -> set[str]:
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    return {row[1] for row in cursor.fetchall()}
-
-def migrate_sqlite_schema():
-    # Prefer the *resolved* sqlite file path used by Flask-SQLAlchemy (usually under app.instance_path).
-    path = None
-    try:
-        engine = db.engine  # requires app_context
-        if getattr(engine.url, 'drivername', None) == 'sqlite':
-            path = engine.url.database
-    except Exception:
-        path = None
-
-    if not path:
-        uri = app.config.get('SQLALCHEMY_DATABASE_URI')
-        path = _sqlite_path_from_uri(uri)
-    if not path:
-        return
-
-    # Ensure directory exists for relative sqlite paths
-    dir_name = os.path.dirname(path)
-    if dir_name:
-        os.makedirs(dir_name, exist_ok=True)
-
-    conn = sqlite3.connect(path)
-    cur = conn.cursor()
-    try:
-        # system_config: add missing columns safely
-        sc_cols = _sqlite_table_columns(cur, 'system_config')
-        if sc_cols:
-            if 'error_retry_count' not in sc_cols:
-                cur.execute("ALTER TABLE system_config ADD COLUMN error_retry_count INTEGER DEFAULT 3")
-            if 'token_refresh_interval' not in sc_cols:
-                cur.execute("ALTER TABLE system_config ADD COLUMN token_refresh_interval INTEGER DEFAULT 3600")
-            if 'stream_conversion_enabled' not in sc_cols:
-                cur.execute("ALTER TABLE system_config ADD COLUMN stream_conversion_enabled BOOLEAN DEFAULT 0")
-
-        # request_log: add missing columns for UI display
-        rl_cols = _sqlite_table_columns(cur, 'request_log')
-        if rl_cols:
-            if 'discord_token' not in rl_cols:
-                cur.execute("ALTER TABLE request_log ADD COLUMN discord_token TEXT")
-            if 'zai_token' not in rl_cols:
-                cur.execute("ALTER TABLE request_log ADD COLUMN zai_token TEXT")
-
-        conn.commit()
-    finally:
-        conn.close()
-
 def _mask_token(value: str | None, head: int = 12, tail: int = 6) -> str | None:
     if not value:
         return None
@@ -122,13 +90,24 @@ def _dt_iso(dt):
     """统一的时间序列化，去掉微秒，便于前端解析显示。"""
     return dt.replace(microsecond=0).isoformat() if dt else None
 
+def _split_fields(raw):
+    return [f.strip() for f in raw.split(',') if f.strip()] if raw else None
+
+def _listing_etag(*parts) -> str:
+    """列表接口的弱 ETag：数据版本 + 查询参数"""
+    raw = '|'.join(str(p) for p in (*parts, request.query_string.decode()))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+def _not_modified(etag):
+    resp = Response(status=304)
+    resp.set_etag(etag, weak=True)
+    return resp
+
 # Database Initialization
 def init_db():
     with app.app_context():
-        db.create_all()
-        # Make sure old sqlite DBs get new columns before ORM queries start
-        migrate_sqlite_schema()
-        db.create_all()
+        # 版本化迁移（见 migrations.py）；已是最新版本时只查询一次 schema_version
+        migrations.migrate()
         config = SystemConfig.query.first()
         if not config:
             # Default Admin: admin / admin
@@ -139,23 +118,75 @@ def init_db():
             )
             db.session.add(config)
             db.session.commit()
-            print("Initialized default admin/admin")
+            logger.info("Initialized default admin/admin")
 
-        # Ensure scheduler interval reflects persisted config (survives restart)
-        try:
-            seconds = int(getattr(config, 'token_refresh_interval', 3600) or 3600)
-            scheduler.reschedule_job('token_refresher', trigger='interval', seconds=seconds)
-        except Exception as e:
-            logger.error(f"Failed to apply token_refresh_interval on startup: {e}")
+# Scheduler（导入 app 时不启动，见 start_background_jobs）
+scheduler = None
 
-# Scheduler
 def scheduled_refresh():
     with app.app_context():
+        # 多副本共用 PostgreSQL 时只有 leader 执行定时刷新
+        if not database.scheduler_leader.held():
+            logger.debug("Skipping scheduled refresh: not the scheduler leader")
+            return
         services.refresh_all_tokens()
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(scheduled_refresh, 'interval', seconds=3600, id='token_refresher')
-scheduler.start()
+def _reschedule_refresh(seconds: int):
+    if scheduler is not None:
+        scheduler.reschedule_job('token_refresher', trigger='interval', seconds=seconds)
+
+# 可选：刷新完成后把 token 推送到 NewAPI 渠道（见 newapi_push.py）
+def _load_pushable_tokens():
+    with app.app_context():
+        try:
+            return services.pushable_tokens()
+        finally:
+            db.session.remove()
+
+def _is_push_leader() -> bool:
+    with app.app_context():
+        try:
+            return database.scheduler_leader.held()
+        except Exception as e:
+            logger.error(f"Scheduler leader check failed: {e}")
+            return False
+
+def start_background_jobs():
+    """启动定时刷新与 NewAPI 推送（服务开始监听之后调用，只会启动一次）"""
+    global scheduler
+    if scheduler is not None:
+        return
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    # Ensure scheduler interval reflects persisted config (survives restart)
+    seconds = 3600
+    with app.app_context():
+        try:
+            config = SystemConfig.query.first()
+            seconds = int(getattr(config, 'token_refresh_interval', 3600) or 3600)
+        except Exception as e:
+            logger.error(f"Failed to apply token_refresh_interval on startup: {e}")
+        finally:
+            db.session.remove()
+        try:
+            # 尽早竞选 leader：最先启动的副本负责定时刷新
+            database.scheduler_leader.held()
+        except Exception as e:
+            logger.error(f"Scheduler leader election failed: {e}")
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(scheduled_refresh, 'interval', seconds=seconds, id='token_refresher')
+    scheduler.start()
+    newapi_push.init_publisher(_load_pushable_tokens, _is_push_leader)
+
+def create_app(start_background: bool = True):
+    """
+    应用工厂：导入 app 模块只注册路由，不访问数据库、不启动后台线程；
+    这里完成建表 / 迁移并（可选）启动后台任务。WSGI 服务器可使用 app:create_app()。
+    """
+    init_db()
+    if start_background:
+        start_background_jobs()
+    return app
 
 # --- Routes: Pages ---
 
@@ -241,42 +272,46 @@ def api_stats():
 @app.route('/api/tokens', methods=['GET'])
 @api_auth_required
 def get_tokens():
-    tokens = Token.query.all()
-    config = SystemConfig.query.first()
-    result = []
+    """
+    Token 列表。默认返回全部 token 的全部字段（兼容旧版面板）；支持：
+      fields=id,email,...   只查询指定列（st_preview / has_zai_token 为轻量替代）
+      status=active|disabled|valid|expired, q=邮箱关键字, expiring_before=ISO 时间
+      sort=id|at_expires|error_count|created_at（前缀 - 为倒序）
+      limit + cursor        keyset 分页，下一页游标见 next_cursor
+    带弱 ETag，未变化时返回 304。
+    """
+    args = request.args
+    refresh_interval = db.session.scalar(db.select(SystemConfig.token_refresh_interval)) or 3600
+    # valid / expired 的结果随时间变化，ETag 按分钟失效
+    minute = int(time.time() // 60) if args.get('status') in ('valid', 'expired') else ''
+    etag = _listing_etag(services.token_list_version(), refresh_interval, minute)
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+    try:
+        expiring_before = datetime.fromisoformat(args['expiring_before']) if args.get('expiring_before') else None
+        tokens, next_cursor = services.list_tokens(
+            fields=_split_fields(args.get('fields')),
+            status=args.get('status'),
+            q=args.get('q', '').strip() or None,
+            expiring_before=expiring_before,
+            sort=args.get('sort', 'id'),
+            limit=args.get('limit', type=int),
+            cursor=args.get('cursor'),
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid query: {e}'}), 400
     for t in tokens:
-        result.append({
-            'id': t.id,
-            'email': t.email,
-            'is_active': t.is_active,
-            'at_expires': _dt_iso(t.at_expires),
-            'credits': t.credits,
-            'user_paygate_tier': t.user_paygate_tier,
-            'current_project_name': t.current_project_name,
-            'current_project_id': t.current_project_id,
-            'image_count': t.image_count,
-            'video_count': t.video_count,
-            'error_count': t.error_count,
-            'remark': t.remark,
-            'image_enabled': t.image_enabled,
-            'video_enabled': t.video_enabled,
-            'image_concurrency': t.image_concurrency,
-            'video_concurrency': t.video_concurrency,
-            'zai_token': t.zai_token,
-            'st': t.discord_token[:10] + '...' # Masked for security? Frontend uses it for edit.
-            # Ideally return full ST for edit, or handle separately. Frontend calls edit and pre-fills ST.
-            # Let's return full ST for now as admin panel.
-        })
-        # Add full ST if requested or for admin
-        result[-1]['st'] = t.discord_token
-    # Add system config for frontend use (token refresh interval)
-    response_data = {
-        'tokens': result,
-        'config': {
-            'token_refresh_interval': config.token_refresh_interval if config else 3600
-        }
-    }
-    return jsonify(response_data)
+        for key in ('at_expires', 'updated_at'):
+            if key in t:
+                t[key] = _dt_iso(t[key])
+    resp = jsonify({
+        'tokens': tokens,
+        'next_cursor': next_cursor,
+        # Add system config for frontend use (token refresh interval)
+        'config': {'token_refresh_interval': refresh_interval},
+    })
+    resp.set_etag(etag, weak=True)
+    return resp
 
 @app.route('/api/tokens', methods=['POST'])
 @api_auth_required
@@ -299,14 +334,9 @@ def add_token():
     db.session.add(token)
     db.session.commit()
     
-    # Initial refresh
-    success, msg = services.update_token_info(token.id)
-    if not success:
-        token.remark = f"Initial refresh failed: {msg}"
-        db.session.commit()
-        return jsonify({'success': True, 'message': 'Token added but refresh failed: ' + msg})
-        
-    return jsonify({'success': True})
+    # Initial refresh runs on the background pool so the request returns immediately
+    job = services.submit_token_conversion([token.id])
+    return jsonify({'success': True, 'id': token.id, 'job_id': job.id})
 
 @app.route('/api/tokens/<int:id>', methods=['PUT'])
 @api_auth_required
@@ -332,6 +362,7 @@ def delete_token(id):
     token = Token.query.get_or_404(id)
     db.session.delete(token)
     db.session.commit()
+    newapi_push.notify_refreshed()
     return jsonify({'success': True})
 
 @app.route('/api/tokens/refresh-all', methods=['POST'])
@@ -385,6 +416,7 @@ def enable_token(id):
     token = Token.query.get_or_404(id)
     token.is_active = True
     db.session.commit()
+    newapi_push.notify_refreshed()
     return jsonify({'success': True})
 
 @app.route('/api/tokens/<int:id>/disable', methods=['POST'])
@@ -393,6 +425,7 @@ def disable_token(id):
     token = Token.query.get_or_404(id)
     token.is_active = False
     db.session.commit()
+    newapi_push.notify_refreshed()
     return jsonify({'success': True})
 
 # --- Admin Config Routes ---
@@ -462,7 +495,7 @@ def admin_debug():
     if 'token_refresh_interval' in data: 
         config.token_refresh_interval = data.get('token_refresh_interval')
         try:
-            scheduler.reschedule_job('token_refresher', trigger='interval', seconds=config.token_refresh_interval)
+            _reschedule_refresh(config.token_refresh_interval)
         except Exception as e:
             logger.error(f"Failed to reschedule job: {e}")
             
@@ -509,17 +542,33 @@ def update_token_info():
 @app.route('/api/logs', methods=['GET'])
 @api_auth_required
 def get_logs():
-    limit = request.args.get('limit', 100, type=int)
-    logs = RequestLog.query.order_by(RequestLog.created_at.desc()).limit(limit).all()
-    return jsonify([{
-        'operation': l.operation,
-        'token_email': l.token_email,
-        'discord_token': getattr(l, 'discord_token', None),
-        'zai_token': getattr(l, 'zai_token', None),
-        'status_code': l.status_code,
-        'duration': l.duration,
-        'created_at': l.created_at.isoformat()
-    } for l in logs])
+    """
+    请求日志（按时间倒序）。limit / cursor 分页，下一页游标在 X-Next-Cursor 响应头；
+    fields 列投影，status=ok|error|<状态码>，operation，q=邮箱关键字。
+    """
+    args = request.args
+    etag = _listing_etag(services.log_list_version())
+    if request.if_none_match.contains_weak(etag):
+        return _not_modified(etag)
+    try:
+        logs, next_cursor = services.list_logs(
+            fields=_split_fields(args.get('fields')),
+            status=args.get('status'),
+            operation=args.get('operation'),
+            q=args.get('q', '').strip() or None,
+            limit=args.get('limit', 100, type=int),
+            cursor=args.get('cursor'),
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid query: {e}'}), 400
+    for l in logs:
+        if 'created_at' in l:
+            l['created_at'] = l['created_at'].isoformat() if l['created_at'] else None
+    resp = jsonify(logs)
+    if next_cursor:
+        resp.headers['X-Next-Cursor'] = next_cursor
+    resp.set_etag(etag, weak=True)
+    return resp
 
 @app.route('/api/cache/config', methods=['GET', 'POST'])
 @api_auth_required
@@ -590,44 +639,86 @@ def token_refresh_enabled():
     db.session.commit()
     return jsonify({'success': True})
 
+@app.route('/api/newapi/status', methods=['GET'])
+@api_auth_required
+def newapi_status():
+    publisher = newapi_push.get_publisher()
+    if publisher is None:
+        return jsonify({'success': True, 'enabled': False})
+    return jsonify({'success': True, 'enabled': True, 'channels': publisher.channels,
+                    'strategy': publisher.strategy, 'last_push': publisher.last_push})
+
+@app.route('/api/newapi/push', methods=['POST'])
+@api_auth_required
+def newapi_push_now():
+    publisher = newapi_push.get_publisher()
+    if publisher is None:
+        return jsonify({'success': False, 'message': 'NewAPI push is not configured'}), 400
+    results = publisher.push_now()
+    return jsonify({'success': False not in results.values(), 'results': results})
+
+@app.route('/api/upstream/breaker', methods=['GET'])
+@api_auth_required
+def upstream_breaker_status():
+    return jsonify({'success': True, 'breaker': upstream_breaker.snapshot()})
+
+@app.route('/api/upstream/timeouts', methods=['GET'])
+@api_auth_required
+def upstream_timeouts_status():
+    return jsonify({'success': True, **upstream_timeouts.snapshot()})
+
+@app.route('/api/upstream/streams', methods=['GET'])
+@api_auth_required
+def upstream_streams_status():
+    return jsonify({'success': True, 'streams': client_watch.watcher.snapshot()})
+
 @app.route('/api/tokens/import', methods=['POST'])
 @api_auth_required
 def import_tokens():
     data = request.json
     tokens_data = data.get('tokens', [])
-    added = 0
-    updated = 0
-    
-    for t_data in tokens_data:
-        st = t_data.get('session_token')
-        if not st: continue
-        
-        token = Token.query.filter_by(discord_token=st).first()
-        if token:
-            # Update
-            token.email = t_data.get('email', token.email)
-            token.zai_token = t_data.get('access_token', token.zai_token)
-            token.is_active = t_data.get('is_active', token.is_active)
-            token.image_enabled = t_data.get('image_enabled', True)
-            token.video_enabled = t_data.get('video_enabled', True)
-            updated += 1
-        else:
-            # Add
-            token = Token(
-                discord_token=st,
-                email=t_data.get('email'),
-                zai_token=t_data.get('access_token'),
-                is_active=t_data.get('is_active', True),
-                image_enabled=t_data.get('image_enabled', True),
-                video_enabled=t_data.get('video_enabled', True),
-                image_concurrency=t_data.get('image_concurrency', -1),
-                video_concurrency=t_data.get('video_concurrency', -1)
-            )
-            db.session.add(token)
-            added += 1
-            
-    db.session.commit()
-    return jsonify({'success': True, 'added': added, 'updated': updated})
+    result = services.bulk_import_tokens(tokens_data, convert=data.get('convert', True))
+    job = result['job']
+    return jsonify({
+        'success': True,
+        'added': result['added'],
+        'updated': result['updated'],
+        'job_id': job.id if job else None,
+        'pending': job.total if job else 0
+    })
+
+@app.route('/api/tokens/import/<job_id>/progress', methods=['GET'])
+@api_auth_required
+def import_progress(job_id):
+    """以 SSE 推送后台转换进度，任务完成后结束流。"""
+    job = services.get_import_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+
+    def generate():
+        seen = -1
+        while True:
+            snap = job.snapshot()
+            if snap['done'] != seen:
+                seen = snap['done']
+                yield f"data: {json.dumps(snap)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            if snap['finished']:
+                break
+            job.wait_for_change(seen, timeout=15)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/live', methods=['GET'])
+@api_auth_required
+def live_events():
+    """管理面板实时事件（SSE）：token 变化、新请求日志；Last-Event-ID 或 ?since= 断线续传"""
+    last = request.headers.get('Last-Event-ID') or request.args.get('since')
+    last_seq = int(last) if last and last.isdigit() else None
+    return Response(live_feed.stream(last_seq), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/tokens/<int:id>/test', methods=['POST'])
 @api_auth_required
@@ -655,34 +746,126 @@ def activate_sora2(id):
 
 # --- OpenAI Compatible Proxy ---
 
-_rr_lock = Lock()
-_rr_index = 0
+# zai.is 上游整体熔断（见 circuit_breaker.py）
+upstream_breaker = circuit_breaker.from_env()
+
+# 上游请求头管线：固定部分只计算一次，鉴权 / 签名按 token 缓存（见 upstream_headers.py）
+upstream_headers = get_pipeline('api')
+_JSON_CONTENT_TYPE = {"Content-Type": "application/json"}
 
 def _get_token_candidates():
-    """多号轮询：每个请求从上一次的下一个 token 开始顺序尝试。"""
-    global _rr_index
-    tokens = Token.query.filter_by(is_active=True).order_by(Token.id.asc()).all()
-    valid_tokens = [t for t in tokens if t.zai_token and not str(t.zai_token).startswith('SESSION')]
-    if not valid_tokens:
-        return []
-    with _rr_lock:
-        start = _rr_index % len(valid_tokens)
-        _rr_index = (start + 1) % len(valid_tokens)
-    return valid_tokens[start:] + valid_tokens[:start]
-
-def _mark_token_error(token: Token, config: SystemConfig, reason: str):
+    """多号轮询：每个请求从上一次的下一个 token 开始顺序尝试（RouteToken，见 token_pool.py）。"""
+    return token_pool.pool.candidates()
+
+def _mark_token_error(route: RouteToken, config: SystemConfig, reason: str):
+    # 错误路径才加载完整的 ORM 对象；提交后路由池自动同步该 token
+    token = db.session.get(Token, route.id)
+    if token is None:
+        return
     token.error_count = int(token.error_count or 0) + 1
     token.remark = (reason or '')[:1000]
     threshold = int(getattr(config, 'error_ban_threshold', 3) or 3)
-    if token.error_count >= threshold:
+    banned = token.error_count >= threshold
+    if banned:
         token.is_active = False
         token.remark = f"Auto-banned due to errors: {(reason or '')[:950]}"
     db.session.commit()
-
-def _mark_token_success(token: Token):
-    if token.error_count:
-        token.error_count = 0
-    db.session.commit()
+    if banned:
+        newapi_push.notify_refreshed()
+
+def _record_request(operation: str, token: RouteToken, status_code: int, duration: float):
+    """记录请求日志（UI 展示用，token 脱敏）并推送到面板实时日志"""
+    record = log_buffer.buffer.append(operation, token.email, _mask_token(token.discord_token),
+                                      _mask_token(token.zai_token), status_code, duration)
+    entry = log_buffer.as_dict(record)
+    live_feed.publish('log', {**entry, 'created_at': entry['created_at'].isoformat()})
+
+def _request_limit(api_key: str) -> int:
+    return int(API_KEY_MAX_REQUEST_BYTES.get(api_key, MAX_REQUEST_BYTES) or 0)
+
+@app.teardown_request
+def _close_request_body(exc):
+    spooled = g.pop('request_body', None)
+    if spooled is not None:
+        spooled.close()
+
+def _mark_upstream_failure(token: RouteToken, config: SystemConfig, reason: str):
+    was_closed = upstream_breaker.closed
+    upstream_breaker.record_failure(token.id)
+    # 熔断打开期间（包括本次失败触发熔断）属于上游整体故障，不计入 token 错误
+    if was_closed and upstream_breaker.closed:
+        _mark_token_error(token, config, reason)
+
+def _mark_upstream_status(token: RouteToken, config: SystemConfig, status_code: int, detail: str):
+    """
+    上游返回错误状态码：5xx 与 401/403 计入熔断统计，只有熔断仍关闭时才计入 token 错误
+    （个别 token 过期只会被计入该 token；请求头校验变更等导致大量 token 同时 401/403 时打开熔断，不封禁 token）。
+    其他 4xx 直接计入 token 错误。
+    429 (Too Many Requests) 是速率限制，不计入错误，只尝试下一个token
+    """
+    if status_code >= 500 or status_code in (401, 403):
+        _mark_upstream_failure(token, config, f"HTTP {status_code}: {detail[:200]}")
+        return
+    if not upstream_breaker.closed:
+        # 探测请求得到其他 4xx 也说明上游可用
+        upstream_breaker.record_success(token.id)
+    if status_code == 429:
+        logger.info(f"Token {token.id} hit rate limit (429), trying next token")
+        return
+    _mark_token_error(token, config, f"HTTP {status_code}: {detail[:200]}")
+
+def _upstream_timeout(token: RouteToken, config: SystemConfig, exc: upstream_timeouts.UpstreamTimeout):
+    """上游超时：计入超时统计与 token 失败，返回 504"""
+    upstream_timeouts.record(exc.route, exc.phase)
+    _mark_upstream_failure(token, config, f"Upstream {exc}")
+    resp = jsonify({'error': f'upstream {exc.phase} timeout', 'route': exc.route})
+    resp.status_code = 504
+    return resp
+
+def _as_timeout(exc: Exception, deadline: upstream_timeouts.Deadline, read_phase: str = 'idle'):
+    """requests / urllib3 的超时异常转换为 UpstreamTimeout，其他异常返回 None"""
+    phase = upstream_timeouts.phase_of(exc, read_phase)
+    return upstream_timeouts.UpstreamTimeout(deadline.route, phase) if phase else None
+
+def _relay_stream(chunks, resp, watch: client_watch.Watch):
+    """
+    向客户端转发流式响应；上游读超时时记录并结束流。
+    客户端断开（监视线程关闭上游 socket，或写入失败后 WSGI 服务器关闭生成器）时立即停止读取上游。
+    结束后关闭上游连接。
+    """
+    try:
+        yield from chunks
+    except upstream_timeouts.UpstreamTimeout as e:
+        if not watch.cancelled:
+            upstream_timeouts.record(e.route, e.phase)
+            logger.warning(f"Upstream stream aborted: {e}")
+    except GeneratorExit:
+        watch.cancelled = True
+        raise
+    except Exception:
+        if not watch.cancelled:
+            raise
+    finally:
+        client_watch.watcher.release(watch)
+        resp.close()
+
+def _client_cancelled_response():
+    # 客户端已断开，响应不会被读取；499 与 nginx 的 "client closed request" 一致
+    return Response(status=499)
+
+def _breaker_open_response():
+    resp = jsonify({'error': 'zai.is upstream unavailable (circuit open)', 'breaker': upstream_breaker.state})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(upstream_breaker.retry_after())
+    return resp
+
+def _mark_token_success(route: RouteToken):
+    upstream_breaker.record_success(route.id)
+    if route.error_count:
+        token = db.session.get(Token, route.id)
+        if token is not None:
+            token.error_count = 0
+            db.session.commit()
 
 def _filter_stream_headers(hdrs):
     out = {}
@@ -692,14 +875,30 @@ def _filter_stream_headers(hdrs):
     out.setdefault('Content-Type', 'text/event-stream')
     return out
 
-def _aggregate_sse_to_nonstream(resp, fallback_model: str | None = None):
+def _passthrough_encoding(resp):
+    """上游响应已压缩且客户端接受同一编码时返回该编码（原样透传，不解压再压缩）"""
+    encoding = (resp.headers.get('Content-Encoding') or '').strip().lower()
+    if encoding and encoding != 'identity' and ',' not in encoding and compression.accepts(encoding):
+        return encoding
+    return None
+
+def _upstream_body_response(resp, mimetype):
+    encoding = _passthrough_encoding(resp)
+    if not encoding:
+        return Response(resp.content, status=resp.status_code, mimetype=mimetype)
+    out = Response(resp.raw.read(decode_content=False), status=resp.status_code, mimetype=mimetype)
+    out.headers['Content-Encoding'] = encoding
+    out.vary.add('Accept-Encoding')
+    return out
+
+def _aggregate_sse_to_nonstream(lines, fallback_model: str | None = None):
     first_chunk = None
     usage = None
     role_by_index: dict[int, str] = {}
     content_by_index: dict[int, list[str]] = {}
     finish_by_index: dict[int, str] = {}
 
-    for line in resp.iter_lines(decode_unicode=True):
+    for line in lines:
         if not line:
             continue
         if not line.startswith('data:'):
@@ -764,86 +963,150 @@ def proxy_chat_completions():
     if not auth_header or not auth_header.startswith('Bearer ') or auth_header.split(' ')[1] != config.api_key:
          return jsonify({'error': 'Invalid API Key'}), 401
 
-    payload = request.get_json(silent=True)
-    if not isinstance(payload, dict):
+    # 原始请求体只读取一次（大请求体落盘），只扫描出 stream / model，不做完整解析和重新序列化
+    limit = _request_limit(config.api_key)
+    if limit and request.content_length and request.content_length > limit:
+        return jsonify({'error': f'Request body exceeds {limit} bytes'}), 413
+    try:
+        spooled = request_body.SpooledBody.read_from(request.stream, REQUEST_SPOOL_BYTES, limit or None)
+    except request_body.BodyTooLarge:
+        return jsonify({'error': f'Request body exceeds {limit} bytes'}), 413
+    g.request_body = spooled
+    try:
+        fields = request_body.scan_top_level(spooled.view(), ('stream', 'model'))
+    except request_body.BodyScanError:
         return jsonify({'error': 'Invalid JSON body'}), 400
+    model = fields['model'][0] if 'model' in fields else None
 
-    client_stream = bool(payload.get('stream'))
+    client_stream = bool(fields['stream'][0]) if 'stream' in fields else False
     stream_conversion_enabled = bool(getattr(config, 'stream_conversion_enabled', False))
     should_convert = (not client_stream) and stream_conversion_enabled
     zai_stream = client_stream or should_convert
+    body = spooled.upload_data(fields, force_stream=zai_stream)
 
     candidates = _get_token_candidates()
     if not candidates:
         return jsonify({'error': 'No active tokens available'}), 503
+    # 等待上游 / 转发流式响应期间不占用数据库连接（config 已加载的属性仍可读取）
+    db.session.close()
 
     max_attempts = max(1, int(getattr(config, 'error_retry_count', 1) or 1))
     attempts = 0
     last_response = None
 
+    if not upstream_breaker.allow_request():
+        return _breaker_open_response()
+
     for token in candidates:
         if attempts >= max_attempts:
             break
+        # 熔断已打开（或处于探测）时不再换 token 重试
+        if attempts and not upstream_breaker.closed:
+            break
         attempts += 1
 
-        zai_url = "https://zai.is/api/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {token.zai_token}",
-            "Content-Type": "application/json"
-        }
-
-        zai_payload = dict(payload)
-        if zai_stream:
-            zai_payload['stream'] = True
+        zai_url = f"{services.ZAI_BASE_URL}/api/v1/chat/completions"
+        headers = upstream_headers.for_token(token.zai_token, _JSON_CONTENT_TYPE)
+        # 分阶段超时（见 upstream_timeouts.py）；每次换 token 重新计时
+        deadline = upstream_timeouts.Deadline('chat_stream' if zai_stream else 'chat',
+                                              model if isinstance(model, str) else None)
 
         try:
-            resp = requests.post(zai_url, json=zai_payload, headers=headers, stream=zai_stream, timeout=600)
+            # 每次重试复用同一个 bytes 缓冲区
+            # 始终以流方式读取，便于把上游已压缩的响应体原样透传
+            resp = requests.post(zai_url, data=request_body.rewind(body), headers=headers, stream=True,
+                                 timeout=deadline.request_timeout())
         except Exception as e:
-            _mark_token_error(token, config, f"Request error: {e}")
+            timeout = _as_timeout(e, deadline, 'ttfb')
+            if timeout is not None:
+                last_response = _upstream_timeout(token, config, timeout)
+                continue
+            _mark_upstream_failure(token, config, f"Request error: {e}")
             last_response = jsonify({'error': str(e)})
             last_response.status_code = 502
             continue
 
         # Log request (UI 展示用，写入脱敏 token)
-        duration = time.time() - start_time
-        log = RequestLog(
-            operation="chat/completions",
-            token_email=token.email,
-            discord_token=_mask_token(token.discord_token),
-            zai_token=_mask_token(token.zai_token),
-            status_code=resp.status_code,
-            duration=duration
-        )
-        db.session.add(log)
-        db.session.commit()
+        _record_request("chat/completions", token, resp.status_code, time.time() - start_time)
 
         if resp.status_code >= 400:
             try:
                 detail = resp.text
             except Exception:
                 detail = ''
-            # 429 (Too Many Requests) 是速率限制，不计入错误，只尝试下一个token
-            if resp.status_code != 429:
-                _mark_token_error(token, config, f"HTTP {resp.status_code}: {detail[:200]}")
-            else:
-                logger.info(f"Token {token.id} hit rate limit (429), trying next token")
+            _mark_upstream_status(token, config, resp.status_code, detail)
             last_response = Response(resp.content, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
             continue
 
-        _mark_token_success(token)
-
-        if client_stream:
-            def generate():
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        yield chunk
-            return Response(stream_with_context(generate()), status=resp.status_code, headers=_filter_stream_headers(resp.headers))
+        if zai_stream:
+            # 向客户端发送任何字节之前先读到第一个事件：卡住、断开或错误事件时换下一个 token
+            encoding = _passthrough_encoding(resp) if client_stream else None
+            try:
+                peeked = sse_peek.peek(resp, encoding, deadline.first_event_timeout(), deadline.read_timeout())
+            except (sse_peek.StreamPeekTimeout, upstream_timeouts.UpstreamTimeout) as e:
+                resp.close()
+                phase = 'total' if getattr(e, 'phase', None) == 'total' else 'ttfb'
+                last_response = _upstream_timeout(token, config, upstream_timeouts.UpstreamTimeout(deadline.route, phase))
+                continue
+            except sse_peek.StreamPeekError as e:
+                resp.close()
+                _mark_upstream_failure(token, config, f"Stream error: {e}")
+                last_response = jsonify({'error': f'upstream {e}'})
+                last_response.status_code = 502
+                continue
+            if peeked.error:
+                resp.close()
+                _mark_upstream_failure(token, config, f"Stream error event: {peeked.error[:200]}")
+                if client_stream:
+                    last_response = Response(f"{peeked.event}\n\n", status=resp.status_code, mimetype='text/event-stream')
+                else:
+                    last_response = jsonify({'error': 'upstream stream error', 'detail': peeked.error[:1000]})
+                    last_response.status_code = 502
+                continue
+
+            # 首个事件之后：相邻两次读取超过 idle（或超过 total）时结束
+            chunks = upstream_timeouts.paced(peeked.iter_bytes(), resp, deadline)
+
+            if should_convert:
+                # 客户端尚未收到任何数据，聚合途中超时仍可换 token 重试
+                watch = client_watch.watcher.watch(request.environ, resp, 'chat/completions')
+                try:
+                    aggregated = _aggregate_sse_to_nonstream(sse_peek.iter_lines(chunks), fallback_model=model if isinstance(model, str) else None)
+                except Exception as e:
+                    if watch.cancelled:
+                        return _client_cancelled_response()
+                    if not isinstance(e, upstream_timeouts.UpstreamTimeout):
+                        raise
+                    last_response = _upstream_timeout(token, config, e)
+                    continue
+                finally:
+                    client_watch.watcher.release(watch)
+                    resp.close()
+                if watch.cancelled:
+                    return _client_cancelled_response()
+                _mark_token_success(token)
+                return jsonify(aggregated)
+
+            _mark_token_success(token)
+            out_headers = _filter_stream_headers(resp.headers)
+            if encoding:
+                out_headers['Content-Encoding'] = encoding
+            watch = client_watch.watcher.watch(request.environ, resp, 'chat/completions')
+            return Response(stream_with_context(_relay_stream(chunks, resp, watch)), status=resp.status_code, headers=out_headers)
 
-        if should_convert:
-            aggregated = _aggregate_sse_to_nonstream(resp, fallback_model=payload.get('model'))
-            return jsonify(aggregated)
+        try:
+            upstream_timeouts.set_read_timeout(resp, deadline.read_timeout())
+            out = _upstream_body_response(resp, resp.headers.get('Content-Type', 'application/json'))
+        except Exception as e:
+            resp.close()
+            timeout = _as_timeout(e, deadline)
+            if timeout is None:
+                raise
+            last_response = _upstream_timeout(token, config, timeout)
+            continue
 
-        return Response(resp.content, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
+        _mark_token_success(token)
+        return out
 
     if last_response is not None:
         return last_response
@@ -861,6 +1124,7 @@ def proxy_models():
     start_time = time.time()
 
     candidates = _get_token_candidates()
+    db.session.close()
     if not candidates: # If no token, maybe we can't fetch models? Or just return default list.
         # Fallback list
         return jsonify({
@@ -875,54 +1139,74 @@ def proxy_models():
     attempts = 0
     last_response = None
 
+    if not upstream_breaker.allow_request():
+        return _breaker_open_response()
+
     for token in candidates:
         if attempts >= max_attempts:
             break
+        # 熔断已打开（或处于探测）时不再换 token 重试
+        if attempts and not upstream_breaker.closed:
+            break
         attempts += 1
 
-        zai_url = "https://zai.is/api/v1/models"
-        headers = {"Authorization": f"Bearer {token.zai_token}"}
+        zai_url = f"{services.ZAI_BASE_URL}/api/v1/models"
+        headers = upstream_headers.for_token(token.zai_token)
+
+        deadline = upstream_timeouts.Deadline('models')
 
         try:
-            resp = requests.get(zai_url, headers=headers, timeout=60)
+            resp = requests.get(zai_url, headers=headers, stream=True, timeout=deadline.request_timeout())
         except Exception as e:
-            _mark_token_error(token, config, f"Request error: {e}")
+            timeout = _as_timeout(e, deadline, 'ttfb')
+            if timeout is not None:
+                last_response = _upstream_timeout(token, config, timeout)
+                continue
+            _mark_upstream_failure(token, config, f"Request error: {e}")
             last_response = jsonify({"error": "Failed to fetch models", "detail": str(e)})
             last_response.status_code = 502
             continue
 
-        duration = time.time() - start_time
-        log = RequestLog(
-            operation="models",
-            token_email=token.email,
-            discord_token=_mask_token(token.discord_token),
-            zai_token=_mask_token(token.zai_token),
-            status_code=resp.status_code,
-            duration=duration
-        )
-        db.session.add(log)
-        db.session.commit()
+        _record_request("models", token, resp.status_code, time.time() - start_time)
 
         if resp.status_code >= 400:
             try:
                 detail = resp.text
             except Exception:
                 detail = ''
-            # 429 (Too Many Requests) 是速率限制，不计入错误，只尝试下一个token
-            if resp.status_code != 429:
-                _mark_token_error(token, config, f"HTTP {resp.status_code}: {detail[:200]}")
-            else:
-                logger.info(f"Token {token.id} hit rate limit (429), trying next token")
+            _mark_upstream_status(token, config, resp.status_code, detail)
             last_response = Response(resp.content, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
             continue
 
+        try:
+            upstream_timeouts.set_read_timeout(resp, deadline.read_timeout())
+            out = _upstream_body_response(resp, 'application/json')
+        except Exception as e:
+            resp.close()
+            timeout = _as_timeout(e, deadline)
+            if timeout is None:
+                raise
+            last_response = _upstream_timeout(token, config, timeout)
+            continue
+
         _mark_token_success(token)
-        return Response(resp.content, status=resp.status_code, mimetype='application/json')
+        return out
 
     if last_response is not None:
         return last_response
     return jsonify({"error": "Failed to fetch models"}), 500
 
+def main():
+    from werkzeug.debug import DebuggedApplication
+    from werkzeug.serving import make_server
+
+    create_app(start_background=False)
+    # 与 app.run(debug=True, use_reloader=False) 相同；先绑定端口，再启动后台任务
+    app.debug = True
+    server = make_server('0.0.0.0', int(os.environ.get('PORT', 5000)), DebuggedApplication(app, evalex=True), threaded=True)
+    start_background_jobs()
+    logger.info(f"Serving on http://{server.host}:{server.port}")
+    server.serve_forever()
+
 if __name__ == '__main__':
-    init_db()
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False) # use_reloader=False for scheduler
+    main()
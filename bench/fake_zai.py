@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地 fake zai.is 上游（压测 / CI 使用，不访问外网）
+
+模拟接口：
+  POST /api/v1/chat/completions   流式（SSE）与非流式
+  GET  /api/v1/models
+  GET  /api/v1/auths/
+  GET  /oauth/discord/login        302 到 Discord 授权地址
+  POST /api/v9/oauth2/authorize    Discord 授权（网关需设置 DISCORD_API_BASE 指向这里）
+  GET  /oauth/discord/callback     302 到 /#token=<jwt>（--oauth-callback 切换为多跳重定向 / token cookie / session cookie）
+  GET  /oauth/discord/hop          多跳重定向的中间跳转
+
+用法：python bench/fake_zai.py --port 8900 --latency-ms 50 --chunks 20 --chunk-interval-ms 10
+      加 --seed 固定错误注入与 OAuth state 的随机序列
+      加 --compress 时 chat/models 响应按客户端 Accept-Encoding 压缩（测试压缩透传）
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+def make_jwt(email: str, ttl: int = 3600) -> str:
+    """生成未签名校验的 JWT（网关只解码 exp / email）"""
+    def b64(obj) -> str:
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b'=').decode()
+    return f"{b64({'alg': 'HS256', 'typ': 'JWT'})}.{b64({'email': email, 'exp': int(time.time()) + ttl})}.c2ln"
+
+
+class FakeZai:
+    def __init__(self, latency_ms: float = 0, chunks: int = 10, chunk_interval_ms: float = 0,
+                 chunk_size: int = 16, error_rate_429: float = 0, error_rate_5xx: float = 0,
+                 oauth_latency_ms: float = 0, seed: int | None = None, compress: bool = False,
+                 stall_rate: float = 0, stall_ms: float = 120000, error_event_rate: float = 0,
+                 oauth_callback: str = 'fragment', oauth_hops: int = 3):
+        self.latency = latency_ms / 1000
+        self.chunks = chunks
+        self.chunk_interval = chunk_interval_ms / 1000
+        self.chunk_size = chunk_size
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.oauth_latency = oauth_latency_ms / 1000
+        self.compress = compress
+        self.stall_rate = stall_rate
+        self.stall = stall_ms / 1000
+        self.error_event_rate = error_event_rate
+        self.oauth_callback_mode = oauth_callback
+        self.oauth_hops = oauth_hops
+        self.random = random.Random(seed)
+        self.sessions = {}
+        self.stats = {'chat': 0, 'models': 0, 'logins': 0, 'injected_429': 0, 'injected_5xx': 0,
+                      'injected_stall': 0, 'injected_error_event': 0, 'oauth_hops': 0, 'session_auths': 0}
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.add_routes([
+            web.post('/api/v1/chat/completions', self.chat_completions),
+            web.get('/api/v1/models', self.models),
+            web.get('/api/v1/auths/', self.auths),
+            web.get('/oauth/discord/login', self.oauth_login),
+            web.post('/api/v9/oauth2/authorize', self.discord_authorize),
+            web.get('/oauth/discord/callback', self.oauth_callback),
+            web.get('/oauth/discord/hop', self.oauth_hop),
+            web.get('/', self.index),
+            web.get('/__stats', self.get_stats),
+        ])
+        return app
+
+    def _injected_error(self):
+        roll = self.random.random()
+        if roll < self.error_rate_429:
+            self.stats['injected_429'] += 1
+            return web.json_response({'error': 'rate limited'}, status=429)
+        if roll < self.error_rate_429 + self.error_rate_5xx:
+            self.stats['injected_5xx'] += 1
+            return web.json_response({'error': 'upstream error'}, status=502)
+        return None
+
+    @staticmethod
+    def _authorized(request: web.Request) -> bool:
+        return request.headers.get('Authorization', '').startswith('Bearer ')
+
+    def _maybe_compress(self, resp: web.StreamResponse) -> web.StreamResponse:
+        if self.compress:
+            resp.enable_compression()
+        return resp
+
+    def _chunk(self, rid: str, model: str, content=None, finish=None, role=None) -> bytes:
+        delta = {}
+        if role:
+            delta['role'] = role
+        if content is not None:
+            delta['content'] = content
+        body = {
+            'id': rid, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}]
+        }
+        return f"data: {json.dumps(body)}\n\n".encode()
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        if not self._authorized(request):
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        self.stats['chat'] += 1
+        payload = await request.json()
+        model = payload.get('model') or 'fake-model'
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        error = self._injected_error()
+        if error is not None:
+            return error
+
+        rid = f"chatcmpl-{int(time.time() * 1000)}"
+        piece = 'x' * self.chunk_size
+        if not payload.get('stream'):
+            if self.chunk_interval:
+                await asyncio.sleep(self.chunk_interval * self.chunks)
+            return self._maybe_compress(web.json_response({
+                'id': rid, 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': piece * self.chunks},
+                             'finish_reason': 'stop'}]
+            }))
+
+        resp = self._maybe_compress(
+            web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'}))
+        await resp.prepare(request)
+        # 200 之后的故障：首个事件前卡住 / 首个事件即为错误
+        roll = self.random.random()
+        if roll < self.stall_rate:
+            self.stats['injected_stall'] += 1
+            await asyncio.sleep(self.stall)
+        elif roll < self.stall_rate + self.error_event_rate:
+            self.stats['injected_error_event'] += 1
+            await resp.write(f"data: {json.dumps({'error': {'message': 'upstream overloaded', 'type': 'server_error'}})}\n\n".encode())
+            await resp.write_eof()
+            return resp
+        await resp.write(self._chunk(rid, model, role='assistant', content=''))
+        for _ in range(self.chunks):
+            if self.chunk_interval:
+                await asyncio.sleep(self.chunk_interval)
+            await resp.write(self._chunk(rid, model, content=piece))
+        await resp.write(self._chunk(rid, model, finish='stop'))
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def models(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        self.stats['models'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        error = self._injected_error()
+        if error is not None:
+            return error
+        return self._maybe_compress(web.json_response({'object': 'list', 'data': [
+            {'id': 'fake-model', 'object': 'model', 'created': 1700000000, 'owned_by': 'fake'}
+        ]}))
+
+    async def auths(self, request: web.Request) -> web.Response:
+        email = self.sessions.get(request.cookies.get('session', ''))
+        if not email:
+            return web.json_response({'error': 'no session'}, status=401)
+        self.stats['session_auths'] += 1
+        return web.json_response({'id': email.split('@')[0], 'email': email, 'name': email.split('@')[0]})
+
+    async def index(self, request: web.Request) -> web.Response:
+        return web.Response(text='<html></html>', content_type='text/html')
+
+    async def oauth_login(self, request: web.Request) -> web.Response:
+        callback = f"{request.scheme}://{request.host}/oauth/discord/callback"
+        state = base64.urlsafe_b64encode(self.random.randbytes(12)).decode()
+        location = (f"https://discord.com/oauth2/authorize?client_id=1000&response_type=code"
+                    f"&redirect_uri={callback}&scope=identify+email&state={state}")
+        resp = web.Response(status=302, headers={'Location': location})
+        resp.set_cookie('oauth_state', state)
+        return resp
+
+    async def discord_authorize(self, request: web.Request) -> web.Response:
+        discord_token = request.headers.get('Authorization', '')
+        if len(discord_token) < 20:
+            return web.json_response({'message': '401: Unauthorized'}, status=401)
+        if self.oauth_latency:
+            await asyncio.sleep(self.oauth_latency)
+        code = hashlib.sha1(discord_token.encode()).hexdigest()[:16]
+        state = request.query.get('state', '')
+        return web.json_response({'location': f"{request.query.get('redirect_uri')}?code={code}&state={state}"})
+
+    async def oauth_callback(self, request: web.Request) -> web.Response:
+        if request.cookies.get('oauth_state') != request.query.get('state'):
+            return web.json_response({'error': 'state mismatch'}, status=400)
+        self.stats['logins'] += 1
+        email = f"{request.query.get('code', 'user')[:12]}@fake.zai"
+        mode = self.oauth_callback_mode
+        if mode == 'redirect':
+            return self._hop(self.oauth_hops, email)
+        if mode == 'fragment':
+            return web.Response(status=302, headers={'Location': f"/#token={make_jwt(email)}"})
+        # cookie / session：回到首页，token 或 session 只在 cookie 里
+        resp = web.Response(status=302, headers={'Location': '/'})
+        if mode == 'cookie':
+            resp.set_cookie('token', make_jwt(email))
+        else:
+            session_id = base64.urlsafe_b64encode(self.random.randbytes(12)).decode()
+            self.sessions[session_id] = email
+            resp.set_cookie('session', session_id)
+        return resp
+
+    def _hop(self, remaining: int, email: str) -> web.Response:
+        # 中间跳转不带 token，最后一跳才到 /#token=
+        if remaining <= 0:
+            return web.Response(status=302, headers={'Location': f"/#token={make_jwt(email)}"})
+        return web.Response(status=302, headers={'Location': f"/oauth/discord/hop?n={remaining - 1}&email={email}"})
+
+    async def oauth_hop(self, request: web.Request) -> web.Response:
+        self.stats['oauth_hops'] += 1
+        return self._hop(int(request.query.get('n', 0)), request.query.get('email', 'user@fake.zai'))
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--latency-ms', type=float, default=20, help='上游首包前的固定延迟')
+    parser.add_argument('--chunks', type=int, default=20, help='每个流式响应的内容块数')
+    parser.add_argument('--chunk-interval-ms', type=float, default=5, help='相邻 SSE 块之间的间隔')
+    parser.add_argument('--chunk-size', type=int, default=16, help='每块内容的字符数')
+    parser.add_argument('--error-rate-429', type=float, default=0, help='注入 429 的比例 (0~1)')
+    parser.add_argument('--error-rate-5xx', type=float, default=0, help='注入 5xx 的比例 (0~1)')
+    parser.add_argument('--oauth-latency-ms', type=float, default=0, help='Discord 授权接口延迟')
+    parser.add_argument('--compress', action='store_true', help='按 Accept-Encoding 压缩 chat / models 响应')
+    parser.add_argument('--stall-rate', type=float, default=0, help='流式响应返回 200 后在首个事件前卡住的比例 (0~1)')
+    parser.add_argument('--stall-ms', type=float, default=120000, help='卡住的时长')
+    parser.add_argument('--error-event-rate', type=float, default=0, help='流式响应首个事件为错误 JSON 的比例 (0~1)')
+    parser.add_argument('--oauth-callback', choices=['fragment', 'redirect', 'cookie', 'session'], default='fragment',
+                        help='OAuth 回调返回 token 的方式：/#token=、多跳重定向、token cookie、session cookie（经 /api/v1/auths/ 校验）')
+    parser.add_argument('--oauth-hops', type=int, default=3, help='--oauth-callback redirect 时的中间跳转次数')
+    parser.add_argument('--seed', type=int, help='随机数种子（错误注入与 OAuth state），固定后结果可复现')
+
+
+def from_args(args: argparse.Namespace) -> FakeZai:
+    return FakeZai(
+        latency_ms=args.latency_ms,
+        chunks=args.chunks,
+        chunk_interval_ms=args.chunk_interval_ms,
+        chunk_size=args.chunk_size,
+        error_rate_429=args.error_rate_429,
+        error_rate_5xx=args.error_rate_5xx,
+        oauth_latency_ms=args.oauth_latency_ms,
+        compress=getattr(args, 'compress', False),
+        stall_rate=getattr(args, 'stall_rate', 0),
+        stall_ms=getattr(args, 'stall_ms', 120000),
+        error_event_rate=getattr(args, 'error_event_rate', 0),
+        seed=getattr(args, 'seed', None),
+        oauth_callback=getattr(args, 'oauth_callback', 'fragment'),
+        oauth_hops=getattr(args, 'oauth_hops', 3),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 fake zai.is 上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(from_args(args).build_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动耗时基准：多次在新进程中 `python -X importtime -c "import app"`，取中位数；
+另外测量 create_app()（建表 / 迁移）在新数据库与已有数据库上的耗时。
+
+与基线对比时只按相对值判定回归：同一次运行内测得 `import flask; import requests` 的耗时作为参照，
+比较 app 导入 / 启动耗时与参照的比值（绝对毫秒数随机器变化，只提示）；
+并检查启动时不应导入的模块（DEFERRED_MODULES）确实没有被导入。
+
+只访问本地临时 SQLite，可在 CI 中运行。
+
+用法：
+  python bench/import_time.py --runs 10
+  python bench/import_time.py --output import-time.json --baseline bench/baseline-import.json --max-regression 0.3
+  （基线不存在时退出码为 2；基线用 --runs 10 --output bench/baseline-import.json 生成）
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 参照：app 也依赖这两个包，二者的导入耗时随机器 / Python 版本同比例变化
+REFERENCE_MODULES = ('flask', 'requests')
+# 只在用到时才导入的模块（后台任务、命令行、浏览器登录），import app 后不应出现在 sys.modules 中
+DEFERRED_MODULES = ('apscheduler', 'argparse', 'webbrowser')
+
+STARTUP_SNIPPET = (
+    "import time; t0 = time.perf_counter(); import app; t1 = time.perf_counter(); "
+    "app.create_app(start_background=False); t2 = time.perf_counter(); "
+    "print('{\"import_ms\": %.2f, \"create_app_ms\": %.2f}' % ((t1 - t0) * 1000, (t2 - t1) * 1000))"
+)
+
+
+def parse_importtime(stderr: str, module: str):
+    """解析 -X importtime 输出，返回 (module 的累计耗时 us, {直接依赖: 累计耗时 us})"""
+    total = None
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if name == module and depth == 0:
+            total = int(cumulative)
+        elif depth == 1:
+            children[name] = int(cumulative)
+    return total, children
+
+
+def measure_import(module: str, runs: int, env: dict) -> dict:
+    totals = []
+    children_runs = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                              cwd=ROOT, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr[-2000:])
+        total, children = parse_importtime(proc.stderr, module)
+        if total is not None:
+            totals.append(total)
+            children_runs.append(children)
+    heaviest = {}
+    for name in children_runs[0] if children_runs else ():
+        heaviest[name] = round(statistics.median(c.get(name, 0) for c in children_runs) / 1000, 2)
+    top = dict(sorted(heaviest.items(), key=lambda kv: kv[1], reverse=True)[:10])
+    return {
+        'import_p50_ms': round(statistics.median(totals) / 1000, 2),
+        'import_min_ms': round(min(totals) / 1000, 2),
+        'top_imports_ms': top,
+    }
+
+
+def measure_reference(runs: int, env: dict) -> float:
+    """REFERENCE_MODULES 导入耗时（累计）的中位数，毫秒"""
+    code = '; '.join(f'import {m}' for m in REFERENCE_MODULES)
+    totals = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                              cwd=ROOT, env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr[-2000:])
+        totals.append(sum(parse_importtime(proc.stderr, m)[0] or 0 for m in REFERENCE_MODULES))
+    return round(statistics.median(totals) / 1000, 2)
+
+
+def deferred_imported(module: str, env: dict) -> list:
+    """import module 之后已经被导入的 DEFERRED_MODULES"""
+    code = (f"import json, sys, {module}; "
+            f"print(json.dumps([m for m in {list(DEFERRED_MODULES)!r} if m in sys.modules]))")
+    proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def measure_startup(runs: int, env: dict) -> dict:
+    """create_app()：首次（新库，需要建表）与再次启动（已有库，只检查 schema 指纹）"""
+    first, warm = [], []
+    for _ in range(runs):
+        workdir = tempfile.mkdtemp(prefix='zai2api-startup-')
+        run_env = dict(env, DATABASE_URI=f"sqlite:///{os.path.join(workdir, 'startup.db')}")
+        for bucket in (first, warm):
+            proc = subprocess.run([sys.executable, '-c', STARTUP_SNIPPET], cwd=ROOT, env=run_env,
+                                  capture_output=True, text=True)
+            if proc.returncode != 0:
+                raise RuntimeError(proc.stderr[-2000:])
+            bucket.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return {
+        'cold_create_app_p50_ms': round(statistics.median(r['create_app_ms'] for r in first), 2),
+        'warm_create_app_p50_ms': round(statistics.median(r['create_app_ms'] for r in warm), 2),
+        'warm_total_p50_ms': round(statistics.median(r['import_ms'] + r['create_app_ms'] for r in warm), 2),
+    }
+
+
+def add_ratios(report: dict) -> None:
+    reference = report.get('reference_import_p50_ms')
+    if not reference:
+        return
+    for key in ('import_p50_ms', 'warm_total_p50_ms'):
+        if report.get(key) is not None:
+            report[key.replace('_p50_ms', '_ratio')] = round(report[key] / reference, 3)
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> tuple[list[str], list[str]]:
+    """与基线对比，返回 (失败, 提示)：相对参照的比值超出容忍度判定失败，绝对耗时只提示"""
+    failures, notes = [], []
+    for key in ('import_ratio', 'warm_total_ratio'):
+        if baseline.get(key) and report.get(key) is not None:
+            if report[key] > baseline[key] * (1 + max_regression):
+                failures.append(f"{key} {report[key]} > baseline {baseline[key]}")
+    for key in ('import_p50_ms', 'warm_total_p50_ms'):
+        if baseline.get(key) and report.get(key) is not None:
+            if report[key] > baseline[key] * (1 + max_regression):
+                notes.append(f"{key} {report[key]} > baseline {baseline[key]}")
+    return failures, notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zai2API 启动耗时基准')
+    parser.add_argument('--module', default='app', help='测量导入耗时的模块')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='把报告写入 JSON 文件')
+    parser.add_argument('--baseline', help='基线报告 JSON，用于回归对比')
+    parser.add_argument('--max-regression', type=float, default=0.3, help='允许的相对回退比例')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        # 指定了基线却不存在时直接失败，避免回归检查被静默跳过
+        if not os.path.exists(args.baseline):
+            print(f"[!] baseline {args.baseline} not found (generate it with --output)")
+            sys.exit(2)
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    env = dict(os.environ, LOG_LEVEL='WARNING')
+    # 先导入一次生成 .pyc，避免把编译时间算进第一轮
+    subprocess.run([sys.executable, '-c', f'import {args.module}'], cwd=ROOT, env=env, capture_output=True)
+    report = {'module': args.module, 'runs': args.runs, 'python': sys.version.split()[0]}
+    report.update(measure_import(args.module, args.runs, env))
+    report['reference_import_p50_ms'] = measure_reference(args.runs, env)
+    report['deferred_imported'] = deferred_imported(args.module, env)
+    if args.module == 'app':
+        report.update(measure_startup(max(1, args.runs // 2), env))
+    add_ratios(report)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    failures = []
+    if report['deferred_imported']:
+        failures.append(f"imported at startup: {', '.join(report['deferred_imported'])}")
+    if baseline is not None:
+        regressions, notes = compare(report, baseline, args.max_regression)
+        failures += regressions
+        if notes:
+            print('\n[i] absolute numbers vs baseline (machine dependent, not fatal):\n  ' + '\n  '.join(notes))
+    if failures:
+        print('\n[!] regression:\n  ' + '\n  '.join(failures))
+        sys.exit(1)
+    if baseline is not None:
+        print('\n[+] within baseline tolerance')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量登录压测：在本地 fake zai.is（同时充当 Discord 授权接口）上并发执行 Discord OAuth 登录，
+对比异步版本（zai_token_async.backend_login_many，一个事件循环）与同步版本
+（zai_token.DiscordOAuthHandler，线程池 + 共享连接池）的耗时、吞吐与各步骤延迟。
+
+全程只访问 127.0.0.1；有登录失败时退出码为 1。
+
+用法：
+  python bench/login_bench.py                                  # 300 次登录，并发 100，async 与 sync 各跑一次
+  python bench/login_bench.py --client async --logins 1000 --concurrency 200 --oauth-latency-ms 100
+  python bench/login_bench.py --output login.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_zai
+from run_bench import ROOT, free_port, percentile, proc_usage, start_process, wait_for_port
+
+
+def make_tokens(count: int) -> list:
+    return [f"bench-discord-token-{i:06d}-{'x' * 24}" for i in range(count)]
+
+
+def login_async(tokens: list, base_url: str, concurrency: int) -> list:
+    from zai_token_async import backend_login_many
+    return asyncio.run(backend_login_many(tokens, base_url, concurrency=concurrency))
+
+
+def login_sync(tokens: list, base_url: str, concurrency: int) -> list:
+    from zai_token import create_oauth_handler
+
+    def login_one(token: str) -> dict:
+        return create_oauth_handler(base_url).backend_login(token)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(login_one, tokens))
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    ok = [r for r in results if r.get('token')]
+    errors = {}
+    for r in results:
+        if not r.get('token'):
+            key = str(r.get('error'))[:80]
+            errors[key] = errors.get(key, 0) + 1
+    steps = {}
+    for r in ok:
+        for step, ms in (r.get('timings') or {}).items():
+            steps.setdefault(step, []).append(ms)
+    return {
+        'ok': len(ok),
+        'failed': len(results) - len(ok),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'logins_per_s': round(len(ok) / elapsed, 1) if elapsed else None,
+        'steps_ms': {step: {'p50': round(percentile(v, 50), 2), 'p99': round(percentile(v, 99), 2)}
+                     for step, v in steps.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zai2API 批量登录压测（async vs sync）')
+    parser.add_argument('--client', choices=['async', 'sync', 'both'], default='both')
+    parser.add_argument('--logins', type=int, default=300, help='登录次数（每次使用不同的 Discord token）')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--output', help='把报告写入 JSON 文件')
+    fake_zai.add_arguments(parser)
+    parser.set_defaults(oauth_latency_ms=50)
+    args = parser.parse_args()
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    # DiscordOAuthHandler.DISCORD_API_BASE 在导入 zai_token 时读取
+    os.environ['DISCORD_API_BASE'] = f"{base_url}/api/v9"
+    sys.path.insert(0, ROOT)
+
+    upstream = start_process([sys.executable, os.path.join(ROOT, 'bench', 'fake_zai.py'), '--port', str(port),
+                              '--oauth-latency-ms', str(args.oauth_latency_ms)]
+                             + (['--seed', str(args.seed)] if args.seed is not None else []))
+    tokens = make_tokens(args.logins)
+    report = {'logins': args.logins, 'concurrency': args.concurrency,
+              'oauth_latency_ms': args.oauth_latency_ms, 'results': {}}
+    try:
+        wait_for_port(port, upstream)
+        clients = ['async', 'sync'] if args.client == 'both' else [args.client]
+        for client in clients:
+            login = login_async if client == 'async' else login_sync
+            before = proc_usage(os.getpid())
+            started = time.perf_counter()
+            results = login(tokens, base_url, args.concurrency)
+            elapsed = time.perf_counter() - started
+            after = proc_usage(os.getpid())
+            report['results'][client] = dict(
+                summarize(results, elapsed),
+                cpu_seconds=round(after.get('cpu_seconds', 0) - before.get('cpu_seconds', 0), 2),
+            )
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    if any(r['failed'] for r in report['results'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
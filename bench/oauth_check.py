@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OAuth 登录回调路径检查：在本地 fake zai.is 上分别以 async（zai_token_async.backend_login_many，共享 connector）
+与 sync（zai_token.create_oauth_handler，线程池 + 共享连接池）并发登录，逐条断言：
+
+  fragment  回调直接 302 到 /#token=<jwt>
+  redirect  回调经多跳重定向后才出现 /#token=（fake 统计的中间跳转数必须等于 登录次数 × 跳数）
+  cookie    token 只在名为 token 的 cookie 里
+  session   只有 session cookie，经 _verify_session（/api/v1/auths/）得到 SESSION_AUTH 与用户信息
+  timeout   Discord 授权接口慢于 oauth.total：登录失败、耗时不超过 total 太多、计入 oauth total 超时
+
+每次登录使用不同的 Discord token，fake 按 token 派生邮箱：拿到的 token / 用户信息必须属于本次登录的账号，
+共享连接池下 cookie 串号（state 不匹配或拿到别人的 session）都会失败。
+
+全程只访问 127.0.0.1；有断言失败时退出码为 1。
+
+用法：
+  python bench/oauth_check.py
+  python bench/oauth_check.py --client async --logins 50 --concurrency 20
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sys
+import time
+import urllib.request
+
+from login_bench import login_async, login_sync, make_tokens
+from run_bench import ROOT, free_port, start_process, wait_for_port
+
+# 超时场景使用较短的 oauth.total；需在导入 upstream_timeouts 之前设置
+OAUTH_TOTAL = 2
+HOPS = 3
+CASES = {
+    'fragment': [],
+    'redirect': ['--oauth-callback', 'redirect', '--oauth-hops', str(HOPS)],
+    'cookie': ['--oauth-callback', 'cookie'],
+    'session': ['--oauth-callback', 'session'],
+    'timeout': ['--oauth-latency-ms', str((OAUTH_TOTAL + 2) * 1000)],
+}
+
+
+def expected_email(discord_token: str) -> str:
+    """与 fake_zai 一致：code = sha1(token)[:16]，邮箱取 code 前 12 位"""
+    return f"{hashlib.sha1(discord_token.encode()).hexdigest()[:12]}@fake.zai"
+
+
+def jwt_email(token: str) -> str:
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))).get('email')
+    except (IndexError, ValueError):
+        return None
+
+
+def fetch_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(f"{base_url}/__stats", timeout=10) as resp:
+        return json.loads(resp.read())
+
+
+def timeout_count() -> int:
+    import upstream_timeouts
+    return upstream_timeouts.snapshot()['timeouts']['oauth']['total']
+
+
+def check_logins(case: str, client: str, tokens: list, results: list, elapsed: float, stats: dict) -> list:
+    """返回失败描述列表"""
+    failures = []
+    for discord_token, result in zip(tokens, results):
+        email = expected_email(discord_token)
+        if case == 'timeout':
+            error = str(result.get('error'))
+            wanted = '登录超时' if client == 'async' else 'oauth total timeout'
+            if result.get('token') or wanted not in error:
+                failures.append(f"{email}: expected {wanted!r}, got {result}")
+        elif case == 'session':
+            user_info = result.get('user_info') or {}
+            if result.get('token') != 'SESSION_AUTH' or user_info.get('email') != email:
+                failures.append(f"{email}: expected SESSION_AUTH for own session, got {result}")
+        elif jwt_email(result.get('token') or '') != email:
+            failures.append(f"{email}: expected own jwt, got {result}")
+    if case == 'redirect' and stats['oauth_hops'] != len(tokens) * HOPS:
+        failures.append(f"expected {len(tokens) * HOPS} redirect hops, fake saw {stats['oauth_hops']}")
+    if case == 'session' and stats['session_auths'] != len(tokens):
+        failures.append(f"expected {len(tokens)} session checks, fake saw {stats['session_auths']}")
+    if case == 'timeout' and elapsed > OAUTH_TOTAL + 1.5:
+        failures.append(f"timeout case took {elapsed:.2f}s, oauth.total is {OAUTH_TOTAL}s")
+    return failures
+
+
+def run_case(case: str, client: str, logins: int, concurrency: int) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    upstream = start_process([sys.executable, os.path.join(ROOT, 'bench', 'fake_zai.py'),
+                              '--port', str(port), '--seed', '1'] + CASES[case])
+    try:
+        wait_for_port(port, upstream)
+        tokens = make_tokens(logins)
+        # DiscordOAuthHandler.DISCORD_API_BASE 在导入时读取，各 case 的端口不同，直接改类属性
+        from zai_token import DiscordOAuthHandler
+        from zai_token_async import AsyncDiscordOAuthHandler
+        DiscordOAuthHandler.DISCORD_API_BASE = AsyncDiscordOAuthHandler.DISCORD_API_BASE = f"{base_url}/api/v9"
+
+        timeouts_before = timeout_count()
+        login = login_async if client == 'async' else login_sync
+        started = time.perf_counter()
+        results = login(tokens, base_url, concurrency)
+        elapsed = time.perf_counter() - started
+        stats = fetch_stats(base_url)
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+
+    failures = check_logins(case, client, tokens, results, elapsed, stats)
+    if case == 'timeout' and timeout_count() - timeouts_before != logins:
+        failures.append(f"expected {logins} oauth total timeouts, recorded {timeout_count() - timeouts_before}")
+    return {'elapsed_s': round(elapsed, 3), 'failures': failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zai2API OAuth 回调路径检查')
+    parser.add_argument('--client', choices=['async', 'sync', 'both'], default='both')
+    parser.add_argument('--logins', type=int, default=40, help='每个场景的登录次数（每次使用不同的 Discord token）')
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ['UPSTREAM_TIMEOUTS'] = json.dumps({'oauth': {'total': OAUTH_TOTAL}})
+    sys.path.insert(0, ROOT)
+
+    clients = ['async', 'sync'] if args.client == 'both' else [args.client]
+    report = {}
+    for case in CASES:
+        # 超时场景每次都要等满 oauth.total，少跑几次
+        logins = min(args.logins, args.concurrency) if case == 'timeout' else args.logins
+        for client in clients:
+            report[f"{case}/{client}"] = result = run_case(case, client, logins, args.concurrency)
+            print(f"{case:<9} {client:<5} {'ok' if not result['failures'] else 'FAILED'} "
+                  f"({logins} logins, {result['elapsed_s']}s)")
+            for failure in result['failures'][:5]:
+                print(f"    {failure}")
+
+    if any(r['failures'] for r in report.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+网关离线压测：启动本地 fake zai.is 与网关进程，按给定并发驱动请求，
+输出吞吐、TTFB p50/p99、网关额外开销、网关进程 CPU 与 RSS。
+与基线对比时只按同一次运行内的相对指标（网关 / 直连上游的吞吐比例、额外开销）判定回归。
+
+全程只访问 127.0.0.1，可在无外网的 CI 中运行。
+
+用法：
+  python bench/run_bench.py --mode stream --concurrency 32 --requests 2000
+  python bench/run_bench.py --mode login --tokens 500
+  python bench/run_bench.py --output bench.json --baseline bench/baseline-stream.json --max-regression 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+import fake_zai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = 'sk-bench'
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"process exited early with code {proc.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"port {port} not ready after {timeout}s")
+
+
+def percentile(values, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def proc_usage(pid: int) -> dict:
+    """读取 /proc 中的 CPU 时间与 RSS（非 Linux 环境返回空）"""
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        usage['cpu_seconds'] = (int(fields[11]) + int(fields[12])) / CLK_TCK
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key = 'rss_mb' if line.startswith('VmRSS') else 'peak_rss_mb'
+                    usage[key] = round(int(line.split()[1]) / 1024, 1)
+    except (OSError, IndexError, ValueError):
+        pass
+    return usage
+
+
+def build_payload(mode: str, prompt_bytes: int) -> dict:
+    return {
+        'model': 'fake-model',
+        'stream': mode == 'stream',
+        'messages': [{'role': 'user', 'content': 'x' * prompt_bytes}]
+    }
+
+
+async def one_request(session: aiohttp.ClientSession, method: str, url: str, headers: dict, body) -> dict:
+    start = time.perf_counter()
+    ttfb = None
+    try:
+        async with session.request(method, url, headers=headers, json=body) as resp:
+            async for _ in resp.content.iter_any():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+            status = resp.status
+    except Exception:
+        status = 0
+    total = time.perf_counter() - start
+    return {'status': status, 'ttfb': ttfb if ttfb is not None else total, 'total': total}
+
+
+async def drive(base_url: str, mode: str, concurrency: int, total_requests: int, prompt_bytes: int,
+                headers: dict, upstream: bool = False) -> dict:
+    if mode == 'models':
+        method, path, body = 'GET', '/v1/models', None
+    else:
+        method, path, body = 'POST', '/v1/chat/completions', build_payload(mode, prompt_bytes)
+    if upstream:
+        # 直连 fake 上游时，convert 模式等价于上游的流式请求
+        path = '/api' + path
+        if body is not None and mode == 'convert':
+            body = dict(body, stream=True)
+    url = base_url + path
+
+    results = []
+    queue: asyncio.Queue = asyncio.Queue()
+    for _ in range(total_requests):
+        queue.put_nowait(None)
+
+    async def worker(session):
+        while True:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results.append(await one_request(session, method, url, headers, body))
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=600)
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if 200 <= r['status'] < 300]
+    ttfb = [r['ttfb'] * 1000 for r in ok]
+    totals = [r['total'] * 1000 for r in ok]
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': len(results) - len(ok),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 1) if elapsed else 0,
+        'ttfb_p50_ms': _round(percentile(ttfb, 50)),
+        'ttfb_p99_ms': _round(percentile(ttfb, 99)),
+        'total_p50_ms': _round(percentile(totals, 50)),
+        'total_p99_ms': _round(percentile(totals, 99)),
+    }
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+async def admin_session(base_url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{base_url}/api/login", json={'username': 'admin', 'password': 'admin'}) as resp:
+            token = (await resp.json())['token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+async def seed(base_url: str, admin: dict, mode: str, tokens: int, with_access_token: bool) -> dict:
+    items = []
+    for i in range(tokens):
+        item = {'session_token': f"bench-discord-token-{i:06d}-{'x' * 24}"}
+        if with_access_token:
+            item['access_token'] = fake_zai.make_jwt(f"bench{i}@fake.zai")
+        items.append(item)
+
+    async with aiohttp.ClientSession(headers=admin) as session:
+        await session.post(f"{base_url}/api/admin/apikey", json={'new_api_key': API_KEY})
+        await session.post(f"{base_url}/api/admin/config", json={
+            'stream_conversion_enabled': mode == 'convert', 'error_retry_count': 3})
+        start = time.perf_counter()
+        async with session.post(f"{base_url}/api/tokens/import", json={'tokens': items}) as resp:
+            result = await resp.json()
+        accepted = time.perf_counter() - start
+
+        converted = None
+        if result.get('job_id'):
+            async with session.get(f"{base_url}/api/tokens/import/{result['job_id']}/progress") as resp:
+                async for line in resp.content:
+                    if line.startswith(b'data:'):
+                        converted = json.loads(line[5:])
+            converted = dict(converted or {}, elapsed_s=round(time.perf_counter() - start, 3))
+    return {'import_accept_s': round(accepted, 3), 'conversion': converted, 'import': result}
+
+
+def start_process(args_list, env=None) -> subprocess.Popen:
+    return subprocess.Popen(args_list, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run(args) -> dict:
+    upstream_port = free_port()
+    gateway_port = free_port()
+    upstream_url = f"http://127.0.0.1:{upstream_port}"
+    gateway_url = f"http://127.0.0.1:{gateway_port}"
+    workdir = tempfile.mkdtemp(prefix='zai2api-bench-')
+
+    fake_cmd = [sys.executable, os.path.join(ROOT, 'bench', 'fake_zai.py'), '--port', str(upstream_port),
+                '--latency-ms', str(args.latency_ms), '--chunks', str(args.chunks),
+                '--chunk-interval-ms', str(args.chunk_interval_ms), '--chunk-size', str(args.chunk_size),
+                '--error-rate-429', str(args.error_rate_429), '--error-rate-5xx', str(args.error_rate_5xx),
+                '--oauth-latency-ms', str(args.oauth_latency_ms),
+                '--stall-rate', str(args.stall_rate), '--stall-ms', str(args.stall_ms),
+                '--error-event-rate', str(args.error_event_rate)] + (['--compress'] if args.compress else []) \
+        + (['--seed', str(args.seed)] if args.seed is not None else [])
+    env = dict(os.environ,
+               DATABASE_URI=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               ZAI_BASE_URL=upstream_url,
+               DISCORD_API_BASE=f"{upstream_url}/api/v9",
+               PORT=str(gateway_port),
+               LOG_LEVEL=args.log_level)
+
+    upstream = start_process(fake_cmd)
+    gateway = None
+    try:
+        wait_for_port(upstream_port, upstream)
+        gateway = start_process([sys.executable, 'app.py'], env=env)
+        wait_for_port(gateway_port, gateway)
+
+        admin = asyncio.run(admin_session(gateway_url))
+        seeded = asyncio.run(seed(gateway_url, admin, args.mode, args.tokens,
+                                  with_access_token=args.mode != 'login'))
+        report = {'mode': args.mode, 'concurrency': args.concurrency, 'seed': seeded}
+        if args.mode == 'login':
+            report['gateway'] = proc_usage(gateway.pid)
+            return report
+
+        client_headers = {'Authorization': f'Bearer {API_KEY}'}
+        upstream_stats = asyncio.run(drive(upstream_url, args.mode, args.concurrency, args.requests,
+                                           args.prompt_bytes, {'Authorization': 'Bearer bench'}, upstream=True))
+        before = proc_usage(gateway.pid)
+        gateway_stats = asyncio.run(drive(gateway_url, args.mode, args.concurrency, args.requests,
+                                          args.prompt_bytes, client_headers))
+        after = proc_usage(gateway.pid)
+
+        overhead = {}
+        for key in ('ttfb_p50_ms', 'ttfb_p99_ms', 'total_p50_ms', 'total_p99_ms'):
+            if gateway_stats.get(key) is not None and upstream_stats.get(key) is not None:
+                overhead[key] = round(gateway_stats[key] - upstream_stats[key], 2)
+
+        report.update({
+            'gateway': gateway_stats,
+            'upstream_direct': upstream_stats,
+            'overhead': overhead,
+            'process': {
+                'cpu_seconds': round(after.get('cpu_seconds', 0) - before.get('cpu_seconds', 0), 2),
+                'rss_mb': after.get('rss_mb'),
+                'peak_rss_mb': after.get('peak_rss_mb'),
+            }
+        })
+        return report
+    finally:
+        for proc in (gateway, upstream):
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+
+def _ratio(report: dict) -> float | None:
+    """网关吞吐 / 直连 fake 上游吞吐（同一次运行内测得）"""
+    gateway, direct = report.get('gateway') or {}, report.get('upstream_direct') or {}
+    if gateway.get('throughput_rps') is None or not direct.get('throughput_rps'):
+        return None
+    return gateway['throughput_rps'] / direct['throughput_rps']
+
+
+def compare(report: dict, baseline: dict, max_regression: float,
+            max_overhead_regression: float = 1.0, overhead_slack_ms: float = 20) -> tuple[list[str], list[str]]:
+    """
+    与基线对比，返回 (失败, 提示)。
+    只有同一次运行内的相对指标会判定失败：网关吞吐 / 直连上游吞吐的比例（max_regression），
+    网关相对直连上游的额外开销 overhead p50（毫秒级、抖动大，单独用 max_overhead_regression 与 overhead_slack_ms）；
+    绝对吞吐 / 延迟 / 转换耗时随机器变化，只作为提示输出。
+    """
+    failures, notes = [], []
+    overhead, base_overhead = report.get('overhead') or {}, baseline.get('overhead') or {}
+    for key in ('ttfb_p50_ms', 'total_p50_ms'):
+        if base_overhead.get(key) is not None and overhead.get(key) is not None:
+            limit = max(base_overhead[key] * (1 + max_overhead_regression), base_overhead[key] + overhead_slack_ms)
+            if overhead[key] > limit:
+                failures.append(f"overhead {key} {overhead[key]} > {round(limit, 2)} (baseline {base_overhead[key]})")
+    ratio, base_ratio = _ratio(report), _ratio(baseline)
+    if ratio is not None and base_ratio:
+        if ratio < base_ratio * (1 - max_regression):
+            failures.append(f"gateway/upstream throughput ratio {ratio:.2f} < baseline {base_ratio:.2f}")
+    current, base = report.get('gateway', {}), baseline.get('gateway', {})
+    if current.get('errors'):
+        failures.append(f"{current['errors']} failed requests")
+    if base.get('throughput_rps') and current.get('throughput_rps') is not None:
+        if current['throughput_rps'] < base['throughput_rps'] * (1 - max_regression):
+            notes.append(f"throughput {current['throughput_rps']} < baseline {base['throughput_rps']}")
+    for key in ('ttfb_p50_ms', 'ttfb_p99_ms'):
+        if base.get(key) and current.get(key) is not None:
+            if current[key] > base[key] * (1 + max_regression):
+                notes.append(f"{key} {current[key]} > baseline {base[key]}")
+    # login 模式：批量导入后的 ST→AT 转换（没有直连对照，耗时只提示）
+    conversion = (report.get('seed') or {}).get('conversion') or {}
+    base_conversion = (baseline.get('seed') or {}).get('conversion') or {}
+    if base_conversion.get('elapsed_s') and conversion.get('elapsed_s') is not None:
+        if conversion['elapsed_s'] > base_conversion['elapsed_s'] * (1 + max_regression):
+            notes.append(f"conversion {conversion['elapsed_s']}s > baseline {base_conversion['elapsed_s']}s")
+    if conversion.get('failed'):
+        failures.append(f"{conversion['failed']} failed conversions")
+    return failures, notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zai2API 离线压测')
+    parser.add_argument('--mode', choices=['stream', 'nonstream', 'convert', 'models', 'login'], default='stream',
+                        help='stream=客户端流式, nonstream=非流式透传, convert=非流式转流式聚合, login=批量导入+ST→AT 转换')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--tokens', type=int, default=20, help='导入的账号数量')
+    parser.add_argument('--prompt-bytes', type=int, default=256, help='请求体中消息内容的大小')
+    parser.add_argument('--log-level', default='WARNING', help='网关进程的 LOG_LEVEL')
+    parser.add_argument('--output', help='把报告写入 JSON 文件')
+    parser.add_argument('--baseline', help='基线报告 JSON，用于回归对比')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='网关 / 直连上游吞吐比例允许的相对回退（绝对指标超出时只提示）')
+    parser.add_argument('--max-overhead-regression', type=float, default=1.0,
+                        help='网关额外开销（overhead p50）允许的相对增长')
+    parser.add_argument('--overhead-slack-ms', type=float, default=20,
+                        help='overhead p50 相对基线至少允许增加的毫秒数，避免开销很小时因抖动误报')
+    fake_zai.add_arguments(parser)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        # 指定了基线却不存在时直接失败，避免回归检查被静默跳过
+        if not os.path.exists(args.baseline):
+            print(f"[!] baseline {args.baseline} not found (generate it with --output)")
+            sys.exit(2)
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    report = run(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    if baseline is not None:
+        failures, notes = compare(report, baseline, args.max_regression,
+                                 args.max_overhead_regression, args.overhead_slack_ms)
+        if notes:
+            print('\n[i] absolute numbers vs baseline (machine dependent, not fatal):\n  ' + '\n  '.join(notes))
+        if failures:
+            print('\n[!] regression vs baseline:\n  ' + '\n  '.join(failures))
+            sys.exit(1)
+        print('\n[+] within baseline tolerance')
+
+
+if __name__ == '__main__':
+    main()
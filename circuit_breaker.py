@@ -0,0 +1,151 @@
+"""
+zai.is 上游整体熔断（closed / open / half-open）。
+
+按时间窗口统计各 token 的请求结果：失败率超过阈值、且失败分布在多个不同 token 上时，
+认为是上游整体故障而不是个别账号的问题，打开熔断。打开期间请求直接失败，
+到期后进入 half-open，每次只放行一个探测请求：成功则关闭，失败则重新打开（时间翻倍，有上限）。
+调用方把 5xx、401/403、连接错误和超时记为失败；失败分布在少于 min_tokens 个 token 上时按账号问题处理。
+熔断未关闭时调用方不应再给 token 记错误。
+
+环境变量：ZAI_BREAKER_WINDOW / ZAI_BREAKER_FAILURE_RATE / ZAI_BREAKER_MIN_REQUESTS /
+ZAI_BREAKER_MIN_TOKENS / ZAI_BREAKER_OPEN_SECONDS，ZAI_BREAKER_ENABLED=0 关闭熔断。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    def __init__(self, window: float = 60, failure_rate: float = 0.5, min_requests: int = 10,
+                 min_tokens: int = 3, open_seconds: float = 30, max_open_seconds: float = 300,
+                 probe_timeout: float = 120, enabled: bool = True):
+        self.window = window
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.min_tokens = min_tokens
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probe_timeout = probe_timeout
+        self.enabled = enabled
+        self.state = CLOSED
+        self._events: deque = deque()  # (ts, token_id, ok)
+        self._lock = threading.Lock()
+        self._opened_at = 0.0
+        self._current_open = open_seconds
+        self._probe_started = 0.0
+        self.trips = 0
+
+    def _prune(self, now: float) -> None:
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
+
+    def _open(self, now: float, reason: str) -> None:
+        self.state = OPEN
+        self._opened_at = now
+        self._probe_started = 0.0
+        self.trips += 1
+        logger.warning(f"zai upstream circuit opened: {reason}",
+                       extra={'fields': {'open_seconds': self._current_open}})
+
+    def allow_request(self) -> bool:
+        """是否放行一次上游请求；half-open 时同一时刻只放行一个探测"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            now = time.time()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if now - self._opened_at < self._current_open:
+                    return False
+                self.state = HALF_OPEN
+                self._probe_started = 0.0
+            # HALF_OPEN：探测请求长时间无结果时允许再探测一次
+            if self._probe_started and now - self._probe_started < self.probe_timeout:
+                return False
+            self._probe_started = now
+            return True
+
+    @property
+    def closed(self) -> bool:
+        return not self.enabled or self.state == CLOSED
+
+    def retry_after(self) -> int:
+        with self._lock:
+            if self.state != OPEN:
+                return 1
+            return max(1, int(self._opened_at + self._current_open - time.time()) + 1)
+
+    def record_success(self, token_id=None) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.time()
+            if self.state == OPEN:
+                return  # 打开前已发出的请求，结果不作为探测
+            if self.state == HALF_OPEN:
+                logger.info("zai upstream circuit closed: probe succeeded")
+                self.state = CLOSED
+                self._current_open = self.open_seconds
+                self._events.clear()
+                return
+            self._events.append((now, token_id, True))
+            self._prune(now)
+
+    def record_failure(self, token_id=None) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.time()
+            if self.state == OPEN:
+                return
+            if self.state == HALF_OPEN:
+                # 探测失败：重新打开，时间翻倍
+                self._current_open = min(self._current_open * 2, self.max_open_seconds)
+                self._open(now, "probe failed")
+                return
+            self._events.append((now, token_id, False))
+            self._prune(now)
+            total = len(self._events)
+            failures = [tid for _, tid, ok in self._events if not ok]
+            if total < self.min_requests or len(failures) / total < self.failure_rate:
+                return
+            # 失败集中在少数 token 上属于账号问题，不熔断
+            failed_tokens = len(set(failures))
+            if failed_tokens >= self.min_tokens:
+                self._open(now, f"{len(failures)}/{total} failed across {failed_tokens} tokens")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._prune(time.time())
+            failures = [tid for _, tid, ok in self._events if not ok]
+            return {
+                'enabled': self.enabled,
+                'state': self.state,
+                'window_requests': len(self._events),
+                'window_failures': len(failures),
+                'window_failed_tokens': len(set(failures)),
+                'open_seconds': self._current_open,
+                'trips': self.trips,
+            }
+
+
+def from_env() -> CircuitBreaker:
+    env = os.environ.get
+    return CircuitBreaker(
+        window=float(env('ZAI_BREAKER_WINDOW', '60')),
+        failure_rate=float(env('ZAI_BREAKER_FAILURE_RATE', '0.5')),
+        min_requests=int(env('ZAI_BREAKER_MIN_REQUESTS', '10')),
+        min_tokens=int(env('ZAI_BREAKER_MIN_TOKENS', '3')),
+        open_seconds=float(env('ZAI_BREAKER_OPEN_SECONDS', '30')),
+        enabled=env('ZAI_BREAKER_ENABLED', '1').lower() not in ('0', 'false', 'no'),
+    )
@@ -0,0 +1,145 @@
+"""
+流式响应的客户端断开检测。
+
+转发上游 SSE 期间，生成器阻塞在读取上游上，只有下一次向客户端写入失败时才会发现客户端已断开，
+在此之前上游仍在生成（消耗额度）并占用工作线程和上游连接。
+这里用一个后台线程监视所有正在转发的客户端连接（epoll / select，每个流不额外占线程）：
+客户端连接关闭（可读且读到 EOF）时立即关闭对应的上游 socket，阻塞的读取随即返回，
+转发结束后上游连接从连接池释放。结果计为 client_cancelled（GET /api/upstream/streams 查看）。
+
+客户端 socket 取自 WSGI environ（werkzeug 开发服务器为 werkzeug.socket，gunicorn 为 gunicorn.socket）；
+取不到时只在写入失败时发现断开（同样计数）。
+
+环境变量：CLIENT_DISCONNECT_POLL（检查间隔秒数，默认 1）
+"""
+
+import logging
+import os
+import selectors
+import socket
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.environ.get('CLIENT_DISCONNECT_POLL', '1'))
+
+_PEEK_FLAGS = socket.MSG_PEEK | getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class Watch:
+    """一个正在转发的流：客户端 socket 与上游响应"""
+
+    __slots__ = ('client', 'resp', 'label', 'cancelled')
+
+    def __init__(self, client, resp, label: str):
+        self.client = client
+        self.resp = resp
+        self.label = label
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """标记客户端已断开并关闭上游 socket（唤醒阻塞在读取上的转发线程）"""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        sock = getattr(getattr(getattr(self.resp, 'raw', None), 'connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class DisconnectWatcher:
+    def __init__(self, interval: float = POLL_INTERVAL):
+        self.interval = interval
+        self.cancelled = 0
+        self.completed = 0
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, environ, resp, label: str = '') -> Watch:
+        client = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+        watch = Watch(client, resp, label)
+        if client is not None:
+            try:
+                with self._lock:
+                    self._selector.register(client, selectors.EVENT_READ, watch)
+                    self._wake.set()
+            except (ValueError, KeyError, OSError):
+                # 已关闭或已被监视（同一连接上的上一个流尚未释放）
+                watch.client = None
+            else:
+                self._ensure_thread()
+        return watch
+
+    def release(self, watch: Watch) -> None:
+        """转发结束：停止监视并记录结果"""
+        self._unregister(watch)
+        with self._lock:
+            if watch.cancelled:
+                self.cancelled += 1
+            else:
+                self.completed += 1
+        if watch.cancelled:
+            logger.info(f"Client disconnected, upstream stream closed ({watch.label})")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'active': len(self._selector.get_map()),
+                'completed': self.completed,
+                'client_cancelled': self.cancelled,
+            }
+
+    def _unregister(self, watch: Watch) -> None:
+        if watch.client is None:
+            return
+        with self._lock:
+            key = self._selector.get_map().get(watch.client)
+            if key is not None and key.data is watch:
+                self._selector.unregister(watch.client)
+        watch.client = None
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='client-disconnect-watcher', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            try:
+                events = self._selector.select(self.interval)
+            except OSError as e:
+                logger.warning(f"Client disconnect watcher select failed: {e}")
+                events = []
+            for key, _ in events:
+                self._check(key.data)
+            with self._lock:
+                if not self._selector.get_map():
+                    self._wake.clear()
+
+    def _check(self, watch: Watch) -> None:
+        client = watch.client
+        if client is None:
+            return
+        try:
+            data = client.recv(1, _PEEK_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        self._unregister(watch)
+        # 读到数据（客户端在同一连接上发送了新请求）时无法据此判断，停止监视
+        if not data:
+            watch.cancel()
+
+
+watcher = DisconnectWatcher()
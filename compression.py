@@ -0,0 +1,149 @@
+"""
+响应压缩（gzip / brotli）。
+
+- 非流式的 JSON / 文本响应：超过 COMPRESSION_MIN_BYTES 时按客户端 Accept-Encoding 压缩；
+- SSE 流：逐块压缩并在每块后 flush，事件不会被压缩器攒住；
+- 已带 Content-Encoding 的响应（例如原样透传的上游压缩体）不再处理。
+
+brotli 为可选依赖，未安装时只使用 gzip。
+
+环境变量：RESPONSE_COMPRESSION（默认 1）、COMPRESSION_MIN_BYTES（默认 1024）、SSE_COMPRESSION（默认 1）
+"""
+
+import gzip
+import logging
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - 可选依赖
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('RESPONSE_COMPRESSION', '1').lower() not in ('0', 'false', 'no')
+SSE_ENABLED = os.environ.get('SSE_COMPRESSION', '1').lower() not in ('0', 'false', 'no')
+MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = {
+    'application/json', 'text/html', 'text/plain', 'text/css',
+    'application/javascript', 'text/javascript',
+}
+
+
+def _accepted(header: str) -> dict:
+    """解析 Accept-Encoding，返回 {encoding: q}"""
+    result = {}
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[name] = q
+    return result
+
+
+def accepts(encoding: str) -> bool:
+    """当前请求的客户端是否接受某种 Content-Encoding"""
+    accepted = _accepted(request.headers.get('Accept-Encoding', ''))
+    q = accepted.get(encoding.lower(), accepted.get('*', 0.0))
+    return q > 0
+
+
+def choose_encoding() -> str | None:
+    accepted = _accepted(request.headers.get('Accept-Encoding', ''))
+    candidates = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = None
+    for name in candidates:
+        q = accepted.get(name, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (name, q)
+    return best[0] if best else None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+class _StreamEncoder:
+    """流式压缩：每个块压缩后立即 flush，保证 SSE 事件及时送达"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._c = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._c.process(data) + self._c.flush()
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self._c.finish()
+        return self._c.flush(zlib.Z_FINISH)
+
+
+def _compress_iter(iterable, encoding: str):
+    encoder = _StreamEncoder(encoding)
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield encoder.compress(chunk)
+        yield encoder.finish()
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+def compress_response(response):
+    if (not ENABLED or request.method == 'HEAD' or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers):
+        return response
+
+    if response.is_streamed:
+        if not SSE_ENABLED or response.mimetype != 'text/event-stream' or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding()
+        if encoding:
+            response.response = _compress_iter(response.response, encoding)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+        return response
+
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return response
+    encoding = choose_encoding()
+    if encoding:
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app) -> None:
+    app.after_request(compress_response)
@@ -0,0 +1,160 @@
+"""
+数据库连接配置（SQLite / PostgreSQL）与多副本协调。
+
+DATABASE_URI 为 postgres:// 或 postgresql://（未指定驱动）时使用 psycopg 3。
+PostgreSQL 使用连接池：DB_POOL_SIZE 个常驻连接，高峰时最多再借出 DB_MAX_OVERFLOW 个，
+取连接最多等待 DB_POOL_TIMEOUT 秒；借出前 ping 一次（数据库重启 / 负载均衡断开空闲连接后自动重连），
+超过 DB_POOL_RECYCLE 秒的连接重建。
+SQLite 默认使用 WAL 日志模式（读写互不阻塞，synchronous=NORMAL），SQLITE_JOURNAL_MODE 可改回 DELETE 等模式。
+
+多个网关副本共用一个 PostgreSQL 时，定时任务只在持有 advisory lock 的副本（leader）上执行，
+见 LeaderLock；token 刷新通过 services.claim_tokens 认领，同一 token 不会被多个副本同时刷新。
+
+环境变量：DB_POOL_SIZE（默认 10）、DB_MAX_OVERFLOW（默认 20）、DB_POOL_TIMEOUT（默认 10）、
+DB_POOL_RECYCLE（默认 1800）、DB_POOL_PRE_PING（默认 1）、SQLITE_JOURNAL_MODE（默认 WAL）
+"""
+
+import importlib.util
+import logging
+import os
+import sqlite3
+import threading
+
+from sqlalchemy import create_engine as sa_create_engine, event, text
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URI = 'sqlite:///zai2api.db'
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '20'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1').lower() not in ('0', 'false', 'no')
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL').upper()
+
+
+def normalize_uri(uri: str) -> str:
+    """postgres:// → postgresql://；未指定驱动且未安装 psycopg2 时使用 psycopg 3"""
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    if uri.startswith('postgresql://') and importlib.util.find_spec('psycopg2') is None \
+            and importlib.util.find_spec('psycopg') is not None:
+        uri = 'postgresql+psycopg://' + uri[len('postgresql://'):]
+    return uri
+
+
+def is_postgres(engine=None) -> bool:
+    engine = engine or db.engine
+    return engine.dialect.name == 'postgresql'
+
+
+def engine_options(uri: str) -> dict:
+    """create_engine 的参数（SQLALCHEMY_ENGINE_OPTIONS）"""
+    if uri.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': POOL_SIZE,
+        'max_overflow': MAX_OVERFLOW,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_pre_ping': POOL_PRE_PING,
+    }
+
+
+def _sqlite_pragmas(dbapi_conn, _record) -> None:
+    if not isinstance(dbapi_conn, sqlite3.Connection) or not SQLITE_JOURNAL_MODE:
+        return
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+        if SQLITE_JOURNAL_MODE == 'WAL':
+            # WAL 下 NORMAL 不会损坏数据库，只在断电时可能丢失最后几个事务
+            cursor.execute('PRAGMA synchronous=NORMAL')
+    finally:
+        cursor.close()
+
+
+def configure_engine(engine) -> None:
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _sqlite_pragmas)
+
+
+def create_engine(uri: str, **kw):
+    """与应用相同配置的独立 engine（压测 / 脚本使用）"""
+    uri = normalize_uri(uri)
+    engine = sa_create_engine(uri, **{**engine_options(uri), **kw})
+    configure_engine(engine)
+    return engine
+
+
+def init_app(app) -> None:
+    """设置连接串与连接池参数并初始化 Flask-SQLAlchemy（engine 在这里创建，不会连接数据库）"""
+    uri = normalize_uri(app.config.get('SQLALCHEMY_DATABASE_URI') or DEFAULT_URI)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(uri))
+    db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine)
+
+
+class LeaderLock:
+    """
+    基于 PostgreSQL 会话级 advisory lock 的 leader 选举。
+
+    held() 尝试获取锁，成功后一直占用一个连接持有它；持有锁的进程退出或连接断开时锁自动释放，
+    其他副本下一次调用 held() 时接任。非 PostgreSQL 数据库（单进程部署）总是返回 True。
+    """
+
+    def __init__(self, key: int, name: str):
+        self.key = key
+        self.name = name
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def held(self, engine=None) -> bool:
+        engine = engine or db.engine
+        if not is_postgres(engine):
+            return True
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.execute(text('SELECT 1'))
+                    return True
+                except Exception as e:
+                    logger.warning(f"Lost {self.name} leadership: {e}")
+                    self._close()
+            conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            try:
+                acquired = conn.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': self.key}).scalar()
+            except Exception:
+                conn.close()
+                raise
+            if not acquired:
+                conn.close()
+                return False
+            self._conn = conn
+            logger.info(f"Acquired {self.name} leadership")
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': self.key})
+                except Exception:
+                    pass
+                self._close()
+
+    def _close(self) -> None:
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+
+# 定时刷新 token 的 leader（键与 migrations 的迁移锁不同）
+scheduler_leader = LeaderLock(720_204_903, 'scheduler')
@@ -0,0 +1,182 @@
+"""
+管理面板实时事件（SSE）。
+
+进程内的事件环形缓冲区，每个事件带递增序号：
+  - token：某个 token 的字段变化（只含变化的列），新建时带 created，is_active 变化时带 was_active；
+  - token_removed：token 被删除；
+  - log：新的请求日志；
+  - resync：批量导入等无法逐行跟踪的变更，面板应重新加载列表。
+客户端断线重连时带上最后收到的序号（Last-Event-ID），从缓冲区补发；
+序号已被覆盖时收到 resync。
+
+Token 变化通过 SQLAlchemy session 事件收集：flush 时记录变化的列，commit 后统一发布，回滚则丢弃。
+"""
+
+import json
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# 缓冲区保留的事件数
+BUFFER_SIZE = 2000
+
+# 推送给面板的 token 字段（与列表接口的投影字段一致，不包含完整 token）
+TOKEN_FIELDS = ('email', 'is_active', 'at_expires', 'error_count', 'remark', 'discord_token', 'zai_token')
+
+_PENDING_KEY = 'live_feed_pending'
+
+
+class LiveFeed:
+    def __init__(self, maxlen: int = BUFFER_SIZE):
+        self._events: deque = deque(maxlen=maxlen)  # (seq, kind, data)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def publish(self, kind: str, data: dict) -> int:
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, kind, data))
+            self._cond.notify_all()
+            return self._seq
+
+    def since(self, seq: int) -> Tuple[List[tuple], bool]:
+        """返回序号大于 seq 的事件；第二项为 True 表示中间的事件已被覆盖"""
+        with self._cond:
+            if seq >= self._seq:
+                return [], False
+            events = [e for e in self._events if e[0] > seq]
+            gap = not events or events[0][0] != seq + 1
+            return events, gap
+
+    def wait(self, seq: int, timeout: float) -> None:
+        with self._cond:
+            if self._seq <= seq:
+                self._cond.wait(timeout)
+
+
+feed = LiveFeed()
+
+
+def publish(kind: str, data: dict) -> int:
+    return feed.publish(kind, data)
+
+
+def _iso(value):
+    return value.replace(microsecond=0).isoformat() if value else None
+
+
+def token_payload(token_id: int, values: Dict[str, object]) -> dict:
+    """把列值转换为面板使用的字段（st_preview / has_zai_token 代替完整 token）"""
+    out: Dict[str, object] = {'id': token_id}
+    for name, value in values.items():
+        if name == 'discord_token':
+            out['st_preview'] = value[:20] if value else None
+        elif name == 'zai_token':
+            out['has_zai_token'] = value is not None
+        elif name == 'at_expires':
+            out['at_expires'] = _iso(value)
+        else:
+            out[name] = value
+    return out
+
+
+def _collect(session: Session, flush_context) -> None:
+    from models import Token
+
+    pending: Dict[int, dict] = session.info.setdefault(_PENDING_KEY, {})
+    for obj in session.new:
+        if isinstance(obj, Token):
+            values = {name: getattr(obj, name) for name in TOKEN_FIELDS}
+            pending[obj.id] = {'kind': 'token', 'data': {**token_payload(obj.id, values), 'created': True}}
+    for obj in session.dirty:
+        if not isinstance(obj, Token):
+            continue
+        state = inspect(obj)
+        token_id = state.identity[0]
+        changed = {}
+        was_active = None
+        for name in TOKEN_FIELDS:
+            history = state.attrs[name].history
+            if history.has_changes():
+                changed[name] = getattr(obj, name)
+                if name == 'is_active' and history.deleted:
+                    was_active = history.deleted[0]
+        if not changed:
+            continue
+        entry = pending.setdefault(token_id, {'kind': 'token', 'data': {'id': token_id}})
+        entry['data'].update(token_payload(token_id, changed))
+        if was_active is not None:
+            entry['data'].setdefault('was_active', was_active)
+    for obj in session.deleted:
+        if isinstance(obj, Token):
+            state = inspect(obj)
+            was_active = state.attrs.is_active.history
+            active = was_active.deleted[0] if was_active.deleted else obj.is_active
+            pending[state.identity[0]] = {'kind': 'token_removed', 'data': {'id': state.identity[0], 'was_active': active}}
+
+
+def _publish_pending(session: Session) -> None:
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    for entry in pending.values():
+        if entry['kind'] == 'token':
+            was_active = entry['data'].get('was_active')
+            if was_active is not None and was_active == entry['data'].get('is_active'):
+                entry['data'].pop('was_active')
+        feed.publish(entry['kind'], entry['data'])
+
+
+def _discard_pending(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+_installed = False
+
+
+def install() -> None:
+    """注册 session 事件（只需调用一次）"""
+    global _installed
+    if _installed:
+        return
+    event.listen(Session, 'after_flush', _collect)
+    event.listen(Session, 'after_commit', _publish_pending)
+    event.listen(Session, 'after_rollback', _discard_pending)
+    _installed = True
+
+
+def _sse(kind: str, seq: Optional[int], data: dict) -> str:
+    event_id = f"id: {seq}\n" if seq is not None else ''
+    return f"event: {kind}\n{event_id}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream(last_seq: Optional[int], keepalive: float = 15):
+    """SSE 生成器：先补发 last_seq 之后的事件，再持续推送新事件"""
+    seq = feed.seq
+    yield _sse('hello', None, {'seq': seq})
+    if last_seq is not None:
+        if last_seq > seq:
+            # 服务已重启，序号重新计数
+            yield _sse('resync', seq, {})
+        else:
+            seq = last_seq
+    while True:
+        events, gap = feed.since(seq)
+        if gap:
+            seq = feed.seq
+            yield _sse('resync', seq, {})
+            continue
+        for event_seq, kind, data in events:
+            seq = event_seq
+            yield _sse(kind, event_seq, data)
+        if not events:
+            feed.wait(seq, keepalive)
+            if feed.seq <= seq:
+                yield ": keep-alive\n\n"
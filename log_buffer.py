@@ -0,0 +1,310 @@
+"""
+最近请求日志的内存环形缓冲区。
+
+代理请求只把日志追加到固定大小的环形缓冲区（元组，一次加锁），不在请求线程里写 SQLite；
+需要持久化时由后台线程每 FLUSH_INTERVAL 秒批量插入一次。
+/api/logs 优先从缓冲区取最近的日志，缓冲区覆盖不到的更早历史再查数据库。
+
+日志 id 由后台写线程按块预留（每次 ID_BLOCK 个，PostgreSQL 从 request_log 的序列取，SQLite 从 id_block 计数器取），
+请求线程只在追加日志的同一把锁内取用预留的 id，不访问数据库，缓冲区顺序与 id 顺序一致；
+id 与数据库中的一致，分页游标在两处通用；同一个库上的多个进程 / 副本预留到的 id 互不冲突。
+预留的 id 暂时用完时：单进程下本地递增（下一块从这之后预留），有其他进程写同一个库时由数据库分配。
+
+缓冲区只包含本进程的日志。PostgreSQL（多副本）上，或预留到的块与上一块不连续（说明还有其他进程在写同一个库，
+例如 gunicorn 多 worker）时，/api/logs 改为始终查询数据库，列表版本号额外按 SHARED_VERSION_TTL 秒分桶
+（其他进程的新日志最多滞后这么久才使 304 失效）。
+
+批量写入遇到约束冲突时逐条重写并丢弃冲突的记录，不会让整批日志一直重试。
+
+环境变量：REQUEST_LOG_BUFFER（缓冲区条数，默认 5000）、REQUEST_LOG_PERSIST（默认 1，0 为只保存在内存）
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import insert, text, update
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import IdBlock, RequestLog
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('id', 'operation', 'token_email', 'discord_token', 'zai_token', 'status_code', 'duration', 'created_at')
+FLUSH_INTERVAL = 1.0
+# 单次批量插入的最大条数
+FLUSH_BATCH = 500
+# 每次预留的 id 数（剩余不足一半时后台写线程预留下一块）
+ID_BLOCK = 1000
+SHARED_VERSION_TTL = 5
+
+
+class LogBuffer:
+    def __init__(self, size: int = 5000, persist: bool = True):
+        self.size = max(1, size)
+        self.persist = persist
+        self._ring: List[Optional[tuple]] = [None] * self.size
+        self._count = 0
+        self._last_id = 0
+        # 缓冲区包含全部历史（数据库中的日志少于缓冲区大小且尚未覆盖）
+        self._complete = True
+        self._lock = threading.Lock()
+        self._seeded = False
+        # 有其他进程 / 副本写同一个库：查询走数据库
+        self._shared = False
+        self._ids: List[int] = []
+        self._block_end: Optional[int] = None
+        self._pending: List[tuple] = []
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        # 预留的 id 剩余不足一半：写线程立即预留下一块，不等合并窗口结束
+        self._ids_low = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+        self._app = None
+
+    def init_app(self, app) -> None:
+        self._app = app
+        atexit.register(self.flush)
+
+    def _ensure_seeded(self) -> None:
+        """首次使用时从数据库载入最近的日志（需要 app context）"""
+        if self._seeded:
+            return
+        shared = db.engine.dialect.name == 'postgresql'
+        rows, max_id = [], 0
+        if not shared:
+            rows = db.session.execute(
+                db.select(*(getattr(RequestLog, f) for f in FIELDS)).order_by(RequestLog.id.desc()).limit(self.size)
+            ).all()
+            max_id = db.session.scalar(db.select(db.func.max(RequestLog.id))) or 0
+        with self._lock:
+            if self._seeded:
+                return
+            self._shared = shared
+            for row in reversed(rows):
+                self._ring[self._count % self.size] = tuple(row)
+                self._count += 1
+            self._last_id = max(self._last_id, max_id)
+            self._complete = not shared and len(rows) < self.size
+            self._seeded = True
+        if self.persist:
+            # 第一块 id 在首次使用时预留（每个进程一次），之后由后台写线程提前预留
+            try:
+                self._refill_ids()
+            except Exception as e:
+                logger.error(f"Failed to reserve request log ids: {e}")
+
+    def _refill_ids(self) -> None:
+        """
+        后台写线程中预留下一块 id（请求线程从不为分配 id 访问数据库）。
+        SQLite 计数器至少推进到本进程已用过的最大 id 之后；预留到的块与预期位置不连续说明还有其他进程在写同一个库。
+        """
+        with self._lock:
+            if len(self._ids) >= ID_BLOCK // 2:
+                return
+            floor = self._last_id + 1
+        ids = self._allocate_ids(ID_BLOCK, floor)
+        with self._lock:
+            expected = floor if self._block_end is None else max(self._block_end + 1, floor)
+            if self._block_end is not None and ids[0] != expected and not self._shared:
+                logger.info("Another process is writing request logs, serving /api/logs from the database")
+                self._shared = True
+                self._complete = False
+            self._block_end = ids[-1]
+            # 预留期间请求线程可能已经用掉了块开头的 id（本地分配），跳过这些
+            fresh = [i for i in ids if i > self._last_id]
+            self._ids = list(reversed(fresh)) + self._ids
+
+    def _allocate_ids(self, n: int, floor: int) -> List[int]:
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.connect() as conn:
+                return conn.execute(text(
+                    "SELECT nextval(pg_get_serial_sequence('request_log', 'id')) FROM generate_series(1, :n)"
+                ), {'n': n}).scalars().all()
+        for attempt in range(3):
+            try:
+                with db.engine.begin() as conn:
+                    end = conn.execute(
+                        update(IdBlock).where(IdBlock.name == 'request_log')
+                        .values(next_id=db.func.max(IdBlock.next_id, floor) + n).returning(IdBlock.next_id)
+                    ).scalar()
+                    if end is None:
+                        # 第一次预留：从当前最大 id 之后开始
+                        end = max((conn.execute(db.select(db.func.max(RequestLog.id))).scalar() or 0) + 1, floor) + n
+                        conn.execute(insert(IdBlock).values(name='request_log', next_id=end))
+                return list(range(end - n, end))
+            except IntegrityError:
+                # 另一个进程同时创建了计数器行
+                if attempt == 2:
+                    raise
+
+    def _next_id(self) -> Optional[int]:
+        """在 self._lock 内调用：与写入环形缓冲区在同一个临界区，缓冲区顺序与 id 顺序一致"""
+        if self.persist and self._ids:
+            record_id = self._ids.pop()
+            if len(self._ids) < ID_BLOCK // 2:
+                self._ids_low.set()
+        elif self.persist and self._shared:
+            # 预留的 id 用完且有其他进程在写：由数据库分配（此时 /api/logs 不读缓冲区）
+            self._ids_low.set()
+            return None
+        else:
+            if self.persist:
+                self._ids_low.set()
+            # 只保存在内存，或单进程下预留的 id 暂时用完：本地递增，下一次预留从这之后开始
+            record_id = self._last_id + 1
+        self._last_id = max(self._last_id, record_id)
+        return record_id
+
+    def append(self, operation: str, token_email, discord_token, zai_token,
+               status_code: int, duration: float) -> tuple:
+        self._ensure_seeded()
+        with self._lock:
+            record = (self._next_id(), operation, token_email, discord_token, zai_token,
+                      status_code, duration, datetime.now())
+            self._ring[self._count % self.size] = record
+            self._count += 1
+            if self._count > self.size:
+                self._complete = False
+            if self.persist:
+                self._pending.append(record)
+        if self.persist:
+            self._start_writer()
+            self._wake.set()
+        return record
+
+    def version(self) -> str:
+        self._ensure_seeded()
+        if self._shared:
+            return f"{self._last_id}:{self._count}:{int(time.time() // SHARED_VERSION_TTL)}"
+        return f"{self._last_id}:{self._count}"
+
+    def query(self, limit: int, before_id: Optional[int] = None,
+              predicate: Optional[Callable[[tuple], bool]] = None) -> Optional[Tuple[List[tuple], bool]]:
+        """
+        按 id 倒序从缓冲区取最多 limit 条，返回 (records, has_more)；
+        缓冲区不足以确定这一页时返回 None（应查询数据库）。
+        """
+        self._ensure_seeded()
+        if self._shared:
+            return None
+        found = []
+        with self._lock:
+            for i in range(self._count - 1, max(-1, self._count - self.size - 1), -1):
+                record = self._ring[i % self.size]
+                if before_id is not None and record[0] >= before_id:
+                    continue
+                if predicate is None or predicate(record):
+                    found.append(record)
+                    if len(found) > limit:
+                        return found[:limit], True
+            complete = self._complete
+        return (found, False) if complete else None
+
+    def _start_writer(self) -> None:
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._flush_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._run, name='request-log-writer', daemon=True)
+                self._writer.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self._refill_in_context()
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to persist request logs: {e}")
+                self._wake.set()
+            # 合并 FLUSH_INTERVAL 内的日志为一次写入；期间 id 不足时立即预留
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while (left := deadline - time.monotonic()) > 0:
+                if self._ids_low.wait(left):
+                    try:
+                        self._refill_in_context()
+                    except Exception as e:
+                        logger.error(f"Failed to reserve request log ids: {e}")
+                        time.sleep(left)
+
+    def _refill_in_context(self) -> None:
+        self._ids_low.clear()
+        if self._app is not None:
+            with self._app.app_context():
+                self._refill_ids()
+
+    def flush(self) -> None:
+        """把待持久化的日志批量写入数据库"""
+        if self._app is None:
+            return
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            with self._app.app_context():
+                try:
+                    for i in range(0, len(pending), FLUSH_BATCH):
+                        batch = pending[i:i + FLUSH_BATCH]
+                        # executemany 要求每行的列相同：由数据库分配 id 的记录单独插入
+                        for rows in ([_row(r) for r in batch if r[0] is not None],
+                                     [_row(r) for r in batch if r[0] is None]):
+                            if rows:
+                                db.session.execute(insert(RequestLog), rows)
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    self._insert_each(pending)
+                except Exception:
+                    db.session.rollback()
+                    with self._lock:
+                        # 下次重试；数据库长时间不可写时只保留最近 size 条
+                        self._pending[:0] = pending
+                        del self._pending[:-self.size]
+                    raise
+                finally:
+                    db.session.remove()
+
+    def _insert_each(self, records: List[tuple]) -> None:
+        """逐条写入，跳过违反约束（id 重复）的记录；需要 app context"""
+        dropped = 0
+        for i, record in enumerate(records):
+            try:
+                db.session.execute(insert(RequestLog), [_row(record)])
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                dropped += 1
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._pending[:0] = records[i:]
+                    del self._pending[:-self.size]
+                raise
+        if dropped:
+            logger.warning(f"Dropped {dropped} request logs that violated a constraint (duplicate id)")
+
+
+def _row(record: tuple) -> dict:
+    values = dict(zip(FIELDS, record))
+    if values['id'] is None:
+        del values['id']
+    return values
+
+
+def as_dict(record: tuple, fields=FIELDS) -> dict:
+    values = dict(zip(FIELDS, record))
+    return {f: values[f] for f in fields}
+
+
+buffer = LogBuffer(
+    size=int(os.environ.get('REQUEST_LOG_BUFFER', '5000')),
+    persist=os.environ.get('REQUEST_LOG_PERSIST', '1').lower() not in ('0', 'false', 'no'),
+)
@@ -0,0 +1,150 @@
+"""
+结构化日志：JSON 行格式 + 队列异步输出 + 登录关联 ID / 步骤耗时。
+
+业务代码只需 logging.getLogger(__name__)；附加字段通过 extra={'fields': {...}} 传入。
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+# 当前登录流程的关联 ID（线程 / asyncio task 各自独立）
+correlation_id: contextvars.ContextVar[str | None] = contextvars.ContextVar('correlation_id', default=None)
+
+_listener: logging.handlers.QueueListener | None = None
+_atexit_registered = False
+
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'fields'}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行 JSON。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        cid = getattr(record, 'correlation_id', None)
+        if cid:
+            entry['correlation_id'] = cid
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and key not in entry and key != 'correlation_id':
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _CorrelationFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'correlation_id'):
+            record.correlation_id = correlation_id.get()
+        return True
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """在入队前（调用方线程内）捕获 contextvar，输出线程里再格式化。"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not hasattr(record, 'correlation_id'):
+            record.correlation_id = correlation_id.get()
+        # 不在调用方线程里格式化，只合并 args，保留 fields 供 JSON 输出
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure_logging(level: str | None = None, fmt: str | None = None) -> None:
+    """
+    配置根 logger：日志先进入内存队列，由后台线程写 stdout，避免请求线程阻塞在 I/O 上。
+    LOG_LEVEL 默认 INFO（登录步骤的 DEBUG 日志默认关闭），LOG_FORMAT 可选 json / text。
+    """
+    global _listener, _atexit_registered
+    level = (level or os.environ.get('LOG_LEVEL', 'INFO')).upper()
+    fmt = (fmt or os.environ.get('LOG_FORMAT', 'json')).lower()
+
+    _stop_listener()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if fmt == 'text':
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    else:
+        stream_handler.setFormatter(JsonFormatter())
+    stream_handler.addFilter(_CorrelationFilter())
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_ContextQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    if not _atexit_registered:
+        atexit.register(_stop_listener)
+        _atexit_registered = True
+
+
+def _stop_listener() -> None:
+    """停止当前的输出线程并写完队列中剩余的日志（重复调用安全）"""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+@contextmanager
+def login_context(cid: str | None = None):
+    """为一次登录流程设置关联 ID，流程内的所有日志都会带上它。"""
+    token = correlation_id.set(cid or uuid.uuid4().hex[:12])
+    try:
+        yield correlation_id.get()
+    finally:
+        correlation_id.reset(token)
+
+
+class StepTimer:
+    """记录每个步骤的耗时（毫秒），同时以 DEBUG 级别输出。"""
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.timings: dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def step(self, name: str, **fields):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = round((time.perf_counter() - t0) * 1000, 1)
+            self.timings[name] = elapsed
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"step {name} done", extra={'fields': {'step': name, 'elapsed_ms': elapsed, **fields}})
+
+    @property
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self._start) * 1000, 1)
+
+
+def mask(value: str | None, head: int = 6, tail: int = 4) -> str | None:
+    if not value:
+        return value
+    if len(value) <= head + tail:
+        return '***'
+    return f"{value[:head]}...{value[-tail:]}"
@@ -0,0 +1,264 @@
+"""
+版本化的数据库迁移（SQLite / PostgreSQL）。
+
+MIGRATIONS 按版本号顺序登记；schema_version 表记录已应用的版本，每个版本只执行一次。
+启动时只查询一次 schema_version 的最大版本：已是最新版本时不做任何 PRAGMA / 反射检查。
+
+全新的数据库直接按当前模型建表，并把所有版本记为已应用。
+
+编写迁移的约定（迁移需要可重复执行，中途失败后重启会从该版本重新开始）：
+  - 加列用 ctx.add_column：先加可空、无默认值的列（任何数据库上都不重写表），
+    需要填充时再用 ctx.backfill 分批 UPDATE，每批单独提交，不长时间锁住热表；
+  - 建索引用 ctx.create_index：PostgreSQL 上为 CREATE INDEX CONCURRENTLY（不阻塞写入），
+    上次中断留下的无效索引会先删除再重建。
+
+多个进程同时启动时，PostgreSQL 上用 advisory lock 保证只有一个进程执行迁移。
+"""
+
+import logging
+import time
+from datetime import datetime
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 1000
+# 两批之间的间隔，给在线请求让出写锁
+BACKFILL_PAUSE = 0.01
+
+# pg_advisory_lock 的键（任意固定值）
+_PG_LOCK_KEY = 720_204_902
+
+_meta = MetaData()
+schema_version = Table(
+    'schema_version', _meta,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200)),
+    Column('applied_at', DateTime),
+)
+
+
+class Context:
+    """迁移里使用的操作（每个操作自行提交）"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+
+    @property
+    def postgres(self) -> bool:
+        return self.dialect == 'postgresql'
+
+    def execute(self, sql: str, **params):
+        with self.engine.begin() as conn:
+            return conn.execute(text(sql), params)
+
+    def has_table(self, table: str) -> bool:
+        return inspect(self.engine).has_table(table)
+
+    def columns(self, table: str) -> set:
+        return {c['name'] for c in inspect(self.engine).get_columns(table)}
+
+    def add_column(self, table: str, column: str, ddl_type: str, backfill=None) -> None:
+        """加可空列；backfill 不为 None 时分批把已有行的该列填为该值"""
+        if column in self.columns(table):
+            return
+        self.execute(f'ALTER TABLE {table} ADD COLUMN {column} {ddl_type}')
+        if backfill is not None:
+            self.backfill(table, f'{column} = :value', f'{column} IS NULL', value=backfill)
+
+    def backfill(self, table: str, set_sql: str, where_sql: str, batch: int = BACKFILL_BATCH, **params) -> int:
+        """按主键分批 UPDATE table SET set_sql WHERE where_sql，每批单独提交；返回更新的行数"""
+        total = 0
+        while True:
+            with self.engine.begin() as conn:
+                ids = conn.execute(text(
+                    f'SELECT id FROM {table} WHERE {where_sql} ORDER BY id LIMIT :batch'
+                ), {**params, 'batch': batch}).scalars().all()
+                if not ids:
+                    return total
+                conn.execute(text(
+                    f'UPDATE {table} SET {set_sql} WHERE id >= :lo AND id <= :hi AND ({where_sql})'
+                ), {**params, 'lo': ids[0], 'hi': ids[-1]})
+            total += len(ids)
+            if len(ids) < batch:
+                return total
+            time.sleep(BACKFILL_PAUSE)
+
+    def create_index(self, name: str, table: str, columns: Iterable[str], unique: bool = False) -> None:
+        cols = ', '.join(columns)
+        kind = 'UNIQUE INDEX' if unique else 'INDEX'
+        if not self.postgres:
+            self.execute(f'CREATE {kind} IF NOT EXISTS {name} ON {table} ({cols})')
+            return
+        # CONCURRENTLY 不能在事务中执行
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            valid = conn.execute(text(
+                'SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = :name'
+            ), {'name': name}).scalar()
+            if valid:
+                return
+            if valid is False:
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+            conn.execute(text(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table} ({cols})'))
+
+    def create_tables(self, tables=None) -> None:
+        """按当前模型建表（已存在的表跳过）"""
+        db.metadata.create_all(self.engine, tables=tables, checkfirst=True)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Context], None]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str):
+    def register(fn):
+        assert not MIGRATIONS or version > MIGRATIONS[-1].version, 'migration versions must increase'
+        MIGRATIONS.append(Migration(version, description, fn))
+        return fn
+    return register
+
+
+# --- Migrations ---
+
+@migration(1, 'baseline tables')
+def _baseline(ctx: Context) -> None:
+    ctx.create_tables()
+
+
+@migration(2, 'system_config: retry count, refresh interval, stream conversion')
+def _system_config_columns(ctx: Context) -> None:
+    ctx.add_column('system_config', 'error_retry_count', 'INTEGER', backfill=3)
+    ctx.add_column('system_config', 'token_refresh_interval', 'INTEGER', backfill=3600)
+    ctx.add_column('system_config', 'stream_conversion_enabled', 'BOOLEAN', backfill=False)
+
+
+@migration(3, 'request_log: masked token columns')
+def _request_log_columns(ctx: Context) -> None:
+    ctx.add_column('request_log', 'discord_token', 'TEXT')
+    ctx.add_column('request_log', 'zai_token', 'TEXT')
+
+
+@migration(4, 'token: listing filter / sort indexes')
+def _token_indexes(ctx: Context) -> None:
+    ctx.create_index('ix_token_at_expires', 'token', ['at_expires'])
+    ctx.create_index('ix_token_is_active', 'token', ['is_active'])
+
+
+@migration(5, 'token refresh lease; request_log id sequence; PostgreSQL column widths')
+def _multi_node(ctx: Context) -> None:
+    ctx.add_column('token', 'refresh_lease_until', 'TIMESTAMP')
+    if ctx.postgres:
+        # SQLite 不检查 VARCHAR 长度；PostgreSQL 上 scrypt 密码哈希与较长的刷新错误信息会超长。
+        # 加长 VARCHAR / 改为 TEXT 只改元数据，不重写表
+        ctx.execute('ALTER TABLE system_config ALTER COLUMN admin_password_hash TYPE VARCHAR(256)')
+        ctx.execute('ALTER TABLE token ALTER COLUMN remark TYPE TEXT')
+        # 日志 id 改为从序列按块预留（见 log_buffer.py）；之前由进程显式分配的 id 没有推进序列
+        ctx.execute(
+            "SELECT setval(pg_get_serial_sequence('request_log', 'id'), "
+            "GREATEST((SELECT MAX(id) FROM request_log), 1))"
+        )
+
+
+@migration(6, 'id_block: request_log id reservation for multi-process SQLite')
+def _id_block(ctx: Context) -> None:
+    # 计数器行在第一次预留时按 request_log 当前最大 id 创建
+    ctx.create_tables([db.metadata.tables['id_block']])
+
+
+LATEST = MIGRATIONS[-1].version
+
+
+# --- Runner ---
+
+def current_version(engine) -> Optional[int]:
+    """已应用的最大版本；没有 schema_version 表时返回 None"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select(db.func.max(schema_version.c.version))).scalar()
+    except Exception:
+        return None
+
+
+def _record(engine, migrations: Iterable[Migration]) -> None:
+    rows = [{'version': m.version, 'description': m.description[:200], 'applied_at': datetime.now()}
+            for m in migrations]
+    if rows:
+        with engine.begin() as conn:
+            conn.execute(schema_version.insert(), rows)
+
+
+def _run(engine) -> List[int]:
+    ctx = Context(engine)
+    _meta.create_all(engine, checkfirst=True)
+    applied = set(_applied_versions(engine))
+    pending = [m for m in MIGRATIONS if m.version not in applied]
+    if not pending:
+        return []
+    if not applied and not any(ctx.has_table(name) for name in db.metadata.tables):
+        # 全新数据库：按当前模型建表即为最新结构
+        ctx.create_tables()
+        _record(engine, pending)
+        logger.info(f"Created schema at version {LATEST}")
+        return [m.version for m in pending]
+    done = []
+    for m in pending:
+        started = time.perf_counter()
+        logger.info(f"Applying migration {m.version}: {m.description}")
+        m.apply(ctx)
+        _record(engine, [m])
+        done.append(m.version)
+        logger.info(f"Migration {m.version} done in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return done
+
+
+def _applied_versions(engine) -> List[int]:
+    with engine.connect() as conn:
+        return conn.execute(select(schema_version.c.version)).scalars().all()
+
+
+def migrate(engine=None) -> List[int]:
+    """把数据库升级到最新版本（需要 app context），返回本次应用的版本"""
+    engine = engine or db.engine
+    if current_version(engine) == LATEST:
+        return []
+    if engine.dialect.name != 'postgresql':
+        return _run(engine)
+    # 多个副本同时启动时只有一个执行迁移，其余等待后发现已是最新版本
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as lock_conn:
+        lock_conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': _PG_LOCK_KEY})
+        try:
+            return _run(engine)
+        finally:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': _PG_LOCK_KEY})
+
+
+def status(engine=None) -> dict:
+    engine = engine or db.engine
+    try:
+        applied = set(_applied_versions(engine))
+    except Exception:
+        applied = set()
+    return {
+        'latest': LATEST,
+        'current': max(applied) if applied else None,
+        'pending': [m.version for m in MIGRATIONS if m.version not in applied],
+    }
+
+
+if __name__ == '__main__':
+    # python migrations.py：只执行迁移（例如在滚动升级前单独运行）
+    import json
+    from app import app
+
+    with app.app_context():
+        print(json.dumps({'applied': migrate(), **status()}))
@@ -4,7 +4,7 @@ from datetime import datetime
 class SystemConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     admin_username = db.Column(db.String(64), default='admin')
-    admin_password_hash = db.Column(db.String(128))  # Store hash
+    admin_password_hash = db.Column(db.String(256))  # Store hash (scrypt hashes are ~160 chars)
     api_key = db.Column(db.String(128), default='sk-default-key')
     error_ban_threshold = db.Column(db.Integer, default=3)
     error_retry_count = db.Column(db.Integer, default=3) # New field
@@ -31,10 +31,10 @@ class Token(db.Model):
     email = db.Column(db.String(120), nullable=True) # Got from Zai
     discord_token = db.Column(db.String(512), nullable=False) # ST
     zai_token = db.Column(db.Text, nullable=True) # AT (JWT)
-    at_expires = db.Column(db.DateTime, nullable=True)
+    at_expires = db.Column(db.DateTime, nullable=True, index=True)
     
-    is_active = db.Column(db.Boolean, default=True)
-    remark = db.Column(db.String(256), nullable=True)
+    is_active = db.Column(db.Boolean, default=True, index=True)
+    remark = db.Column(db.Text, nullable=True)
     
     # Capabilities & Limits
     image_enabled = db.Column(db.Boolean, default=True)
@@ -55,6 +55,9 @@ class Token(db.Model):
     sora2_remaining_count = db.Column(db.Integer, default=0)
     sora2_invite_code = db.Column(db.String(64), nullable=True)
     
+    # 刷新认领租约：到期前其他进程 / 副本不会再刷新该 token（见 services.claim_tokens）
+    refresh_lease_until = db.Column(db.DateTime, nullable=True)
+
     # Stats
     error_count = db.Column(db.Integer, default=0)
     image_count = db.Column(db.Integer, default=0)
@@ -72,3 +75,9 @@ class RequestLog(db.Model):
     status_code = db.Column(db.Integer)
     duration = db.Column(db.Float)
     created_at = db.Column(db.DateTime, default=datetime.now)
+
+class IdBlock(db.Model):
+    """按块预留 id 的计数器：多个进程写同一个 SQLite 库时 request_log 的 id 不冲突（见 log_buffer.py）"""
+    __tablename__ = 'id_block'
+    name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
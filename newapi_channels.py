@@ -0,0 +1,181 @@
+"""
+NewAPI 渠道接口与 token 分片（网关的 newapi_push.py 与轻量化版本 自动刷新token推送到newapi/zai_token.py 共用）。
+
+只依赖 requests，不依赖 Flask / 数据库。
+
+NewAPI 的 PUT /api/channel/ 没有版本号或前置条件检查，提交的是完整渠道文档：
+修改 key 前总是重新 GET 渠道，基于最新文档计算后立即 PUT，不会用旧文档覆盖管理后台或其他推送方的修改
+（GET 与 PUT 之间一个往返内的并发修改仍可能被覆盖）。PUT 失败时重新 GET 再重试。
+"""
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+def split_keys(key_str: Optional[str]) -> List[str]:
+    return [k.strip() for k in (key_str or "").split("\n") if k.strip()]
+
+
+class NewAPIClient:
+    """NewAPI 渠道接口（/api/channel/），各渠道共享一个连接池"""
+
+    def __init__(self, base_url: str, api_key: str, user_id: str = "1",
+                 pool_size: int = 8, max_retries: int = 2, timeout: float = 30):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.user_id = str(user_id)
+        self.pool_size = max(1, pool_size)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "New-Api-User": self.user_id,
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        })
+
+    def get_channel(self, channel_id: str) -> Optional[Dict[str, Any]]:
+        """GET /api/channel/{id}"""
+        try:
+            resp = self.session.get(f"{self.base_url}/api/channel/{channel_id}", timeout=self.timeout)
+            if resp.status_code != 200:
+                logger.warning(f"NewAPI get channel {channel_id} failed: HTTP {resp.status_code} {resp.text[:200]}")
+                return None
+            data = resp.json()
+            channel = data.get("data") if isinstance(data, dict) and "data" in data else data
+        except Exception as e:
+            logger.warning(f"NewAPI get channel {channel_id} failed: {e}")
+            return None
+        return channel if isinstance(channel, dict) else None
+
+    def update_channel(self, channel_id: str, channel: Dict[str, Any]) -> bool:
+        """PUT /api/channel/（完整渠道文档）"""
+        try:
+            resp = self.session.put(f"{self.base_url}/api/channel/", json=channel, timeout=self.timeout)
+        except Exception as e:
+            logger.warning(f"NewAPI update channel {channel_id} failed: {e}")
+            return False
+        if resp.status_code not in (200, 201):
+            logger.warning(f"NewAPI update channel {channel_id} failed: HTTP {resp.status_code} {resp.text[:200]}")
+            return False
+        return True
+
+    def modify_keys(self, channel_id: str, build: Callable[[List[str]], Optional[List[str]]]) -> Optional[bool]:
+        """
+        获取渠道最新文档，build(当前 key 列表) 返回新 key 列表后 PUT；build 返回 None 表示无需修改。
+        返回 True=已更新，None=无变化，False=失败
+        """
+        for _ in range(self.max_retries + 1):
+            channel = self.get_channel(channel_id)
+            if not channel:
+                return False
+            new_keys = build(split_keys(channel.get("key")))
+            if new_keys is None:
+                return None
+            channel["key"] = "\n".join(new_keys)
+            if self.update_channel(channel_id, channel):
+                return True
+        return False
+
+    def sync_keys(self, channel_id: str, tokens: List[str]) -> Optional[bool]:
+        """
+        把渠道 key 同步为 tokens（保留已有 key 的顺序，新 key 追加），key 集合不变时不发送 PUT。
+        返回 True=已更新，None=无变化，False=失败
+        """
+        wanted = set(tokens)
+        summary: Dict[str, int] = {}
+
+        def build(old_keys: List[str]) -> Optional[List[str]]:
+            if set(old_keys) == wanted:
+                return None
+            kept = [k for k in old_keys if k in wanted]
+            kept_set = set(kept)
+            added = [t for t in dict.fromkeys(tokens) if t not in kept_set]
+            summary.update(kept=len(kept), added=len(added), removed=len(old_keys) - len(kept))
+            return kept + added
+
+        result = self.modify_keys(channel_id, build)
+        if result:
+            logger.info(f"NewAPI channel {channel_id} synced", extra={'fields': summary})
+        return result
+
+    def sync_channels(self, assignments: Dict[str, List[str]]) -> Dict[str, Optional[bool]]:
+        """并发同步多个渠道，assignments 为 {channel_id: tokens}"""
+        if not assignments:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.pool_size, len(assignments))) as pool:
+            futures = {cid: pool.submit(self.sync_keys, cid, tokens) for cid, tokens in assignments.items()}
+            return {cid: fut.result() for cid, fut in futures.items()}
+
+
+def parse_channels(raw) -> List[Dict[str, Any]]:
+    """解析渠道配置：逗号分隔字符串、JSON 字符串或列表（元素为 ID 或 {"id", "tier", "max_keys"}）"""
+    if isinstance(raw, str):
+        raw = raw.strip()
+        if not raw:
+            return []
+        raw = json.loads(raw) if raw.startswith('[') else raw.split(',')
+    channels = []
+    for item in raw or []:
+        if isinstance(item, dict):
+            if item.get("id") is not None:
+                channels.append({"id": str(item["id"]), "tier": item.get("tier"), "max_keys": item.get("max_keys")})
+        elif item is not None and str(item).strip():
+            channels.append({"id": str(item).strip(), "tier": None, "max_keys": None})
+    return channels
+
+
+def _fill_channels(channels: List[Dict[str, Any]], tokens: List[str], assignments: Dict[str, List[str]]) -> List[str]:
+    """配置了 max_keys 的渠道按顺序填满，其余渠道平分剩余 token；返回放不下的 token"""
+    remaining = list(tokens)
+    for channel in channels:
+        if channel.get("max_keys"):
+            limit = int(channel["max_keys"])
+            assignments[channel["id"]].extend(remaining[:limit])
+            remaining = remaining[limit:]
+    unlimited = [c for c in channels if not c.get("max_keys")]
+    if not unlimited:
+        return remaining
+    size = -(-len(remaining) // len(unlimited))
+    for idx, channel in enumerate(unlimited):
+        assignments[channel["id"]].extend(remaining[idx * size:(idx + 1) * size])
+    return []
+
+
+def shard_tokens(items: List[tuple], channels: List[Dict[str, Any]], strategy: str = "count") -> Dict[str, List[str]]:
+    """
+    把 (zai_token, tier) 分配到渠道。count：按数量分片；
+    tier：分到相同 tier 的渠道，没有匹配渠道或已满时进入未设置 tier 的渠道
+    （没有这类渠道时平分到未设置 max_keys 的渠道）。
+    """
+    assignments: Dict[str, List[str]] = {c["id"]: [] for c in channels}
+    unlimited = [c for c in channels if not c.get("max_keys")]
+    if strategy != "tier":
+        overflow = _fill_channels(channels, [t for t, _ in items], assignments)
+    else:
+        groups: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        for channel in channels:
+            groups.setdefault(channel.get("tier"), []).append(channel)
+        buckets: Dict[Optional[str], List[str]] = {}
+        for token, tier in items:
+            buckets.setdefault(tier if tier in groups else None, []).append(token)
+        overflow = []
+        for tier, tokens in buckets.items():
+            if tier is not None:
+                overflow.extend(_fill_channels(groups[tier], tokens, assignments))
+        fallback = buckets.get(None, []) + overflow
+        overflow = _fill_channels(groups.get(None) or unlimited, fallback, assignments) if fallback else []
+    if overflow:
+        logger.warning(f"NewAPI channels full, {len(overflow)} tokens not assigned")
+    return assignments
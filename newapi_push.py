@@ -0,0 +1,144 @@
+"""
+把网关 token 池中的 zAI token 推送到 NewAPI 渠道（可选）
+
+由 token 刷新完成事件触发：同一推送窗口内的刷新合并为一次渠道同步，
+只有渠道 key 集合发生变化时才发送 PUT。另有定时对账，移除已过期 / 被禁用的 token。
+多副本共用 PostgreSQL 时只有 scheduler leader 自动推送（见 database.LeaderLock），
+其它副本的刷新由 leader 下一次对账同步。渠道接口与分片逻辑见 newapi_channels.py。
+
+环境变量：
+  NEWAPI_BASE            NewAPI 地址（未设置则不启用）
+  NEWAPI_KEY             NewAPI 管理密钥
+  NEWAPI_USER_ID         New-Api-User，默认 1
+  NEWAPI_CHANNELS        渠道列表：逗号分隔的 ID，或 JSON 数组（元素为 ID 或 {"id", "tier", "max_keys"}）
+  NEWAPI_SHARD_STRATEGY  count（默认）/ tier（按 Token.user_paygate_tier 分配）
+  NEWAPI_PUSH_WINDOW     推送合并窗口（秒），默认 30
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from newapi_channels import NewAPIClient, parse_channels, shard_tokens
+
+logger = logging.getLogger(__name__)
+
+# 无刷新事件时的对账间隔（秒），用于移除过期 / 被禁用 token
+RECONCILE_INTERVAL = 300
+
+
+class NewAPIPublisher:
+    """
+    后台线程：收到刷新事件后等待 push_window 秒合并，再把当前有效 token 分片同步到各渠道。
+    load_tokens 返回 [(zai_token, tier)]，在后台线程中调用。
+    should_publish 返回 False 时跳过自动推送（多副本时只有 scheduler leader 推送），手动 push_now 不受影响。
+    """
+
+    def __init__(self, client: NewAPIClient, channels: List[Dict[str, Any]],
+                 load_tokens: Callable[[], List[tuple]], strategy: str = "count",
+                 push_window: float = 30, reconcile_interval: float = RECONCILE_INTERVAL,
+                 should_publish: Optional[Callable[[], bool]] = None):
+        self.client = client
+        self.channels = channels
+        self.load_tokens = load_tokens
+        self.strategy = strategy
+        self.push_window = push_window
+        self.reconcile_interval = reconcile_interval
+        self.should_publish = should_publish
+        self._event = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_push: Dict[str, Any] = {}
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._event.set()  # 启动后先对齐一次渠道
+        self._thread = threading.Thread(target=self._run, name='newapi-push', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._event.set()
+
+    def notify(self) -> None:
+        """token 刷新完成后调用"""
+        self._event.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            triggered = self._event.wait(self.reconcile_interval)
+            if self._stop.is_set():
+                return
+            if triggered and self.push_window:
+                # 合并窗口内的其它刷新事件
+                self._stop.wait(self.push_window)
+            self._event.clear()
+            if self.should_publish is not None and not self.should_publish():
+                logger.debug("Skipping NewAPI push: not the scheduler leader")
+                continue
+            try:
+                self.push_now()
+            except Exception as e:
+                logger.error(f"NewAPI push failed: {e}")
+
+    def push_now(self) -> Dict[str, Optional[bool]]:
+        items = self.load_tokens()
+        if not items:
+            # 与轻量化版本一致：没有有效 token 时不清空渠道
+            logger.warning("NewAPI push skipped: no valid tokens")
+            return {}
+        assignments = shard_tokens(items, self.channels, self.strategy)
+        results = self.client.sync_channels(assignments)
+        failed = [cid for cid, ok in results.items() if ok is False]
+        if failed:
+            # 失败的渠道在下一个窗口重试
+            self._event.set()
+        self.last_push = {
+            'at': datetime.now().replace(microsecond=0).isoformat(),
+            'tokens': len(items),
+            'channels': {cid: {'keys': len(assignments[cid]), 'result': ok} for cid, ok in results.items()},
+        }
+        return results
+
+
+_publisher: Optional[NewAPIPublisher] = None
+
+
+def notify_refreshed() -> None:
+    """token 刷新完成事件；未启用推送时为空操作"""
+    if _publisher is not None:
+        _publisher.notify()
+
+
+def get_publisher() -> Optional[NewAPIPublisher]:
+    return _publisher
+
+
+def init_publisher(load_tokens: Callable[[], List[tuple]],
+                   should_publish: Optional[Callable[[], bool]] = None) -> Optional[NewAPIPublisher]:
+    """根据环境变量创建并启动推送线程，未配置时返回 None"""
+    global _publisher
+    base = os.environ.get('NEWAPI_BASE', '').strip()
+    key = os.environ.get('NEWAPI_KEY', '').strip()
+    try:
+        channels = parse_channels(os.environ.get('NEWAPI_CHANNELS', ''))
+    except ValueError as e:
+        logger.error(f"Invalid NEWAPI_CHANNELS: {e}")
+        return None
+    if not base or not key or not channels:
+        return None
+    if _publisher is not None:
+        return _publisher
+    client = NewAPIClient(base, key, os.environ.get('NEWAPI_USER_ID', '1'))
+    _publisher = NewAPIPublisher(
+        client, channels, load_tokens,
+        strategy=os.environ.get('NEWAPI_SHARD_STRATEGY', 'count'),
+        push_window=float(os.environ.get('NEWAPI_PUSH_WINDOW', '30')),
+        should_publish=should_publish,
+    )
+    _publisher.start()
+    logger.info(f"NewAPI push enabled for channels {[c['id'] for c in channels]}")
+    return _publisher
@@ -0,0 +1,279 @@
+"""
+代理请求体的快速处理：原始字节只读取一次，不做完整的 JSON 解析 / 重新序列化。
+
+scan_top_level() 只扫描顶层对象，取出需要的少数字段（如 stream / model）；
+字符串值用 bytes.find 跳过，嵌套结构只在结构字符之间跳转，几十 MB 的 base64 图片也不会被解码。
+其余字段不做完整校验，格式问题交给上游报错。
+
+SpooledBody 负责读取请求体：超过阈值的部分写入临时文件，通过 mmap 扫描，
+再以文件流的形式发给上游，单个请求的内存占用与请求体大小无关。
+"""
+
+import json
+import mmap
+import re
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+# 读取请求体的块大小
+READ_CHUNK = 1024 * 1024
+
+_STRUCT = re.compile(rb'["{}\[\]]')
+_WS = b' \t\r\n'
+_SCALAR_END = b',}] \t\r\n'
+
+
+class BodyScanError(ValueError):
+    pass
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def _skip_ws(buf: bytes, i: int) -> int:
+    n = len(buf)
+    while i < n and buf[i] in _WS:
+        i += 1
+    return i
+
+
+def _string_end(buf: bytes, i: int) -> int:
+    """i 指向起始引号，返回结束引号之后的位置"""
+    j = i + 1
+    while True:
+        j = buf.find(b'"', j)
+        if j < 0:
+            raise BodyScanError('unterminated string')
+        k = j - 1
+        while buf[k] == 0x5C:  # 反斜杠
+            k -= 1
+        if (j - 1 - k) % 2 == 0:
+            return j + 1
+        j += 1
+
+
+def _value_end(buf: bytes, i: int) -> int:
+    c = buf[i]
+    if c == 0x22:
+        return _string_end(buf, i)
+    if c in b'{[':
+        depth = 0
+        j = i
+        while True:
+            m = _STRUCT.search(buf, j)
+            if not m:
+                raise BodyScanError('unterminated container')
+            j = m.start()
+            if buf[j] == 0x22:
+                j = _string_end(buf, j)
+                continue
+            depth += 1 if buf[j] in b'{[' else -1
+            j += 1
+            if depth == 0:
+                return j
+    j = i
+    n = len(buf)
+    while j < n and buf[j] not in _SCALAR_END:
+        j += 1
+    if j == i:
+        raise BodyScanError('missing value')
+    return j
+
+
+def scan_top_level(buf: bytes, keys: Iterable[str]) -> Dict[str, Tuple[object, int, int]]:
+    """
+    扫描顶层 JSON 对象，返回 {key: (value, start, end)}，start/end 为值在 buf 中的字节范围。
+    只解码 keys 中列出的字段；重复字段以最后一个为准（与 json.loads 一致）。
+    """
+    wanted = set(keys)
+    found: Dict[str, Tuple[object, int, int]] = {}
+    try:
+        i = _skip_ws(buf, 0)
+        if buf[i] != 0x7B:
+            raise BodyScanError('body is not a JSON object')
+        i = _skip_ws(buf, i + 1)
+        if buf[i] != 0x7D:
+            while True:
+                if buf[i] != 0x22:
+                    raise BodyScanError('expected key')
+                key_end = _string_end(buf, i)
+                key = json.loads(buf[i:key_end])
+                i = _skip_ws(buf, key_end)
+                if buf[i] != 0x3A:
+                    raise BodyScanError('expected colon')
+                start = _skip_ws(buf, i + 1)
+                end = _value_end(buf, start)
+                if key in wanted:
+                    found[key] = (json.loads(buf[start:end]), start, end)
+                i = _skip_ws(buf, end)
+                if buf[i] == 0x2C:
+                    i = _skip_ws(buf, i + 1)
+                    continue
+                if buf[i] == 0x7D:
+                    break
+                raise BodyScanError('expected comma or closing brace')
+        if _skip_ws(buf, i + 1) != len(buf):
+            raise BodyScanError('trailing data')
+    except IndexError:
+        raise BodyScanError('truncated body')
+    except ValueError as e:
+        if isinstance(e, BodyScanError):
+            raise
+        raise BodyScanError(str(e))
+    return found
+
+
+Piece = Union[Tuple[int, int], bytes]
+
+
+def _stream_true_pieces(buf, found: Dict[str, Tuple[object, int, int]]) -> List[Piece]:
+    """把 stream 设为 true 后的请求体，表示为原始字节范围与新增字节的序列"""
+    size = len(buf)
+    if 'stream' in found:
+        value, start, end = found['stream']
+        if value is True:
+            return [(0, size)]
+        return [(0, start), b'true', (end, size)]
+    pos = buf.find(b'{') + 1
+    sep = b'' if buf[_skip_ws(buf, pos)] == 0x7D else b','
+    return [(0, pos), b'"stream":true' + sep, (pos, size)]
+
+
+def with_stream_true(buf: bytes, found: Dict[str, Tuple[object, int, int]]) -> bytes:
+    """在字节层面把顶层 stream 设为 true（已是 true 时原样返回）"""
+    pieces = _stream_true_pieces(buf, found)
+    if pieces == [(0, len(buf))]:
+        return buf
+    return b''.join(buf[p[0]:p[1]] if isinstance(p, tuple) else p for p in pieces)
+
+
+class UploadBody:
+    """
+    按片段读取的请求体（文件流），供 requests 作为 data 发送；长度已知，会带 Content-Length。
+    每次重试前调用 rewind()。
+    """
+
+    def __init__(self, view, pieces: List[Piece]):
+        self._view = view
+        self._pieces = [p for p in pieces if not isinstance(p, tuple) or p[1] > p[0]]
+        self._length = sum(p[1] - p[0] if isinstance(p, tuple) else len(p) for p in self._pieces)
+        self.rewind()
+
+    def __len__(self) -> int:
+        return self._length
+
+    def rewind(self) -> 'UploadBody':
+        self._index = 0
+        self._offset = 0
+        self._pos = 0
+        return self
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if offset != 0 or whence != 0:
+            raise OSError('UploadBody only supports rewinding')
+        self.rewind()
+        return 0
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        out = []
+        remaining = self._length - self._pos if size is None or size < 0 else size
+        while remaining > 0 and self._index < len(self._pieces):
+            piece = self._pieces[self._index]
+            if isinstance(piece, tuple):
+                start = piece[0] + self._offset
+                take = min(remaining, piece[1] - start)
+                out.append(self._view[start:start + take])
+                piece_done = start + take >= piece[1]
+            else:
+                take = min(remaining, len(piece) - self._offset)
+                out.append(piece[self._offset:self._offset + take])
+                piece_done = self._offset + take >= len(piece)
+            remaining -= take
+            self._pos += take
+            if piece_done:
+                self._index += 1
+                self._offset = 0
+            else:
+                self._offset += take
+        return b''.join(out)
+
+
+def rewind(data):
+    """重试前把请求体恢复到开头（bytes 原样返回）"""
+    return data.rewind() if isinstance(data, UploadBody) else data
+
+
+class SpooledBody:
+    """
+    请求体缓冲：不超过 spool_threshold 时留在内存，否则写入临时文件并通过 mmap 访问。
+    读取过程中超过 limit 抛出 BodyTooLarge。用完需 close()。
+    """
+
+    def __init__(self, spool_threshold: int):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        self._threshold = spool_threshold
+        self._spilled = False
+        self._map: Optional[mmap.mmap] = None
+        self._bytes: Optional[bytes] = None
+        self.size = 0
+
+    @classmethod
+    def read_from(cls, stream, spool_threshold: int, limit: Optional[int] = None) -> 'SpooledBody':
+        body = cls(spool_threshold)
+        try:
+            while True:
+                chunk = stream.read(READ_CHUNK)
+                if not chunk:
+                    break
+                body.size += len(chunk)
+                if limit is not None and body.size > limit:
+                    raise BodyTooLarge(f'request body exceeds {limit} bytes')
+                body._write(chunk)
+        except BaseException:
+            body.close()
+            raise
+        return body
+
+    def _write(self, chunk: bytes) -> None:
+        # 超过阈值时自己 rollover 并记录，不依赖 SpooledTemporaryFile 的内部状态（阈值为 0 时不落盘，与 max_size 一致）
+        if not self._spilled and self._threshold and self.size > self._threshold:
+            self._file.rollover()
+            self._spilled = True
+        self._file.write(chunk)
+
+    @property
+    def spilled(self) -> bool:
+        return self._spilled
+
+    def view(self):
+        """整个请求体的 bytes-like 视图（内存中为 bytes，已落盘为只读 mmap）"""
+        if self.spilled and self.size:
+            if self._map is None:
+                self._file.flush()
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map
+        if self._bytes is None:
+            self._file.seek(0)
+            self._bytes = self._file.read()
+        return self._bytes
+
+    def upload_data(self, found: Dict[str, Tuple[object, int, int]], force_stream: bool = False):
+        """发给上游的请求体：内存中的返回 bytes，已落盘的返回从文件分片读取的 UploadBody"""
+        view = self.view()
+        pieces = _stream_true_pieces(view, found) if force_stream else [(0, len(view))]
+        if not self.spilled:
+            if pieces == [(0, len(view))]:
+                return view
+            return b''.join(view[p[0]:p[1]] if isinstance(p, tuple) else p for p in pieces)
+        return UploadBody(view, pieces)
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._bytes = None
+        self._file.close()
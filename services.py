@@ -1,24 +1,34 @@
+import base64
+import json
 import logging
+import os
 import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from sqlalchemy import func, insert, or_, update
 from extensions import db
 from models import Token, SystemConfig, RequestLog
-from zai_token import DiscordOAuthHandler
+from zai_token import create_oauth_handler
+import newapi_push
+import live_feed
+import token_pool
+import log_buffer
 import jwt # pyjwt
 from flask import current_app
 
 logger = logging.getLogger(__name__)
 
+# 上游地址（可指向自建镜像或本地 fake 上游做压测）
+ZAI_BASE_URL = os.environ.get('ZAI_BASE_URL', 'https://zai.is').rstrip('/')
+
 def get_zai_handler():
     # Assume we are in app context so we can query SystemConfig
+    # Each call returns a fresh cookie jar (one account per handler) backed by a pooled connection per proxy
     config = SystemConfig.query.first()
-    handler = DiscordOAuthHandler()
-    if config and config.proxy_enabled and config.proxy_url:
-        handler.session.proxies = {
-            'http': config.proxy_url,
-            'https': config.proxy_url
-        }
-    return handler
+    proxy = config.proxy_url if config and config.proxy_enabled and config.proxy_url else None
+    return create_oauth_handler(ZAI_BASE_URL, proxy=proxy)
 
 def update_token_info(token_id, use_oauth=False):
     # Caller must ensure app context
@@ -30,7 +40,7 @@ def update_token_info(token_id, use_oauth=False):
     
     # 如果使用 OAuth 登录
     if use_oauth:
-        print(f"[*] Token {token_id} 使用 OAuth 登录更新...")
+        logger.info(f"Token {token_id} refreshing via OAuth browser login")
         result = handler.oauth_login_with_browser()
         source = result.get('source', 'oauth')
     else:
@@ -85,6 +95,7 @@ def update_token_info(token_id, use_oauth=False):
     token.at_expires = min(jwt_exp_dt, desired_exp) if jwt_exp_dt else desired_exp
     
     db.session.commit()
+    newapi_push.notify_refreshed()
     return True, f"Success ({source})"
 
 def create_or_update_token_from_oauth():
@@ -154,6 +165,7 @@ def create_or_update_token_from_oauth():
     token.at_expires = min(at_expires, desired_exp) if at_expires else desired_exp
     
     db.session.commit()
+    newapi_push.notify_refreshed()
     
     return {
         'success': True,
@@ -163,15 +175,525 @@ def create_or_update_token_from_oauth():
         'expires': token.at_expires.isoformat() if token.at_expires else None
     }
 
+# 刷新认领：租约时长（应大于一次 OAuth 登录的总时限）与每次认领的条数
+REFRESH_LEASE = 180
+REFRESH_CLAIM_BATCH = 20
+
+
+def claim_tokens(token_ids=None, due_before=None, claimed_before=None, limit=REFRESH_CLAIM_BATCH) -> list[int]:
+    """
+    认领待刷新的活跃 token：写入 refresh_lease_until 租约并返回认领到的 id。
+    只认领没有租约或租约早于 claimed_before（默认为现在）的 token；due_before 只认领在此之前过期的 token。
+
+    单条 UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING id：
+    PostgreSQL 上多个副本 / 线程同时认领时跳过彼此锁住的行，不等待、不重复；SQLite 写入本身串行。
+    刷新进程中途退出时租约到期后可被重新认领。
+    """
+    now = datetime.now()
+    claimed_before = claimed_before or now
+    candidates = (
+        db.select(Token.id)
+        .where(Token.is_active.is_(True),
+               or_(Token.refresh_lease_until.is_(None), Token.refresh_lease_until < claimed_before))
+        .order_by(Token.at_expires.asc().nulls_first(), Token.id.asc())
+        .limit(limit)
+    )
+    if token_ids is not None:
+        candidates = candidates.where(Token.id.in_(list(token_ids)))
+    if due_before is not None:
+        candidates = candidates.where(or_(Token.at_expires.is_(None), Token.at_expires <= due_before))
+    if db.engine.dialect.name == 'postgresql':
+        candidates = candidates.with_for_update(skip_locked=True)
+    stmt = (
+        update(Token)
+        .where(Token.id.in_(candidates.scalar_subquery()))
+        # 保持 updated_at 不变：认领不算 token 变更
+        .values(refresh_lease_until=now + timedelta(seconds=REFRESH_LEASE), updated_at=Token.updated_at)
+        .returning(Token.id)
+        .execution_options(synchronize_session=False)
+    )
+    try:
+        ids = db.session.scalars(stmt).all()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return sorted(ids)
+
+
+def release_tokens(token_ids) -> None:
+    """刷新结束，结束租约（记为刚刚到期，同一轮批量刷新不会再次认领）"""
+    token_ids = list(token_ids)
+    for i in range(0, len(token_ids), _IN_CHUNK):
+        db.session.execute(
+            update(Token)
+            .where(Token.id.in_(token_ids[i:i + _IN_CHUNK]))
+            .values(refresh_lease_until=datetime.now(), updated_at=Token.updated_at)
+            .execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+
+
 def refresh_all_tokens(force=False):
     # Caller must ensure app context
-    tokens = Token.query.filter_by(is_active=True).all()
-    for token in tokens:
-        if not force and token.at_expires and token.at_expires > datetime.now() + timedelta(minutes=10):
-            continue
-        
+    # 分批认领后逐个刷新；多个副本 / 手动刷新同时进行时各自认领不同的 token
+    started = datetime.now()
+    due_before = None if force else started + timedelta(minutes=10)
+    while True:
+        token_ids = claim_tokens(due_before=due_before, claimed_before=started)
+        if not token_ids:
+            return
         try:
-            success, msg = update_token_info(token.id)
-            logger.info(f"Refreshed token {token.id}: {msg}")
+            for token_id in token_ids:
+                try:
+                    success, msg = update_token_info(token_id)
+                    logger.info(f"Refreshed token {token_id}: {msg}")
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error refreshing token {token_id}: {e}")
+        finally:
+            release_tokens(token_ids)
+
+def pushable_tokens():
+    """当前可推送到 NewAPI 的 token：[(zai_token, user_paygate_tier)]，按 id 排序"""
+    rows = db.session.execute(
+        db.select(Token.zai_token, Token.user_paygate_tier)
+        .where(Token.is_active.is_(True), Token.zai_token.is_not(None), Token.at_expires > datetime.now())
+        .order_by(Token.id.asc())
+    ).all()
+    return [(zai, tier) for zai, tier in rows if not str(zai).startswith('SESSION')]
+
+# --- Bulk import pipeline ---
+
+# 后台 ST→AT 转换线程池（有界），避免在 HTTP 请求内阻塞登录
+REFRESH_WORKERS = max(1, int(os.environ.get('TOKEN_REFRESH_WORKERS', '8')))
+# SQLite 默认单条语句最多 999 个绑定参数，IN 查询分块执行
+_IN_CHUNK = 500
+_MAX_TRACKED_JOBS = 20
+
+_refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix='token-refresh')
+_jobs_lock = threading.Lock()
+_jobs: dict[str, 'ImportJob'] = {}
+
+
+class ImportJob:
+    """一次后台转换任务的进度（线程安全）。"""
+
+    def __init__(self, total: int):
+        self.id = uuid.uuid4().hex
+        self.total = total
+        self.done = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.created_at = time.time()
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.done >= self.total
+
+    def record(self, success: bool):
+        with self._cond:
+            self.done += 1
+            if success:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self._cond.notify_all()
+
+    def wait_for_change(self, seen_done: int, timeout: float) -> None:
+        with self._cond:
+            if self.done == seen_done and not self.finished:
+                self._cond.wait(timeout)
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                'job_id': self.id,
+                'total': self.total,
+                'done': self.done,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'finished': self.finished
+            }
+
+
+# 过期 token 的即时刷新：同一 token 在 EXPIRED_REFRESH_RETRY 秒内只尝试一次
+EXPIRED_REFRESH_RETRY = 300
+_expired_lock = threading.Lock()
+_expired_inflight: set[int] = set()
+_expired_attempts: dict[int, float] = {}
+
+
+def _refresh_expired_in_background(app, token_id: int):
+    with app.app_context():
+        try:
+            # 其他线程 / 副本已在刷新该 token 时跳过
+            if claim_tokens(token_ids=[token_id], limit=1):
+                try:
+                    success, msg = update_token_info(token_id)
+                    logger.info(f"Refreshed expired token {token_id}: {msg}", extra={'fields': {'token_id': token_id, 'success': success}})
+                except Exception:
+                    db.session.rollback()
+                    raise
+                finally:
+                    release_tokens([token_id])
         except Exception as e:
-            logger.error(f"Error refreshing token {token.id}: {e}")
+            logger.error(f"Error refreshing expired token {token_id}: {e}")
+        finally:
+            db.session.remove()
+            with _expired_lock:
+                _expired_inflight.discard(token_id)
+
+
+def schedule_refresh(token_ids) -> int:
+    """路由池发现过期 token 时调用：提交到后台线程池刷新，返回实际提交的数量"""
+    app = current_app._get_current_object()
+    now = time.time()
+    submit = []
+    with _expired_lock:
+        for token_id in token_ids:
+            if token_id in _expired_inflight or now - _expired_attempts.get(token_id, 0) < EXPIRED_REFRESH_RETRY:
+                continue
+            _expired_inflight.add(token_id)
+            _expired_attempts[token_id] = now
+            submit.append(token_id)
+    for token_id in submit:
+        _refresh_executor.submit(_refresh_expired_in_background, app, token_id)
+    return len(submit)
+
+
+def get_import_job(job_id: str):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def _register_job(job: ImportJob):
+    with _jobs_lock:
+        _jobs[job.id] = job
+        if len(_jobs) > _MAX_TRACKED_JOBS:
+            # 丢弃最早的已完成任务
+            for old_id, old_job in sorted(_jobs.items(), key=lambda kv: kv[1].created_at):
+                if len(_jobs) <= _MAX_TRACKED_JOBS:
+                    break
+                if old_job.finished:
+                    _jobs.pop(old_id, None)
+
+
+def _convert_in_background(app, job: ImportJob, token_id: int):
+    with app.app_context():
+        try:
+            success, msg = update_token_info(token_id)
+            logger.info(f"Converted token {token_id}: {msg}", extra={'fields': {'token_id': token_id, 'success': success}})
+        except Exception as e:
+            success = False
+            logger.error(f"Error converting token {token_id}: {e}")
+        finally:
+            db.session.remove()
+    job.record(success)
+
+
+def submit_token_conversion(token_ids) -> ImportJob:
+    """把 token 提交到后台线程池执行 ST→AT 转换，立即返回任务对象。"""
+    app = current_app._get_current_object()
+    token_ids = list(token_ids)
+    job = ImportJob(total=len(token_ids))
+    _register_job(job)
+    for token_id in token_ids:
+        _refresh_executor.submit(_convert_in_background, app, job, token_id)
+    return job
+
+
+def _existing_tokens_by_st(discord_tokens) -> dict[str, tuple]:
+    """一次集合查询（分块 IN）返回 {discord_token: (id, zai_token)}。"""
+    found: dict[str, tuple] = {}
+    for i in range(0, len(discord_tokens), _IN_CHUNK):
+        chunk = discord_tokens[i:i + _IN_CHUNK]
+        rows = db.session.execute(
+            db.select(Token.id, Token.discord_token, Token.zai_token).where(Token.discord_token.in_(chunk))
+        ).all()
+        for token_id, st, zai_token in rows:
+            found.setdefault(st, (token_id, zai_token))
+    return found
+
+
+def _needs_conversion(access_token) -> bool:
+    return not access_token or str(access_token).startswith('SESSION')
+
+
+def bulk_import_tokens(items, convert: bool = True) -> dict:
+    """
+    批量导入 Discord Token：内存去重 + 一次集合查询 + 批量 upsert，
+    缺少可用 access_token 的条目提交后台转换。
+    """
+    # 内存去重（同一 ST 以最后一条为准）
+    by_st: dict[str, dict] = {}
+    for t_data in items:
+        st = (t_data.get('session_token') or '').strip()
+        if not st:
+            continue
+        by_st[st] = t_data
+
+    existing = _existing_tokens_by_st(list(by_st))
+
+    new_rows = []
+    update_rows = []
+    pending_st = []
+    for st, t_data in by_st.items():
+        if st in existing:
+            token_id, zai_token = existing[st]
+            row = {
+                'id': token_id,
+                'image_enabled': t_data.get('image_enabled', True),
+                'video_enabled': t_data.get('video_enabled', True)
+            }
+            for key, field in (('email', 'email'), ('access_token', 'zai_token'), ('is_active', 'is_active')):
+                if key in t_data:
+                    row[field] = t_data[key]
+            update_rows.append(row)
+            zai_token = row.get('zai_token', zai_token)
+        else:
+            zai_token = t_data.get('access_token')
+            new_rows.append({
+                'discord_token': st,
+                'email': t_data.get('email'),
+                'zai_token': zai_token,
+                'is_active': t_data.get('is_active', True),
+                'image_enabled': t_data.get('image_enabled', True),
+                'video_enabled': t_data.get('video_enabled', True),
+                'image_concurrency': t_data.get('image_concurrency', -1),
+                'video_concurrency': t_data.get('video_concurrency', -1)
+            })
+        if t_data.get('is_active', True) and _needs_conversion(zai_token):
+            pending_st.append(st)
+
+    # bulk update 各行列集合不同，按列集合分组执行
+    groups: dict[tuple, list] = {}
+    for row in update_rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for rows in groups.values():
+        db.session.execute(update(Token), rows)
+    if new_rows:
+        db.session.execute(insert(Token), new_rows)
+    db.session.commit()
+    # 批量语句不经过 ORM 变更跟踪：路由池整体重载，通知面板整体刷新
+    token_pool.pool.invalidate()
+    live_feed.publish('resync', {'reason': 'import', 'added': len(new_rows), 'updated': len(update_rows)})
+
+    result = {'added': len(new_rows), 'updated': len(update_rows), 'job': None}
+    if convert and pending_st:
+        ids = _existing_tokens_by_st(pending_st)
+        result['job'] = submit_token_conversion(ids[st][0] for st in pending_st if st in ids)
+    return result
+
+
+# --- Admin listing (keyset pagination + column projection) ---
+
+_EPOCH = datetime(1970, 1, 1)
+MAX_PAGE_SIZE = 1000
+
+TOKEN_FIELDS = {
+    'id': Token.id,
+    'email': Token.email,
+    'is_active': Token.is_active,
+    'at_expires': Token.at_expires,
+    'credits': Token.credits,
+    'user_paygate_tier': Token.user_paygate_tier,
+    'current_project_name': Token.current_project_name,
+    'current_project_id': Token.current_project_id,
+    'image_count': Token.image_count,
+    'video_count': Token.video_count,
+    'error_count': Token.error_count,
+    'remark': Token.remark,
+    'image_enabled': Token.image_enabled,
+    'video_enabled': Token.video_enabled,
+    'image_concurrency': Token.image_concurrency,
+    'video_concurrency': Token.video_concurrency,
+    'zai_token': Token.zai_token,
+    'st': Token.discord_token,
+    # 面板列表只需要预览 / 是否已获取，不必传完整 token
+    'st_preview': func.substr(Token.discord_token, 1, 20),
+    'has_zai_token': Token.zai_token.is_not(None),
+    'updated_at': Token.updated_at,
+}
+TOKEN_DEFAULT_FIELDS = [f for f in TOKEN_FIELDS if f not in ('st_preview', 'has_zai_token', 'updated_at')]
+
+# 排序键（NULL 合并为固定值，保证 keyset 比较稳定）
+TOKEN_SORTS = {
+    'id': (Token.id, int),
+    'at_expires': (func.coalesce(Token.at_expires, _EPOCH), datetime.fromisoformat),
+    'error_count': (func.coalesce(Token.error_count, 0), int),
+    'created_at': (func.coalesce(Token.created_at, _EPOCH), datetime.fromisoformat),
+}
+
+LOG_FIELDS = {
+    'id': RequestLog.id,
+    'operation': RequestLog.operation,
+    'token_email': RequestLog.token_email,
+    'discord_token': RequestLog.discord_token,
+    'zai_token': RequestLog.zai_token,
+    'status_code': RequestLog.status_code,
+    'duration': RequestLog.duration,
+    'created_at': RequestLog.created_at,
+}
+LOG_DEFAULT_FIELDS = [f for f in LOG_FIELDS if f != 'id']
+
+
+def encode_cursor(values) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or not values:
+        raise ValueError('invalid cursor')
+    return values
+
+
+def _projection(fields, available: dict, default: list) -> list:
+    names = [f for f in (fields or default) if f in available]
+    if not names:
+        raise ValueError('no valid fields')
+    return names
+
+
+def _token_filters(status=None, q=None, expiring_before=None) -> list:
+    now = datetime.now()
+    conds = []
+    if status == 'active':
+        conds.append(Token.is_active.is_(True))
+    elif status == 'disabled':
+        conds.append(Token.is_active.is_(False))
+    elif status == 'valid':
+        conds += [Token.is_active.is_(True), Token.at_expires > now]
+    elif status == 'expired':
+        conds.append(db.or_(Token.at_expires.is_(None), Token.at_expires <= now))
+    if q:
+        conds.append(func.lower(Token.email).contains(q.lower(), autoescape=True))
+    if expiring_before:
+        conds.append(Token.at_expires < expiring_before)
+    return conds
+
+
+def token_list_version() -> str:
+    """列表版本号：行数 + 最大 id + 最近更新时间，用于 ETag，不需要加载任何行"""
+    count, max_id, last_update = db.session.execute(
+        db.select(func.count(Token.id), func.max(Token.id), func.max(Token.updated_at))
+    ).one()
+    return f"{count}:{max_id}:{last_update}"
+
+
+def list_tokens(fields=None, status=None, q=None, expiring_before=None, sort='id',
+                limit=None, cursor=None) -> tuple[list[dict], str | None]:
+    """
+    Token 列表：只查询请求的列；sort 前缀 '-' 表示倒序；
+    给出 limit 时按 (排序键, id) 做 keyset 分页，返回 (rows, next_cursor)。
+    """
+    names = _projection(fields, TOKEN_FIELDS, TOKEN_DEFAULT_FIELDS)
+    desc = sort.startswith('-')
+    sort_expr, parse = TOKEN_SORTS.get(sort.lstrip('-'), TOKEN_SORTS['id'])
+
+    stmt = db.select(*(TOKEN_FIELDS[n].label(n) for n in names),
+                     sort_expr.label('_sort'), Token.id.label('_id'))
+    conds = _token_filters(status, q, expiring_before)
+    if cursor:
+        last_sort, last_id = (decode_cursor(cursor) + [None])[:2]
+        if not isinstance(last_id, int):
+            raise ValueError('invalid cursor')
+        last_sort = parse(last_sort)
+        if desc:
+            conds.append(db.or_(sort_expr < last_sort, db.and_(sort_expr == last_sort, Token.id < last_id)))
+        else:
+            conds.append(db.or_(sort_expr > last_sort, db.and_(sort_expr == last_sort, Token.id > last_id)))
+    if conds:
+        stmt = stmt.where(*conds)
+    stmt = stmt.order_by(sort_expr.desc(), Token.id.desc()) if desc else stmt.order_by(sort_expr.asc(), Token.id.asc())
+    if limit:
+        stmt = stmt.limit(min(int(limit), MAX_PAGE_SIZE) + 1)
+
+    rows = db.session.execute(stmt).all()
+    next_cursor = None
+    if limit and len(rows) > min(int(limit), MAX_PAGE_SIZE):
+        rows = rows[:-1]
+        next_cursor = encode_cursor([rows[-1]._sort, rows[-1]._id])
+    result = []
+    for row in rows:
+        item = {n: getattr(row, n) for n in names}
+        if 'has_zai_token' in item:
+            item['has_zai_token'] = bool(item['has_zai_token'])
+        result.append(item)
+    return result, next_cursor
+
+
+def log_list_version() -> str:
+    return log_buffer.buffer.version()
+
+
+def _log_predicate(status=None, operation=None, q=None):
+    if not (status or operation or q):
+        return None
+    q = q.lower() if q else None
+    code = int(status) if status and str(status).isdigit() else None
+
+    def match(record) -> bool:
+        values = log_buffer.as_dict(record)
+        status_code = values['status_code'] or 0
+        if status == 'ok' and status_code >= 400:
+            return False
+        if status == 'error' and status_code < 400:
+            return False
+        if code is not None and status_code != code:
+            return False
+        if operation and values['operation'] != operation:
+            return False
+        if q and q not in (values['token_email'] or '').lower():
+            return False
+        return True
+    return match
+
+
+def list_logs(fields=None, status=None, operation=None, q=None, limit=100,
+              cursor=None) -> tuple[list[dict], str | None]:
+    """
+    请求日志：按 id 倒序 keyset 分页（cursor 为上一页最后一条的 id）。
+    优先从内存缓冲区读取，缓冲区覆盖不到时查询数据库。
+    """
+    names = _projection(fields, LOG_FIELDS, LOG_DEFAULT_FIELDS)
+    limit = max(1, min(int(limit or 100), MAX_PAGE_SIZE))
+    last_id = None
+    if cursor:
+        last_id = decode_cursor(cursor)[0]
+        if not isinstance(last_id, int):
+            raise ValueError('invalid cursor')
+
+    served = log_buffer.buffer.query(limit, last_id, _log_predicate(status, operation, q))
+    if served is not None:
+        records, has_more = served
+        next_cursor = encode_cursor([records[-1][0]]) if has_more else None
+        return [log_buffer.as_dict(r, names) for r in records], next_cursor
+
+    # 尚未写入的日志先落库，保证查询结果完整
+    log_buffer.buffer.flush()
+    stmt = db.select(*(LOG_FIELDS[n].label(n) for n in names), RequestLog.id.label('_id'))
+    if status == 'ok':
+        stmt = stmt.where(RequestLog.status_code < 400)
+    elif status == 'error':
+        stmt = stmt.where(RequestLog.status_code >= 400)
+    elif status and str(status).isdigit():
+        stmt = stmt.where(RequestLog.status_code == int(status))
+    if operation:
+        stmt = stmt.where(RequestLog.operation == operation)
+    if q:
+        stmt = stmt.where(func.lower(RequestLog.token_email).contains(q.lower(), autoescape=True))
+    if last_id is not None:
+        stmt = stmt.where(RequestLog.id < last_id)
+    rows = db.session.execute(stmt.order_by(RequestLog.id.desc()).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:-1]
+        next_cursor = encode_cursor([rows[-1]._id])
+    return [{n: getattr(row, n) for n in names} for row in rows], next_cursor
@@ -0,0 +1,164 @@
+"""
+上游 SSE 流的首个事件预读。
+
+上游返回 200 后，在向客户端发送任何字节之前先读到第一个 data 事件：
+  - 首字节超时（ZAI_STREAM_FIRST_BYTE_TIMEOUT，默认 600 秒）、连接被重置 → StreamPeekError；
+  - 第一个事件是错误（{"error": ...} 或 event: error）→ PeekedStream.error；
+调用方据此换下一个 token 重试。预读到的字节原样缓存，之后与剩余部分一起发给客户端。
+
+上游响应原样透传压缩体时，预读的字节只为检查而解压，发给客户端的仍是原始压缩字节。
+"""
+
+import json
+import time
+import zlib
+from typing import Iterable, Iterator, List, Optional
+
+from upstream_timeouts import set_read_timeout
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - 可选依赖
+    brotli = None
+
+READ_CHUNK = 1024
+# 预读缓冲上限：超过仍未读到完整事件时不再检查，直接开始转发
+MAX_PEEK_BYTES = 64 * 1024
+
+
+class StreamPeekError(Exception):
+    pass
+
+
+class StreamPeekTimeout(StreamPeekError):
+    pass
+
+
+def _decompressor(encoding: Optional[str]):
+    if not encoding:
+        return None
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.decompressobj()
+    if encoding == 'br' and brotli is not None:
+        return brotli.Decompressor()
+    return False  # 无法解码：不检查内容
+
+
+def _decompress(decoder, data: bytes) -> bytes:
+    if hasattr(decoder, 'process'):
+        return decoder.process(data)
+    return decoder.decompress(data)
+
+
+def _split_event(text: str):
+    """返回 (第一个完整事件, 剩余文本)，尚不完整时返回 (None, text)"""
+    text = text.replace('\r\n', '\n')
+    idx = text.find('\n\n')
+    if idx < 0:
+        return None, text
+    return text[:idx], text[idx + 2:]
+
+
+def event_error(event: str) -> Optional[str]:
+    """事件为错误时返回错误内容（data 原文），否则返回 None"""
+    name = None
+    data_lines = []
+    for line in event.split('\n'):
+        if line.startswith('event:'):
+            name = line[6:].strip()
+        elif line.startswith('data:'):
+            data_lines.append(line[5:].strip())
+    data = '\n'.join(data_lines)
+    if name == 'error':
+        return data or 'error'
+    if not data or data == '[DONE]':
+        return None
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(payload, dict) and (payload.get('error') or payload.get('type') == 'error'):
+        return data
+    return None
+
+
+class PeekedStream:
+    def __init__(self, chunks: List[bytes], rest: Iterator[bytes], event: Optional[str]):
+        self.chunks = chunks
+        self.rest = rest
+        self.event = event
+        self.error = event_error(event) if event else None
+
+    def iter_bytes(self) -> Iterator[bytes]:
+        yield from self.chunks
+        for chunk in self.rest:
+            if chunk:
+                yield chunk
+
+    def iter_lines(self) -> Iterator[str]:
+        return iter_lines(self.iter_bytes())
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """逐行读取（仅用于未透传压缩、已解码的流）"""
+    pending = ''
+    for chunk in chunks:
+        pending += chunk.decode('utf-8', errors='replace')
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def peek(resp, passthrough_encoding: Optional[str] = None, first_byte_timeout: Optional[float] = None,
+         read_timeout: Optional[float] = None) -> PeekedStream:
+    """
+    从 requests 的流式响应（stream=True）预读第一个 data 事件。
+    passthrough_encoding 不为空时按原始（压缩）字节读取；first_byte_timeout 为读到首个事件的总时限，
+    之后 socket 读超时改为 read_timeout（相邻两次读取的最长间隔）。
+    """
+    raw = resp.raw.stream(READ_CHUNK, decode_content=not passthrough_encoding)
+    decoder = _decompressor(passthrough_encoding)
+    deadline = time.monotonic() + first_byte_timeout if first_byte_timeout else None
+    chunks: List[bytes] = []
+    size = 0
+    text = ''
+    event = None
+    try:
+        for chunk in raw:
+            if not chunk:
+                continue
+            chunks.append(chunk)
+            size += len(chunk)
+            if decoder is False:
+                break
+            decoded = _decompress(decoder, chunk) if decoder else chunk
+            text += decoded.decode('utf-8', errors='replace')
+            while True:
+                candidate, text = _split_event(text)
+                if candidate is None:
+                    break
+                # 只有注释（keep-alive）的事件不算首个事件
+                if any(line.startswith(('data:', 'event:')) for line in candidate.split('\n')):
+                    event = candidate
+                    break
+            if event is not None or size >= MAX_PEEK_BYTES:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                raise StreamPeekTimeout('first event timed out')
+        else:
+            if not chunks:
+                raise StreamPeekError('stream closed before first event')
+    except StreamPeekError:
+        raise
+    except Exception as e:
+        if 'timed out' in str(e).lower() or 'timeout' in type(e).__name__.lower():
+            raise StreamPeekTimeout('first event timed out')
+        raise StreamPeekError(f'stream failed before first event: {e}')
+    if first_byte_timeout != read_timeout:
+        set_read_timeout(resp, read_timeout)
+    return PeekedStream(chunks, raw, event)
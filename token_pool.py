@@ -0,0 +1,209 @@
+"""
+代理路由用的 token 池。
+
+请求路径上不再加载完整的 ORM Token（身份映射、属性插桩、约 30 个列），
+而是使用只包含路由所需字段的 RouteToken（__slots__）。
+池在首次使用时从数据库加载活跃 token 的少数几列，之后：
+  - ORM 提交（commit）中改动过的 token 标记为过期，下次取候选时按 id 重新查询这几行；
+  - 批量语句（bulk insert / update）不经过 ORM 变更跟踪，调用 invalidate() 整体重载；
+  - 另外每 RELOAD_INTERVAL 秒整体重载一次兜底（多副本部署时其他副本的改动靠它同步，可调小）。
+
+zAI token（JWT）的 exp 在记录创建时解码一次。选择候选时跳过已过期或即将过期
+（EXPIRY_MARGIN 秒内）的 token，并通过 on_expired 回调立即安排刷新，
+客户端请求不会再落到已失效的 token 上（上游 401 + 记错误）。
+
+环境变量：ZAI_TOKEN_EXPIRY_MARGIN（默认 60 秒）、TOKEN_POOL_RELOAD（默认 300 秒）
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import jwt
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from extensions import db
+from models import Token
+
+RELOAD_INTERVAL = float(os.environ.get('TOKEN_POOL_RELOAD', '300'))
+EXPIRY_MARGIN = float(os.environ.get('ZAI_TOKEN_EXPIRY_MARGIN', '60'))
+# SQLite 默认单条语句最多 999 个绑定参数，IN 查询分块执行
+_IN_CHUNK = 500
+
+_CHANGED_KEY = 'token_pool_changed'
+
+
+def _jwt_exp(token: str) -> Optional[float]:
+    """JWT 的 exp（不校验签名）；无法解码或没有 exp 时返回 None"""
+    try:
+        exp = jwt.decode(token, options={"verify_signature": False, "verify_exp": False}).get('exp')
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+
+class RouteToken:
+    """路由记录：只保留代理需要的字段"""
+
+    __slots__ = ('id', 'email', 'zai_token', 'discord_token', 'at_expires', 'error_count', 'exp')
+
+    def __init__(self, id, email, zai_token, discord_token, at_expires, error_count):
+        self.id = id
+        self.email = email
+        self.zai_token = zai_token
+        self.discord_token = discord_token
+        self.at_expires = at_expires
+        self.error_count = error_count or 0
+        self.exp = _jwt_exp(zai_token) if self.routable else None
+
+    @property
+    def routable(self) -> bool:
+        return bool(self.zai_token) and not str(self.zai_token).startswith('SESSION')
+
+    def usable(self, cutoff: float) -> bool:
+        return self.exp is None or self.exp > cutoff
+
+    def __repr__(self) -> str:
+        return f"<RouteToken {self.id}>"
+
+
+_COLUMNS = (Token.id, Token.email, Token.zai_token, Token.discord_token, Token.at_expires, Token.error_count)
+
+
+class TokenPool:
+    def __init__(self, reload_interval: float = RELOAD_INTERVAL, expiry_margin: float = EXPIRY_MARGIN):
+        self.reload_interval = reload_interval
+        self.expiry_margin = expiry_margin
+        # 发现过期 token 时调用，参数为 token id 列表（在请求线程中调用）
+        self.on_expired: Optional[Callable[[List[int]], None]] = None
+        self._next_expiry: Optional[float] = None
+        self._tokens: Dict[int, RouteToken] = {}
+        self._routable: Tuple[RouteToken, ...] = ()
+        self._stale: Set[int] = set()
+        self._needs_reload = True
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._rr_index = 0
+
+    def mark_stale(self, ids: Iterable[int]) -> None:
+        with self._lock:
+            self._stale.update(ids)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._needs_reload = True
+
+    def _sync(self) -> None:
+        """应用待同步的变更（需要 app context）"""
+        with self._lock:
+            full = self._needs_reload or time.time() - self._loaded_at > self.reload_interval
+            stale = self._stale
+            if not full and not stale:
+                return
+            self._stale = set()
+            self._needs_reload = False
+
+        if full:
+            loaded_at = time.time()
+            rows = db.session.execute(db.select(*_COLUMNS).where(Token.is_active.is_(True))).all()
+            tokens = {row.id: RouteToken(*row) for row in rows}
+            with self._lock:
+                self._tokens = tokens
+                self._loaded_at = loaded_at
+                self._rebuild()
+            return
+
+        stale = list(stale)
+        fresh: List[RouteToken] = []
+        for i in range(0, len(stale), _IN_CHUNK):
+            rows = db.session.execute(
+                db.select(*_COLUMNS).where(Token.id.in_(stale[i:i + _IN_CHUNK]), Token.is_active.is_(True))
+            ).all()
+            fresh.extend(RouteToken(*row) for row in rows)
+        with self._lock:
+            tokens = dict(self._tokens)
+            for token_id in stale:
+                tokens.pop(token_id, None)
+            for token in fresh:
+                tokens[token.id] = token
+            self._tokens = tokens
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        self._set_routable(sorted((t for t in self._tokens.values() if t.routable), key=lambda t: t.id))
+
+    def _set_routable(self, tokens) -> None:
+        self._routable = tuple(tokens)
+        self._next_expiry = min((t.exp for t in self._routable if t.exp is not None), default=None)
+
+    def _drop_expired(self, cutoff: float) -> List[int]:
+        """从候选中移除过期 token（刷新后随同步重新加入），返回被移除的 id"""
+        expired = [t.id for t in self._routable if not t.usable(cutoff)]
+        self._set_routable(t for t in self._routable if t.usable(cutoff))
+        return expired
+
+    def candidates(self) -> List[RouteToken]:
+        """多号轮询：每个请求从上一次的下一个 token 开始顺序尝试"""
+        self._sync()
+        expired: List[int] = []
+        with self._lock:
+            # 最早的 exp 仍在安全范围内时无需逐个检查
+            cutoff = time.time() + self.expiry_margin
+            if self._next_expiry is not None and self._next_expiry <= cutoff:
+                expired = self._drop_expired(cutoff)
+            tokens = self._routable
+            if tokens:
+                start = self._rr_index % len(tokens)
+                self._rr_index = (start + 1) % len(tokens)
+        if expired and self.on_expired is not None:
+            self.on_expired(expired)
+        if not tokens:
+            return []
+        return list(tokens[start:] + tokens[:start])
+
+    def get(self, token_id: int):
+        return self._tokens.get(token_id)
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+
+pool = TokenPool()
+
+
+def _token_id(obj):
+    # 已持久化的对象用 identity 取主键，避免在 flush 中加载已过期的属性；新对象在 flush 后已有 id
+    identity = inspect(obj).identity
+    return identity[0] if identity else obj.id
+
+
+def _collect(session: Session, flush_context) -> None:
+    changed = session.info.setdefault(_CHANGED_KEY, set())
+    for objs in (session.new, session.dirty, session.deleted):
+        changed.update(_token_id(obj) for obj in objs if isinstance(obj, Token))
+
+
+def _apply(session: Session) -> None:
+    changed = session.info.pop(_CHANGED_KEY, None)
+    if changed:
+        pool.mark_stale(changed)
+
+
+def _discard(session: Session) -> None:
+    session.info.pop(_CHANGED_KEY, None)
+
+
+_installed = False
+
+
+def install() -> None:
+    """注册 session 事件（只需调用一次）"""
+    global _installed
+    if _installed:
+        return
+    event.listen(Session, 'after_flush', _collect)
+    event.listen(Session, 'after_commit', _apply)
+    event.listen(Session, 'after_rollback', _discard)
+    _installed = True
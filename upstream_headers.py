@@ -0,0 +1,153 @@
+"""
+上游（zai.is）请求头管线。
+
+每个管线由若干 HeaderProvider 组成：
+  - static()：与 token 无关的部分，在管线创建时计算一次；
+  - derive(token)：与 token 相关的部分（鉴权、签名等），按 token 缓存，
+    到 provider.ttl 或 token 的 JWT exp（先到者）时重新计算。
+代理接口（/v1/chat/completions、/v1/models）与 DiscordOAuthHandler 共用这里的管线。
+OAuth 登录只使用 static() 部分，且只附加在发往 zai.is 的请求上（见 zai_token.oauth_request_headers），
+不会发送到 discord.com；derive(token) 的输入是 zai.is 访问令牌，登录时还没有，不参与 OAuth。
+
+环境变量：
+  ZAI_EXTRA_HEADERS     追加的固定请求头，JSON 对象，如 {"x-zai-darkknight": "..."}
+  ZAI_HEADER_PROVIDERS  自定义 provider，逗号分隔的 "module:factory"，factory() 返回 HeaderProvider
+"""
+
+import base64
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 无法从 token 中读到 exp 时，派生请求头的默认缓存时间（秒）
+DEFAULT_TTL = 3600
+MAX_CACHED_TOKENS = 4096
+
+
+class HeaderProvider:
+    """请求头提供者基类；ttl 为 derive() 结果的最长缓存时间（秒），None 表示跟随 token 过期。"""
+
+    ttl: Optional[float] = None
+
+    def static(self) -> Dict[str, str]:
+        return {}
+
+    def derive(self, token: str) -> Dict[str, str]:
+        return {}
+
+
+class StaticHeaderProvider(HeaderProvider):
+    def __init__(self, headers: Dict[str, str]):
+        self.headers = dict(headers)
+
+    def static(self) -> Dict[str, str]:
+        return dict(self.headers)
+
+
+class BearerAuthProvider(HeaderProvider):
+    def derive(self, token: str) -> Dict[str, str]:
+        return {'Authorization': f'Bearer {token}'}
+
+
+def _token_exp(token: str) -> Optional[float]:
+    """读取 JWT payload 中的 exp（不校验签名）"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+
+class UpstreamHeaders:
+    def __init__(self, providers: List[HeaderProvider], base: Optional[Dict[str, str]] = None,
+                 max_cached: int = MAX_CACHED_TOKENS):
+        self.providers = list(providers)
+        self._static = dict(base or {})
+        for provider in self.providers:
+            self._static.update(provider.static())
+        self._derived = [p for p in self.providers if type(p).derive is not HeaderProvider.derive]
+        self._cache: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self.max_cached = max_cached
+
+    def static(self) -> Dict[str, str]:
+        return dict(self._static)
+
+    def _derive(self, token: str) -> Dict[str, str]:
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(token)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        headers = dict(self._static)
+        expires_at = _token_exp(token) or now + DEFAULT_TTL
+        for provider in self._derived:
+            headers.update(provider.derive(token))
+            if provider.ttl is not None:
+                expires_at = min(expires_at, now + provider.ttl)
+        with self._lock:
+            if len(self._cache) >= self.max_cached:
+                for key in [k for k, (exp, _) in self._cache.items() if exp <= now]:
+                    del self._cache[key]
+                while len(self._cache) >= self.max_cached:
+                    del self._cache[next(iter(self._cache))]
+            self._cache[token] = (expires_at, headers)
+        return headers
+
+    def for_token(self, token: Optional[str], extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """返回某个 token 的完整请求头（副本，可直接修改）"""
+        headers = dict(self._derive(token) if token and self._derived else self._static)
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            self._cache.pop(token, None)
+
+
+def _load_env_providers() -> List[HeaderProvider]:
+    providers: List[HeaderProvider] = []
+    extra = os.environ.get('ZAI_EXTRA_HEADERS', '').strip()
+    if extra:
+        try:
+            providers.append(StaticHeaderProvider(json.loads(extra)))
+        except ValueError as e:
+            logger.error(f"Invalid ZAI_EXTRA_HEADERS: {e}")
+    for spec in filter(None, (s.strip() for s in os.environ.get('ZAI_HEADER_PROVIDERS', '').split(','))):
+        module_name, _, attr = spec.partition(':')
+        try:
+            factory = getattr(importlib.import_module(module_name), attr or 'provider')
+            providers.append(factory())
+        except Exception as e:
+            logger.error(f"Failed to load header provider {spec}: {e}")
+    return providers
+
+
+_pipelines_lock = threading.Lock()
+_pipelines: Dict[str, UpstreamHeaders] = {}
+
+
+def get_pipeline(name: str = 'api', base: Optional[Dict[str, str]] = None, bearer: bool = True) -> UpstreamHeaders:
+    """
+    按名称缓存的管线（首次调用时创建，static 部分只计算一次）。
+    api 管线带 Bearer 鉴权；OAuth 登录使用 oauth:<base_url> 管线（只取 static()）。
+    """
+    with _pipelines_lock:
+        pipeline = _pipelines.get(name)
+        if pipeline is None:
+            providers = _load_env_providers()
+            if bearer:
+                providers.append(BearerAuthProvider())
+            pipeline = UpstreamHeaders(providers, base=base)
+            _pipelines[name] = pipeline
+        return pipeline
@@ -0,0 +1,214 @@
+"""
+上游调用的分阶段超时策略。
+
+每类上游调用（route）有一组超时（秒，0 表示不限制）：
+  - connect：建立连接；
+  - ttfb：发出请求到收到响应头，流式对话为到收到第一个 SSE 事件；
+  - idle：收到响应后相邻两次读取之间的最长间隔。流式响应由 socket 读超时充当看门狗，
+    上游卡住时读取在 idle 秒后失败并关闭连接，不占用工作线程；
+  - total：整个调用的总时限（OAuth 为整个登录流程），每次读取前按剩余时间收紧读超时。
+
+route：chat（非流式对话）、chat_stream（流式对话，含转换为非流式的请求）、models、oauth。
+UPSTREAM_TIMEOUTS（JSON 对象）覆盖默认值："*" 作用于所有 route，"model:<通配符>" 按模型叠加在对话 route 之上，例如
+  {"chat_stream": {"ttfb": 30, "idle": 120}, "oauth": {"total": 30}, "model:glm-4.6*": {"idle": 600}}
+超时按 route / 阶段计数，GET /api/upstream/timeouts 查看。
+"""
+
+import fnmatch
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('connect', 'ttfb', 'idle', 'total')
+
+# 兼容原有变量：流式请求等待第一个事件的时限；默认与原来的 timeout=600 相同，首字很慢的模型不会被提前换 token
+_STREAM_TTFB = float(os.environ.get('ZAI_STREAM_FIRST_BYTE_TIMEOUT', '600'))
+
+DEFAULTS: Dict[str, Dict[str, float]] = {
+    'chat': {'connect': 10, 'ttfb': 600, 'idle': 600, 'total': 0},
+    'chat_stream': {'connect': 10, 'ttfb': _STREAM_TTFB, 'idle': 300, 'total': 0},
+    'models': {'connect': 10, 'ttfb': 60, 'idle': 60, 'total': 60},
+    'oauth': {'connect': 10, 'ttfb': 20, 'idle': 20, 'total': 60},
+}
+
+
+class UpstreamTimeout(Exception):
+    def __init__(self, route: str, phase: str):
+        super().__init__(f"{route} {phase} timeout")
+        self.route = route
+        self.phase = phase
+
+
+class TimeoutPolicy:
+    __slots__ = PHASES
+
+    def __init__(self, connect=None, ttfb=None, idle=None, total=None):
+        # 0 / None 均表示不限制
+        self.connect = connect or None
+        self.ttfb = ttfb or None
+        self.idle = idle or None
+        self.total = total or None
+
+    def merged(self, overrides: Dict[str, float]) -> 'TimeoutPolicy':
+        values = self.as_dict()
+        values.update({k: float(v) if v else None for k, v in overrides.items() if k in PHASES})
+        return TimeoutPolicy(**values)
+
+    def as_dict(self) -> Dict[str, Optional[float]]:
+        return {phase: getattr(self, phase) for phase in PHASES}
+
+    def __repr__(self) -> str:
+        return f"<TimeoutPolicy {self.as_dict()}>"
+
+
+def _load_overrides() -> Dict[str, Dict[str, float]]:
+    raw = os.environ.get('UPSTREAM_TIMEOUTS')
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+    except ValueError as e:
+        logger.error(f"Invalid UPSTREAM_TIMEOUTS, using defaults: {e}")
+        return {}
+    return {str(k): v for k, v in data.items() if isinstance(v, dict)}
+
+
+_overrides = _load_overrides()
+_policies: Dict[Tuple[str, Optional[str]], TimeoutPolicy] = {}
+
+
+def policy(route: str, model: Optional[str] = None) -> TimeoutPolicy:
+    """route（及模型）对应的超时策略，结果按 (route, model) 缓存"""
+    key = (route, model)
+    cached = _policies.get(key)
+    if cached is not None:
+        return cached
+    result = TimeoutPolicy(**DEFAULTS.get(route, DEFAULTS['chat']))
+    for name in ('*', route):
+        if name in _overrides:
+            result = result.merged(_overrides[name])
+    if model and route in ('chat', 'chat_stream'):
+        for name, values in _overrides.items():
+            if name.startswith('model:') and fnmatch.fnmatchcase(model, name[6:]):
+                result = result.merged(values)
+    if len(_policies) < 1024:
+        _policies[key] = result
+    return result
+
+
+class Deadline:
+    """一次上游调用的计时：每次发起请求 / 读取前按剩余总时长收紧超时，超出 total 时抛出 UpstreamTimeout"""
+
+    __slots__ = ('route', 'policy', 'started', 'expires')
+
+    def __init__(self, route: str, model: Optional[str] = None):
+        self.route = route
+        self.policy = policy(route, model)
+        self.started = time.monotonic()
+        self.expires = self.started + self.policy.total if self.policy.total else None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.expires is None else self.expires - time.monotonic()
+
+    def _cap(self, value: Optional[float]) -> Optional[float]:
+        remaining = self.remaining()
+        if remaining is None:
+            return value
+        if remaining <= 0:
+            raise UpstreamTimeout(self.route, 'total')
+        return remaining if value is None else min(value, remaining)
+
+    def check(self) -> None:
+        self._cap(None)
+
+    def request_timeout(self) -> Tuple[Optional[float], Optional[float]]:
+        """requests 的 (connect, read) 超时；read 覆盖到收到响应头为止"""
+        return self._cap(self.policy.connect), self._cap(self.policy.ttfb)
+
+    def first_event_timeout(self) -> Optional[float]:
+        """从现在起等待第一个事件的时限（ttfb 从发起请求时开始计算）"""
+        ttfb = self.policy.ttfb
+        if ttfb is None:
+            return self._cap(None)
+        return self._cap(max(0.001, self.started + ttfb - time.monotonic()))
+
+    def read_timeout(self) -> Optional[float]:
+        return self._cap(self.policy.idle)
+
+
+def phase_of(exc: BaseException, read_phase: str = 'idle') -> Optional[str]:
+    """把异常归类为超时阶段；不是超时时返回 None。read_phase 为此时读超时对应的阶段"""
+    if isinstance(exc, UpstreamTimeout):
+        return exc.phase
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return 'connect'
+    if isinstance(exc, requests.exceptions.ReadTimeout):
+        return read_phase
+    text = f"{type(exc).__name__} {exc}".lower()
+    if 'timed out' in text or 'timeout' in text:
+        return read_phase
+    return None
+
+
+def set_read_timeout(resp, timeout: Optional[float]) -> None:
+    """修改已建立连接的 socket 读超时（requests 流式响应）"""
+    sock = getattr(getattr(resp.raw, 'connection', None), 'sock', None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+def paced(chunks, resp, deadline: Deadline):
+    """
+    逐块转发响应体：设置 total 时每块之后按剩余时间收紧读超时；
+    读超时转换为 UpstreamTimeout(route, 'idle' / 'total')。
+    """
+    try:
+        for chunk in chunks:
+            yield chunk
+            if deadline.expires is not None:
+                set_read_timeout(resp, deadline.read_timeout())
+    except UpstreamTimeout:
+        raise
+    except Exception as e:
+        phase = phase_of(e)
+        if phase is None:
+            raise
+        if phase == 'idle' and deadline.remaining() is not None and deadline.remaining() <= 0:
+            phase = 'total'
+        raise UpstreamTimeout(deadline.route, phase) from e
+
+
+_counts: Dict[Tuple[str, str], int] = {}
+_counts_lock = threading.Lock()
+
+
+def record(route: str, phase: str) -> None:
+    with _counts_lock:
+        _counts[(route, phase)] = _counts.get((route, phase), 0) + 1
+    logger.info(f"Upstream timeout: route={route} phase={phase}")
+
+
+def note(route: str, exc: BaseException, read_phase: str = 'ttfb') -> Optional[str]:
+    """异常是超时时计入统计并返回阶段"""
+    phase = phase_of(exc, read_phase)
+    if phase:
+        record(route, phase)
+    return phase
+
+
+def snapshot() -> dict:
+    routes = sorted(set(DEFAULTS) | {r for r, _ in _counts})
+    with _counts_lock:
+        counts = {route: {phase: _counts.get((route, phase), 0) for phase in PHASES} for route in routes}
+    return {
+        'policies': {route: policy(route).as_dict() for route in DEFAULTS},
+        'model_overrides': {k[6:]: v for k, v in _overrides.items() if k.startswith('model:')},
+        'timeouts': counts,
+    }
@@ -8,37 +8,136 @@ zAI Token 获取工具
 
 import base64
 import json
-import argparse
+import logging
+import os
 import requests
 import re
 from typing import Optional, Dict, Any
 from urllib.parse import urlparse, parse_qs
-import webbrowser
 import time
 import threading
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+
+from logging_utils import StepTimer, configure_logging, login_context, mask
+from upstream_headers import get_pipeline
+import upstream_timeouts
+
+logger = logging.getLogger(__name__)
+
+# 按代理共享的连接池：多个 handler 复用 TLS 连接，但各自拥有独立的 cookie jar
+_adapter_lock = threading.Lock()
+_shared_adapters: Dict[Optional[str], HTTPAdapter] = {}
+
+
+def _get_shared_adapter(proxy: Optional[str] = None) -> HTTPAdapter:
+    with _adapter_lock:
+        adapter = _shared_adapters.get(proxy)
+        if adapter is None:
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+            _shared_adapters[proxy] = adapter
+        return adapter
+
+
+def default_headers(base_url: str) -> Dict[str, str]:
+    """模拟浏览器的默认请求头（同步/异步 handler 共用）"""
+    return {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.9',
+        'Referer': f'{base_url}/auth',
+        'Origin': base_url,
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+        'Sec-Fetch-Dest': 'document',
+        'Sec-Fetch-Mode': 'navigate',
+        'Sec-Fetch-Site': 'same-origin',
+        'Sec-Fetch-User': '?1',
+    }
+
+
+def is_zai_url(url: str, base_url: str) -> bool:
+    """url 是否指向 zai.is（base_url 的主机或其子域名）"""
+    host = urlparse(url).hostname
+    base = urlparse(base_url).hostname
+    return bool(host and base) and (host == base or host.endswith('.' + base))
+
+
+def oauth_request_headers(url: str, base_url: str, headers: Optional[Dict[str, str]] = None) -> Optional[Dict[str, str]]:
+    """
+    单次 OAuth 请求的附加请求头：只有发往 zai.is 的请求才合并上游请求头管线的固定部分
+    （ZAI_EXTRA_HEADERS 与 provider.static()，按 base_url 只计算一次），不会发送到 discord.com。
+    provider.derive(token) 以 zai.is 访问令牌为输入，登录时还没有令牌，不参与 OAuth。
+    """
+    if not is_zai_url(url, base_url):
+        return headers
+    return {**get_pipeline(f'oauth:{base_url}', bearer=False).static(), **(headers or {})}
+
+
+def parse_authorize_location(location: str) -> Optional[Dict[str, Any]]:
+    """解析 /oauth/discord/login 返回的 Discord 授权跳转地址"""
+    if 'discord.com' not in location:
+        return None
+    params = parse_qs(urlparse(location).query)
+    return {
+        'authorize_url': location,
+        'client_id': params.get('client_id', [''])[0],
+        'redirect_uri': params.get('redirect_uri', [''])[0],
+        'scope': params.get('scope', ['identify email'])[0],
+        'state': params.get('state', [''])[0]
+    }
+
+
+@lru_cache(maxsize=8)
+def super_properties(user_agent: str) -> str:
+    """构建 Discord 的 X-Super-Properties 请求头"""
+    return base64.b64encode(json.dumps({
+        "os": "Windows",
+        "browser": "Chrome",
+        "device": "",
+        "browser_user_agent": user_agent,
+    }).encode()).decode()
+
+
+def create_oauth_handler(base_url: str = "https://zai.is", proxy: Optional[str] = None) -> 'DiscordOAuthHandler':
+    """创建一个复用共享连接池的 handler（每次调用都是新的 cookie jar，适合单个账号使用）"""
+    return DiscordOAuthHandler(base_url, proxy=proxy, adapter=_get_shared_adapter(proxy))
+
 
 class DiscordOAuthHandler:
     """Discord OAuth 登录处理器"""
     
     # Discord API 端点
-    DISCORD_API_BASE = "https://discord.com/api/v9"
+    DISCORD_API_BASE = os.environ.get('DISCORD_API_BASE', "https://discord.com/api/v9")
     
-    def __init__(self, base_url: str = "https://zai.is"):
+    def __init__(self, base_url: str = "https://zai.is", proxy: Optional[str] = None,
+                 adapter: Optional[HTTPAdapter] = None):
         self.base_url = base_url
         self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Referer': f'{base_url}/auth',
-            'Origin': base_url,
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'same-origin',
-            'Sec-Fetch-User': '?1',
-        })
+        if adapter is not None:
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+        if proxy:
+            self.session.proxies = {'http': proxy, 'https': proxy}
+        self.session.headers.update(default_headers(base_url))
+        # 当前登录流程的总时限（backend_login 期间有效）
+        self._deadline: Optional[upstream_timeouts.Deadline] = None
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """所有 OAuth 请求都带分阶段超时（upstream_timeouts 的 oauth 策略），超时计入统计"""
+        deadline = self._deadline or upstream_timeouts.Deadline('oauth')
+        kwargs['headers'] = oauth_request_headers(url, self.base_url, kwargs.get('headers'))
+        try:
+            kwargs['timeout'] = deadline.request_timeout()
+            return self.session.request(method, url, **kwargs)
+        except Exception as e:
+            phase = upstream_timeouts.phase_of(e, 'ttfb')
+            if phase and phase != 'total' and deadline.remaining() is not None and deadline.remaining() <= 0:
+                # 读超时被收紧到了剩余总时长：记为 total
+                upstream_timeouts.record('oauth', 'total')
+                raise upstream_timeouts.UpstreamTimeout('oauth', 'total') from e
+            upstream_timeouts.note('oauth', e)
+            raise
     
     def get_oauth_login_url(self) -> str:
         """获取 Discord OAuth 登录 URL"""
@@ -52,96 +151,82 @@ class DiscordOAuthHandler:
             discord_token: Discord 账号的 token
             
         Returns:
-            包含 zai.is JWT token 的字典
+            包含 zai.is JWT token 的字典（附带 timings：各步骤耗时，毫秒）
         """
         if not discord_token or len(discord_token) < 20:
              return {'error': '无效的 Discord Token'}
 
-        print("\n[*] 开始后端 OAuth 登录流程...")
-        print(f"[*] Discord Token: {discord_token[:20]}...{discord_token[-10:]}")
-        
-        try:
-            # Step 1: 访问 OAuth 登录入口，获取 Discord 授权 URL
-            print("[1/5] 获取 Discord 授权 URL...")
-            oauth_info = self._get_discord_authorize_url()
-            if 'error' in oauth_info:
-                return oauth_info
-            
-            authorize_url = oauth_info['authorize_url']
-            client_id = oauth_info['client_id']
-            redirect_uri = oauth_info['redirect_uri']
-            state = oauth_info.get('state', '')
-            scope = oauth_info.get('scope', 'identify email')
-            
-            print(f"    Client ID: {client_id}")
-            print(f"    Redirect URI: {redirect_uri}")
-            print(f"    Scope: {scope}")
-            
-            # Step 2: 使用 Discord token 授权应用
-            print("[2/5] 授权应用...")
-            auth_result = self._authorize_discord_app(
-                discord_token, client_id, redirect_uri, scope, state
-            )
-            if 'error' in auth_result:
-                return auth_result
-            
-            callback_url = auth_result['callback_url']
-            print(f"    获取到回调 URL")
-            
-            # Step 3: 访问回调 URL 获取 token
-            print("[3/5] 处理 OAuth 回调...")
-            token_result = self._handle_oauth_callback(callback_url)
-            if 'error' in token_result:
+        with login_context():
+            timer = StepTimer(logger)
+            logger.debug("backend login start", extra={'fields': {'discord_token': mask(discord_token)}})
+            self._deadline = upstream_timeouts.Deadline('oauth')
+            try:
+                # Step 1: 访问 OAuth 登录入口，获取 Discord 授权 URL
+                with timer.step('authorize_url'):
+                    oauth_info = self._get_discord_authorize_url()
+                if 'error' in oauth_info:
+                    return self._login_failed(oauth_info, timer)
+
+                client_id = oauth_info['client_id']
+                redirect_uri = oauth_info['redirect_uri']
+                state = oauth_info.get('state', '')
+                scope = oauth_info.get('scope', 'identify email')
+                logger.debug("authorize params", extra={'fields': {
+                    'client_id': client_id, 'redirect_uri': redirect_uri, 'scope': scope}})
+
+                # Step 2: 使用 Discord token 授权应用
+                with timer.step('discord_authorize'):
+                    auth_result = self._authorize_discord_app(
+                        discord_token, client_id, redirect_uri, scope, state
+                    )
+                if 'error' in auth_result:
+                    return self._login_failed(auth_result, timer)
+
+                # Step 3: 访问回调 URL 获取 token
+                with timer.step('oauth_callback'):
+                    token_result = self._handle_oauth_callback(auth_result['callback_url'])
+                if 'error' in token_result:
+                    return self._login_failed(token_result, timer)
+
+                token_result['timings'] = timer.timings
+                logger.debug("backend login ok", extra={'fields': {'total_ms': timer.total_ms}})
                 return token_result
-            
-            print(f"[4/5] 成功获取 JWT Token!")
-            
-            return token_result
-            
-        except Exception as e:
-            return {'error': f'登录过程出错: {str(e)}'}
+
+            except Exception as e:
+                return self._login_failed({'error': f'登录过程出错: {str(e)}'}, timer)
+            finally:
+                self._deadline = None
+
+    def _login_failed(self, result: Dict[str, Any], timer: 'StepTimer') -> Dict[str, Any]:
+        result['timings'] = timer.timings
+        logger.info("backend login failed", extra={'fields': {'error': result.get('error'), 'total_ms': timer.total_ms}})
+        return result
     
     def _get_discord_authorize_url(self) -> Dict[str, Any]:
-        """获取 Discord 授权 URL 和参数"""
+        """获取 Discord 授权 URL 和参数（state 与 cookie 每次登录都不同，不缓存）"""
         try:
-            response = self.session.get(
-                self.get_oauth_login_url(),
+            response = self._request(
+                'GET', self.get_oauth_login_url(),
                 allow_redirects=False
             )
             
             if response.status_code in [301, 302, 303, 307, 308]:
-                location = response.headers.get('Location', '')
-                if 'discord.com' in location:
-                    parsed = urlparse(location)
-                    params = parse_qs(parsed.query)
-                    return {
-                        'authorize_url': location,
-                        'client_id': params.get('client_id', [''])[0],
-                        'redirect_uri': params.get('redirect_uri', [''])[0],
-                        'scope': params.get('scope', ['identify email'])[0],
-                        'state': params.get('state', [''])[0]
-                    }
+                info = parse_authorize_location(response.headers.get('Location', ''))
+                if info:
+                    return info
             return {'error': f'无法获取授权 URL，状态码: {response.status_code}'}
         except Exception as e:
             return {'error': f'获取授权 URL 失败: {str(e)}'}
-    
+
     def _authorize_discord_app(self, discord_token, client_id, redirect_uri, scope, state) -> Dict[str, Any]:
         """使用 Discord token 授权应用"""
         try:
             authorize_url = f"{self.DISCORD_API_BASE}/oauth2/authorize"
             
-            # 构建 super properties 
-            super_properties = base64.b64encode(json.dumps({
-                "os": "Windows",
-                "browser": "Chrome",
-                "device": "",
-                "browser_user_agent": self.session.headers['User-Agent'],
-            }).encode()).decode()
-            
             headers = {
                 'Authorization': discord_token,
                 'Content-Type': 'application/json',
-                'X-Super-Properties': super_properties,
+                'X-Super-Properties': super_properties(self.session.headers['User-Agent']),
             }
             
             params = {
@@ -159,8 +244,8 @@ class DiscordOAuthHandler:
                 'integration_type': 0
             }
             
-            response = self.session.post(
-                authorize_url,
+            response = self._request(
+                'POST', authorize_url,
                 headers=headers,
                 params=params,
                 json=payload
@@ -185,19 +270,16 @@ class DiscordOAuthHandler:
     def _handle_oauth_callback(self, callback_url: str) -> Dict[str, Any]:
         """处理 OAuth 回调，获取 JWT token"""
         try:
-            print(f"    回调 URL: {callback_url[:80]}...")
-            
-            response = self.session.get(callback_url, allow_redirects=False)
+            response = self._request('GET', callback_url, allow_redirects=False)
             
             max_redirects = 10
             for i in range(max_redirects):
-                print(f"    重定向 {i+1}: 状态码 {response.status_code}")
-                
                 if response.status_code not in [301, 302, 303, 307, 308]:
                     break
                 
                 location = response.headers.get('Location', '')
-                print(f"    Location: {location[:100]}...")
+                logger.debug("callback redirect", extra={'fields': {
+                    'hop': i + 1, 'status': response.status_code, 'location': urlparse(location).path}})
                 
                 # Check for token in URL
                 token = self._extract_token(location)
@@ -206,36 +288,31 @@ class DiscordOAuthHandler:
                 if location.startswith('/'):
                     location = f"{self.base_url}{location}"
                 
-                response = self.session.get(location, allow_redirects=False)
+                response = self._request('GET', location, allow_redirects=False)
             
             # Final check in URL
             final_url = response.url if hasattr(response, 'url') else ''
-            print(f"    最终 URL: {final_url}")
-            print(f"    最终状态码: {response.status_code}")
+            logger.debug("callback final", extra={'fields': {'status': response.status_code, 'path': urlparse(final_url).path}})
             
             token = self._extract_token(final_url)
             if token: return {'token': token}
             
-            # Check Cookies
-            print(f"    检查 Cookies...")
+            # Check Cookies（只记录 cookie 名称，不记录值）
             has_session = False
             for cookie in self.session.cookies:
-                print(f"      {cookie.name}: {str(cookie.value)[:50]}...")
                 if cookie.name == 'token':
                     return {'token': cookie.value}
                 if any(x in cookie.name.lower() for x in ['session', 'auth', 'id', 'user']):
                     has_session = True
+            logger.debug("callback cookies", extra={'fields': {'cookies': [c.name for c in self.session.cookies]}})
             
             # Session Fallback
             if has_session:
-                print(f"    [!] 尝试 Session 验证...")
                 user_info = self._verify_session()
-                print(f"    [*] Session 验证结果: {user_info}")
                 if user_info and not user_info.get('error'):
-                    print(f"    [+] Session 验证成功！用户: {user_info.get('name', 'Unknown')}")
+                    logger.debug("session auth ok", extra={'fields': {'user': user_info.get('name', 'Unknown')}})
                     return {'token': 'SESSION_AUTH', 'user_info': user_info}
-                else:
-                    print(f"    [-] Session 验证失败或没有找到有效的session")
+                logger.debug("session auth failed")
 
             return {'error': '未能从回调中获取 token'}
             
@@ -258,27 +335,22 @@ class DiscordOAuthHandler:
         Returns:
             包含 zai.is JWT token 的字典
         """
-        print("\n[*] 开始 OAuth 浏览器登录流程...")
+        logger.info("oauth browser login start")
         
         try:
             # Step 1: 获取 OAuth 登录 URL
-            print("[1/3] 获取 Discord 授权 URL...")
             oauth_info = self._get_discord_authorize_url()
             if 'error' in oauth_info:
                 return oauth_info
             
             authorize_url = oauth_info['authorize_url']
-            print(f"    授权 URL: {authorize_url[:80]}...")
             
-            # Step 2: 在浏览器中打开授权 URL
-            print("[2/3] 在浏览器中打开授权页面...")
-            print("    请在浏览器中完成 Discord 登录授权")
+            # Step 2: 在浏览器中打开授权 URL（只有命令行流程用到，按需导入）
+            import webbrowser
+            print("请在浏览器中完成 Discord 登录授权，系统将自动检测...")
             webbrowser.open(authorize_url)
             
             # Step 3: 等待用户完成授权并检查结果
-            print("[3/3] 等待授权完成...")
-            print("    请在浏览器中完成授权，系统将自动检测...")
-            
             # 创建一个标志来停止检查
             stop_checking = threading.Event()
             result = {'error': '授权超时'}
@@ -293,7 +365,7 @@ class DiscordOAuthHandler:
                     # 检查 session 状态
                     user_info = self._verify_session()
                     if user_info and not user_info.get('error'):
-                        print(f"\n[+] 授权成功！用户: {user_info.get('name', 'Unknown')}")
+                        logger.info("oauth browser login ok", extra={'fields': {'user': user_info.get('name', 'Unknown')}})
                         result = {
                             'token': 'SESSION_AUTH',
                             'user_info': user_info,
@@ -305,7 +377,7 @@ class DiscordOAuthHandler:
                     # 检查是否有 token cookie
                     for cookie in self.session.cookies:
                         if cookie.name == 'token':
-                            print(f"\n[+] 获取到 JWT Token!")
+                            logger.info("oauth browser login got token cookie")
                             result = {
                                 'token': cookie.value,
                                 'source': 'oauth_browser'
@@ -316,7 +388,7 @@ class DiscordOAuthHandler:
                     time.sleep(check_interval)
                 
                 if not stop_checking.is_set():
-                    print("\n[-] 授权超时，请重试")
+                    logger.info("oauth browser login timed out")
             
             # 在后台线程中检查授权状态
             check_thread = threading.Thread(target=check_auth_status)
@@ -333,29 +405,25 @@ class DiscordOAuthHandler:
 
     def _verify_session(self) -> Optional[Dict]:
         try:
-            print(f"    [*] 调用 API: {self.base_url}/api/v1/auths/")
-            resp = self.session.get(
-                f"{self.base_url}/api/v1/auths/",
-                headers={'Accept': 'application/json'},
-                timeout=10  # 添加超时设置
+            resp = self._request(
+                'GET', f"{self.base_url}/api/v1/auths/",
+                headers={'Accept': 'application/json'}
             )
-            print(f"    [*] API 响应状态码: {resp.status_code}")
+            logger.debug("verify session", extra={'fields': {'status': resp.status_code}})
             
             if resp.status_code == 200:
-                data = resp.json()
-                print(f"    [*] API 响应数据: {data}")
-                return data
-            else:
-                print(f"    [-] API 响应内容: {resp.text[:500]}...")
-                return None
+                return resp.json()
+            return None
         except requests.exceptions.Timeout as e:
-            print(f"    [!] API 请求超时: {str(e)}")
+            logger.info(f"verify session timed out: {e}")
             return None
         except Exception as e:
-            print(f"    [!] Session 验证出错: {str(e)}")
+            logger.info(f"verify session error: {e}")
             return None
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser(description='zAI Token 获取工具')
     subparsers = parser.add_subparsers(dest='command')
     
@@ -363,8 +431,10 @@ def main():
     backend_parser = subparsers.add_parser('backend-login', help='后端登录')
     backend_parser.add_argument('--discord-token', required=True, help='Discord Token')
     backend_parser.add_argument('--url', default='https://zai.is', help='Base URL')
+    backend_parser.add_argument('--verbose', action='store_true', help='输出每个登录步骤的调试日志')
     
     args = parser.parse_args()
+    configure_logging(level='DEBUG' if getattr(args, 'verbose', False) else 'WARNING', fmt='text')
     
     if args.command == 'backend-login':
         handler = DiscordOAuthHandler(args.url)
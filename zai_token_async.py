@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+zAI Token 获取工具（异步版本）
+与 zai_token.DiscordOAuthHandler 提供相同的接口，基于 aiohttp，
+可在同一个事件循环中并发执行大量登录。
+bench/login_bench.py 在本地 fake zai.is 上对比 backend_login_many 与同步线程池的批量登录。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional, Dict, Any, List
+
+import aiohttp
+
+from logging_utils import StepTimer, login_context, mask
+import upstream_timeouts
+from zai_token import (
+    DiscordOAuthHandler,
+    default_headers,
+    oauth_request_headers,
+    parse_authorize_location,
+    super_properties,
+)
+
+logger = logging.getLogger(__name__)
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class AsyncDiscordOAuthHandler:
+    """Discord OAuth 登录处理器（异步）
+
+    用法：
+        async with AsyncDiscordOAuthHandler(connector=shared_connector) as handler:
+            result = await handler.backend_login(discord_token)
+
+    传入共享的 aiohttp.TCPConnector 可复用连接；每个 handler 始终使用独立的 cookie jar。
+    """
+
+    DISCORD_API_BASE = DiscordOAuthHandler.DISCORD_API_BASE
+
+    # 与同步版本共用的无 I/O 逻辑
+    get_oauth_login_url = DiscordOAuthHandler.get_oauth_login_url
+    _extract_token = DiscordOAuthHandler._extract_token
+    _login_failed = DiscordOAuthHandler._login_failed
+
+    def __init__(self, base_url: str = "https://zai.is", proxy: Optional[str] = None,
+                 connector: Optional[aiohttp.BaseConnector] = None):
+        self.base_url = base_url
+        self.proxy = proxy
+        self.headers = default_headers(base_url)
+        self._connector = connector
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> 'AsyncDiscordOAuthHandler':
+        self._ensure_session()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            policy = upstream_timeouts.policy('oauth')
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                # 单次请求的分阶段超时；整个登录流程的 total 由 backend_login 控制
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=policy.connect,
+                                              sock_read=max(policy.ttfb or 0, policy.idle or 0) or None),
+                connector=self._connector,
+                connector_owner=self._connector is None,
+                # unsafe=True 允许 IP 形式的 host 保存 cookie（自建/本地上游）
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def backend_login(self, discord_token: str) -> Dict[str, Any]:
+        """
+        纯后端 Discord OAuth 登录
+
+        Args:
+            discord_token: Discord 账号的 token
+
+        Returns:
+            包含 zai.is JWT token 的字典（附带 timings：各步骤耗时，毫秒）
+        """
+        if not discord_token or len(discord_token) < 20:
+            return {'error': '无效的 Discord Token'}
+
+        with login_context():
+            timer = StepTimer(logger)
+            logger.debug("backend login start", extra={'fields': {'discord_token': mask(discord_token)}})
+            try:
+                # 整个登录流程的总时限（upstream_timeouts 的 oauth.total）
+                return await asyncio.wait_for(self._backend_login_steps(discord_token, timer),
+                                              upstream_timeouts.policy('oauth').total)
+            except asyncio.TimeoutError:
+                upstream_timeouts.record('oauth', 'total')
+                return self._login_failed({'error': '登录超时'}, timer)
+            except Exception as e:
+                return self._login_failed({'error': f'登录过程出错: {str(e)}'}, timer)
+
+    async def _backend_login_steps(self, discord_token: str, timer: StepTimer) -> Dict[str, Any]:
+        with timer.step('authorize_url'):
+            oauth_info = await self._get_discord_authorize_url()
+        if 'error' in oauth_info:
+            return self._login_failed(oauth_info, timer)
+
+        with timer.step('discord_authorize'):
+            auth_result = await self._authorize_discord_app(
+                discord_token,
+                oauth_info['client_id'],
+                oauth_info['redirect_uri'],
+                oauth_info.get('scope', 'identify email'),
+                oauth_info.get('state', '')
+            )
+        if 'error' in auth_result:
+            return self._login_failed(auth_result, timer)
+
+        with timer.step('oauth_callback'):
+            token_result = await self._handle_oauth_callback(auth_result['callback_url'])
+        if 'error' in token_result:
+            return self._login_failed(token_result, timer)
+
+        token_result['timings'] = timer.timings
+        logger.debug("backend login ok", extra={'fields': {'total_ms': timer.total_ms}})
+        return token_result
+
+    async def _get_discord_authorize_url(self) -> Dict[str, Any]:
+        """获取 Discord 授权 URL 和参数"""
+        session = self._ensure_session()
+        try:
+            url = self.get_oauth_login_url()
+            async with session.get(url, allow_redirects=False, proxy=self.proxy,
+                                   headers=oauth_request_headers(url, self.base_url)) as response:
+                if response.status in REDIRECT_STATUSES:
+                    info = parse_authorize_location(response.headers.get('Location', ''))
+                    if info:
+                        return info
+                return {'error': f'无法获取授权 URL，状态码: {response.status}'}
+        except Exception as e:
+            upstream_timeouts.note('oauth', e)
+            return {'error': f'获取授权 URL 失败: {str(e)}'}
+
+    async def _authorize_discord_app(self, discord_token, client_id, redirect_uri, scope, state) -> Dict[str, Any]:
+        """使用 Discord token 授权应用"""
+        session = self._ensure_session()
+        try:
+            headers = {
+                'Authorization': discord_token,
+                'Content-Type': 'application/json',
+                'X-Super-Properties': super_properties(self.headers['User-Agent']),
+            }
+            params = {
+                'client_id': client_id,
+                'response_type': 'code',
+                'redirect_uri': redirect_uri,
+                'scope': scope,
+            }
+            if state:
+                params['state'] = state
+            payload = {
+                'permissions': '0',
+                'authorize': True,
+                'integration_type': 0
+            }
+
+            url = f"{self.DISCORD_API_BASE}/oauth2/authorize"
+            async with session.post(
+                url,
+                headers=oauth_request_headers(url, self.base_url, headers),
+                params=params,
+                json=payload,
+                proxy=self.proxy
+            ) as response:
+                if response.status == 200:
+                    try:
+                        data = await response.json(content_type=None)
+                        location = data.get('location', '')
+                        if location:
+                            if location.startswith('/'):
+                                location = f"{self.base_url}{location}"
+                            return {'callback_url': location}
+                    except Exception:
+                        pass
+                return {'error': f'授权失败 (状态码: {response.status})'}
+        except Exception as e:
+            upstream_timeouts.note('oauth', e)
+            return {'error': f'授权过程出错: {str(e)}'}
+
+    async def _handle_oauth_callback(self, callback_url: str) -> Dict[str, Any]:
+        """处理 OAuth 回调，获取 JWT token"""
+        session = self._ensure_session()
+        try:
+            url = callback_url
+            status = None
+            for _ in range(10):
+                async with session.get(url, allow_redirects=False, proxy=self.proxy,
+                                       headers=oauth_request_headers(url, self.base_url)) as response:
+                    status = response.status
+                    location = response.headers.get('Location', '')
+                    final_url = str(response.url)
+                if status not in REDIRECT_STATUSES:
+                    break
+
+                token = self._extract_token(location)
+                if token:
+                    return {'token': token}
+                if location.startswith('/'):
+                    location = f"{self.base_url}{location}"
+                url = location
+
+            token = self._extract_token(final_url)
+            if token:
+                return {'token': token}
+
+            has_session = False
+            for cookie in session.cookie_jar:
+                if cookie.key == 'token':
+                    return {'token': cookie.value}
+                if any(x in cookie.key.lower() for x in ['session', 'auth', 'id', 'user']):
+                    has_session = True
+
+            if has_session:
+                user_info = await self._verify_session()
+                if user_info and not user_info.get('error'):
+                    return {'token': 'SESSION_AUTH', 'user_info': user_info}
+
+            return {'error': '未能从回调中获取 token'}
+        except Exception as e:
+            upstream_timeouts.note('oauth', e)
+            return {'error': f'处理回调失败: {str(e)}'}
+
+    async def oauth_login_with_browser(self, max_wait: float = 120, check_interval: float = 2) -> Dict[str, Any]:
+        """
+        通过浏览器进行 OAuth 登录（异步轮询 session 状态，不占用线程）
+
+        Returns:
+            包含 zai.is JWT token 的字典
+        """
+        try:
+            oauth_info = await self._get_discord_authorize_url()
+            if 'error' in oauth_info:
+                return oauth_info
+
+            import webbrowser
+            webbrowser.open(oauth_info['authorize_url'])
+
+            session = self._ensure_session()
+            deadline = time.monotonic() + max_wait
+            while time.monotonic() < deadline:
+                user_info = await self._verify_session()
+                if user_info and not user_info.get('error'):
+                    return {'token': 'SESSION_AUTH', 'user_info': user_info, 'source': 'oauth_browser'}
+                for cookie in session.cookie_jar:
+                    if cookie.key == 'token':
+                        return {'token': cookie.value, 'source': 'oauth_browser'}
+                await asyncio.sleep(check_interval)
+            return {'error': '授权超时'}
+        except Exception as e:
+            return {'error': f'OAuth 浏览器登录出错: {str(e)}'}
+
+    async def _verify_session(self) -> Optional[Dict]:
+        session = self._ensure_session()
+        try:
+            url = f"{self.base_url}/api/v1/auths/"
+            async with session.get(
+                url,
+                headers=oauth_request_headers(url, self.base_url, {'Accept': 'application/json'}),
+                proxy=self.proxy
+            ) as resp:
+                if resp.status == 200:
+                    return await resp.json(content_type=None)
+                return None
+        except Exception as e:
+            upstream_timeouts.note('oauth', e)
+            return None
+
+
+async def backend_login_many(discord_tokens: List[str], base_url: str = "https://zai.is",
+                             proxy: Optional[str] = None, concurrency: int = 50) -> List[Dict[str, Any]]:
+    """在一个事件循环里并发执行多次登录，结果顺序与输入一致；共享连接池，cookie 按账号隔离。"""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    connector = aiohttp.TCPConnector(limit=max(1, concurrency))
+
+    async def login_one(discord_token: str) -> Dict[str, Any]:
+        async with semaphore:
+            async with AsyncDiscordOAuthHandler(base_url, proxy=proxy, connector=connector) as handler:
+                return await handler.backend_login(discord_token)
+
+    try:
+        return await asyncio.gather(*(login_one(t) for t in discord_tokens))
+    finally:
+        await connector.close()
@@ -9,12 +9,26 @@ zAI Token 获取并推送到newapi
 import base64
 import json
 import argparse
+import logging
 import os
 import requests
 import re
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any, List
 from urllib.parse import urlparse, parse_qs
+from requests.adapters import HTTPAdapter
+
+try:
+    from newapi_channels import NewAPIClient, parse_channels, shard_tokens, split_keys
+except ImportError:
+    # 在仓库内运行时使用上一级目录的共享模块（单独部署时把 newapi_channels.py 复制到本目录）
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from newapi_channels import NewAPIClient, parse_channels, shard_tokens, split_keys
+
+# 所有账号共享连接池（复用 TLS 连接），cookie 仍按 handler（账号）隔离
+_shared_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
 
 class DiscordOAuthHandler:
     """Discord OAuth 登录处理"""
@@ -22,9 +36,12 @@ class DiscordOAuthHandler:
     # Discord API 端点
     DISCORD_API_BASE = "https://discord.com/api/v9"
     
-    def __init__(self, base_url: str = "https://zai.is"):
+    def __init__(self, base_url: str = "https://zai.is", verbose: bool = True):
         self.base_url = base_url
+        self.verbose = verbose
         self.session = requests.Session()
+        self.session.mount('https://', _shared_adapter)
+        self.session.mount('http://', _shared_adapter)
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
@@ -39,6 +56,10 @@ class DiscordOAuthHandler:
             'Sec-Fetch-User': '?1',
         })
     
+    def _log(self, *args) -> None:
+        if self.verbose:
+            print(*args)
+
     def get_oauth_login_url(self) -> str:
         """获取 Discord OAuth 登录 URL"""
         return f"{self.base_url}/oauth/discord/login"
@@ -56,12 +77,12 @@ class DiscordOAuthHandler:
         if not discord_token or len(discord_token) < 20:
              return {'error': '无效的 Discord Token'}
 
-        print("\n[*] 开始后端 OAuth 登录流程...")
-        print(f"[*] Discord Token: {discord_token[:20]}...{discord_token[-10:]}")
+        self._log("\n[*] 开始后端 OAuth 登录流程...")
+        self._log(f"[*] Discord Token: {discord_token[:20]}...{discord_token[-10:]}")
         
         try:
             # Step 1: 访问 OAuth 登录入口，获取 Discord 授权 URL
-            print("[1/5] 获取 Discord 授权 URL...")
+            self._log("[1/5] 获取 Discord 授权 URL...")
             oauth_info = self._get_discord_authorize_url()
             if 'error' in oauth_info:
                 return oauth_info
@@ -72,12 +93,12 @@ class DiscordOAuthHandler:
             state = oauth_info.get('state', '')
             scope = oauth_info.get('scope', 'identify email')
             
-            print(f"    Client ID: {client_id}")
-            print(f"    Redirect URI: {redirect_uri}")
-            print(f"    Scope: {scope}")
+            self._log(f"    Client ID: {client_id}")
+            self._log(f"    Redirect URI: {redirect_uri}")
+            self._log(f"    Scope: {scope}")
             
             # Step 2: 使用 Discord token 授权应用
-            print("[2/5] 授权应用...")
+            self._log("[2/5] 授权应用...")
             auth_result = self._authorize_discord_app(
                 discord_token, client_id, redirect_uri, scope, state
             )
@@ -85,15 +106,15 @@ class DiscordOAuthHandler:
                 return auth_result
             
             callback_url = auth_result['callback_url']
-            print(f"    获取到回调 URL")
+            self._log(f"    获取到回调 URL")
             
             # Step 3: 访问回调 URL 获取 token
-            print("[3/5] 处理 OAuth 回调...")
+            self._log("[3/5] 处理 OAuth 回调...")
             token_result = self._handle_oauth_callback(callback_url)
             if 'error' in token_result:
                 return token_result
             
-            print(f"[4/5] 成功获取 JWT Token!")
+            self._log(f"[4/5] 成功获取 JWT Token!")
             
             return token_result
             
@@ -184,19 +205,19 @@ class DiscordOAuthHandler:
     def _handle_oauth_callback(self, callback_url: str) -> Dict[str, Any]:
         """处理 OAuth 回调，获取 JWT token"""
         try:
-            print(f"    回调 URL: {callback_url[:80]}...")
+            self._log(f"    回调 URL: {callback_url[:80]}...")
             
             response = self.session.get(callback_url, allow_redirects=False)
             
             max_redirects = 10
             for i in range(max_redirects):
-                print(f"    重定向 {i+1}: 状态码 {response.status_code}")
+                self._log(f"    重定向 {i+1}: 状态码 {response.status_code}")
                 
                 if response.status_code not in [301, 302, 303, 307, 308]:
                     break
                 
                 location = response.headers.get('Location', '')
-                print(f"    Location: {location[:100]}...")
+                self._log(f"    Location: {location[:100]}...")
                 
                 # Check for token in URL
                 token = self._extract_token(location)
@@ -209,17 +230,17 @@ class DiscordOAuthHandler:
             
             # Final check in URL
             final_url = response.url if hasattr(response, 'url') else ''
-            print(f"    最终 URL: {final_url}")
-            print(f"    最终状态码: {response.status_code}")
+            self._log(f"    最终 URL: {final_url}")
+            self._log(f"    最终状态码: {response.status_code}")
             
             token = self._extract_token(final_url)
             if token: return {'token': token}
             
             # Check Cookies
-            print(f"    检查 Cookies...")
+            self._log(f"    检查 Cookies...")
             has_session = False
             for cookie in self.session.cookies:
-                print(f"      {cookie.name}: {str(cookie.value)[:50]}...")
+                self._log(f"      {cookie.name}: {str(cookie.value)[:50]}...")
                 if cookie.name == 'token':
                     return {'token': cookie.value}
                 if any(x in cookie.name.lower() for x in ['session', 'auth', 'id', 'user']):
@@ -227,10 +248,10 @@ class DiscordOAuthHandler:
             
             # Session Fallback
             if has_session:
-                print(f"    [!] 尝试 Session 验证...")
+                self._log(f"    [!] 尝试 Session 验证...")
                 user_info = self._verify_session()
                 if user_info and not user_info.get('error'):
-                    print(f"    [+] Session 验证成功！用户: {user_info.get('name', 'Unknown')}")
+                    self._log(f"    [+] Session 验证成功！用户: {user_info.get('name', 'Unknown')}")
                     return {'token': 'SESSION_AUTH', 'user_info': user_info}
 
             return {'error': '未能从回调中获取 token'}
@@ -255,123 +276,89 @@ class DiscordOAuthHandler:
         return None
 
 
-class NewAPITokenManager:
+class NewAPITokenManager(NewAPIClient):
     """
     NewAPI 渠道 token 管理
     参考接口文档: https://apifox.newapi.ai/llms.txt
     接口路径: /api/channel/
-    """
-
-    def __init__(self, base_url: str, api_key: str, user_id: str = "1"):
-        self.base_url = base_url.rstrip("/")
-        self.api_key = api_key
-        self.user_id = user_id
-        self.session = requests.Session()
-        self.session.headers.update({
-            "New-Api-User": str(user_id),
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        })
-
-    def get_channel(self, channel_id: str) -> Optional[Dict[str, Any]]:
-        """获取渠道信息 GET /api/channel/{id}"""
-        url = f"{self.base_url}/api/channel/{channel_id}"
-        resp = self.session.get(url)
-        if resp.status_code == 200:
-            try:
-                data = resp.json()
-                if isinstance(data, dict):
-                    if "data" in data:
-                        return data.get("data")
-                    return data
-            except Exception as exc:
-                print(f"[NewAPI] 解析渠道信息失败: {exc}")
-        else:
-            print(f"[NewAPI] 获取渠道失败: {resp.status_code} {resp.text}")
-        return None
 
-    def update_channel(self, channel_data: Dict[str, Any]) -> bool:
-        """更新渠道 PUT /api/channel/"""
-        url = f"{self.base_url}/api/channel/"
-        resp = self.session.put(url, json=channel_data)
-        if resp.status_code in (200, 201):
-            print(f"[NewAPI] 更新渠道成功")
-            return True
-        print(f"[NewAPI] 更新渠道失败: {resp.status_code} {resp.text}")
-        return False
+    渠道读写（修改前总是重新 GET 渠道文档再 PUT）由 newapi_channels.NewAPIClient 实现，
+    这里保留命令行使用的便捷操作。
+    """
 
     def get_channel_keys(self, channel_id: str) -> List[str]:
         """获取渠道当前的 key 列表"""
         channel = self.get_channel(channel_id)
         if not channel:
             return []
-        key_str = channel.get("key", "")
-        if not key_str:
-            return []
-        return [k.strip() for k in key_str.split("\n") if k.strip()]
+        return split_keys(channel.get("key"))
 
     def clear_channel_tokens(self, channel_id: str) -> None:
         """清空渠道的所有 key"""
-        channel = self.get_channel(channel_id)
-        if not channel:
-            print("[NewAPI] 无法获取渠道信息，跳过清理")
-            return
-
-        old_keys = channel.get("key", "")
-        if not old_keys or not old_keys.strip():
-            print("[NewAPI] 渠道当前无 key")
-            return
-
-        key_count = len([k for k in old_keys.split("\n") if k.strip()])
-        print(f"[NewAPI] 准备清空渠道 {key_count} 个旧 key ...")
+        def build(old_keys: List[str]) -> Optional[List[str]]:
+            if not old_keys:
+                print("[NewAPI] 渠道当前无 key")
+                return None
+            print(f"[NewAPI] 准备清空渠道 {len(old_keys)} 个旧 key ...")
+            return []
 
-        channel["key"] = ""
-        if self.update_channel(channel):
+        result = self.modify_keys(channel_id, build)
+        if result:
             print(f"[NewAPI] 已清空渠道旧 key")
-        else:
+        elif result is False:
             print(f"[NewAPI] 清空渠道旧 key 失败")
 
     def push_tokens(self, channel_id: str, tokens: List[str]) -> bool:
         """推送多个 token 到渠道（替换原有 key）"""
-        channel = self.get_channel(channel_id)
-        if not channel:
-            print("[NewAPI] 无法获取渠道信息，推送失败")
-            return False
-
-        channel["key"] = "\n".join(tokens)
-        if self.update_channel(channel):
+        if self.modify_keys(channel_id, lambda old_keys: list(tokens)):
             print(f"[NewAPI] 推送 {len(tokens)} 个 token 成功")
             return True
         return False
 
-    def create_token(self, channel_id: str, token: str, expires_in: int = 10800) -> bool:
-        """添加单个 token（追加到现有 key）"""
-        channel = self.get_channel(channel_id)
-        if not channel:
-            print("[NewAPI] 无法获取渠道信息，推送失败")
-            return False
+    def sync_keys(self, channel_id: str, tokens: List[str]) -> Optional[bool]:
+        """
+        按差异同步渠道 key：key 集合不变时不发送 PUT。
+        返回 True=已更新，None=无变化，False=失败
+        """
+        result = super().sync_keys(channel_id, tokens)
+        if result is None:
+            print(f"[NewAPI] 渠道 {channel_id} key 无变化，跳过更新")
+        elif result is False:
+            print(f"[NewAPI] 渠道 {channel_id} 同步失败")
+        return result
 
-        old_key = channel.get("key", "") or ""
-        # 追加新 token
-        if old_key.strip():
-            channel["key"] = old_key.strip() + "\n" + token
-        else:
-            channel["key"] = token
+    sync_tokens = sync_keys
 
-        if self.update_channel(channel):
+    def create_token(self, channel_id: str, token: str, expires_in: int = 10800) -> bool:
+        """添加单个 token（追加到现有 key）"""
+        if self.modify_keys(channel_id, lambda old_keys: old_keys + [token]):
             print(f"[NewAPI] 推送 token 成功: {token[:8]}...{token[-6:]}")
             return True
         print(f"[NewAPI] 推送 token 失败")
         return False
 
 
+def _parse_channels(cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    解析目标渠道：newapi_channels 可以是 ID 列表，或 {"id", "tier", "max_keys"} 对象列表；
+    未配置时回退到单个 newapi_channel_id
+    """
+    raw = cfg.get("newapi_channels")
+    if raw:
+        return parse_channels(raw)
+    channel_id = cfg.get("newapi_channel_id") or cfg.get("channel_id")
+    return parse_channels([channel_id]) if channel_id else []
+
+
 def _load_discord_tokens(single_token: Optional[str] = None,
                          token_file: Optional[str] = None,
-                         token_list: Optional[List[str]] = None) -> List[str]:
+                         token_list: Optional[List[Any]] = None) -> List[str]:
     tokens: List[str] = []
     if token_list:
         for t in token_list:
+            # 支持 {"token": "...", "tier": "..."} 形式
+            if isinstance(t, dict):
+                t = t.get("token")
             if t:
                 tokens.append(t.strip())
     if single_token:
@@ -394,6 +381,15 @@ def _load_discord_tokens(single_token: Optional[str] = None,
     return uniq
 
 
+def _token_tiers(token_list: Optional[List[Any]]) -> Dict[str, str]:
+    """从 discord_tokens 中的 {"token", "tier"} 对象读取账号 tier"""
+    tiers: Dict[str, str] = {}
+    for item in token_list or []:
+        if isinstance(item, dict) and item.get("token") and item.get("tier"):
+            tiers[item["token"].strip()] = str(item["tier"])
+    return tiers
+
+
 def _load_config(config_path: str) -> Dict[str, Any]:
     if not os.path.exists(config_path):
         print(f"[!] 未找到配置文件: {config_path}")
@@ -406,40 +402,312 @@ def _load_config(config_path: str) -> Dict[str, Any]:
         return {}
 
 
-def convert_and_push(discord_tokens: List[str], zai_url: str, newapi_base: str, newapi_key: str, channel_id: str, expires_in: int, user_id: str = "1") -> None:
+def _jwt_exp(token: str) -> Optional[int]:
+    """读取 JWT payload 中的 exp（不校验签名）"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return int(exp) if exp else None
+    except Exception:
+        return None
+
+
+def _login_one(d_token: str, zai_url: str) -> Dict[str, Any]:
+    # 每个账号使用独立的 handler / cookie jar，避免账号之间串 cookie
+    return DiscordOAuthHandler(zai_url, verbose=False).backend_login(d_token)
+
+
+def convert_tokens(discord_tokens: List[str], zai_url: str, concurrency: int = 4,
+                   cache: Optional[Dict[str, str]] = None, min_valid_seconds: int = 0) -> Dict[str, str]:
+    """
+    并发把 Discord token 转换为 zAI token，返回按输入顺序排列的 {discord_token: zai_token}。
+    cache 为 {discord_token: zai_token}，其中 exp 距今仍大于 min_valid_seconds 的直接复用，不再登录。
+    """
+    cache = cache if cache is not None else {}
+    now = time.time()
+    results: Dict[str, str] = {}
+    pending: List[str] = []
+    for d_token in discord_tokens:
+        cached = cache.get(d_token)
+        exp = _jwt_exp(cached) if cached else None
+        if exp and exp - now > min_valid_seconds:
+            results[d_token] = cached
+        else:
+            pending.append(d_token)
+
+    print(f"[*] 复用 {len(results)} 个仍有效的 token，需登录 {len(pending)} 个（并发 {concurrency}）")
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            outcomes = pool.map(lambda t: _login_one(t, zai_url), pending)
+            for idx, (d_token, res) in enumerate(zip(pending, outcomes), start=1):
+                prefix = f"[{idx}/{len(pending)}] {d_token[:12]}..."
+                if res.get('error'):
+                    print(f"{prefix} 转换失败: {res['error']}")
+                    continue
+                token_val = res.get('token')
+                if not token_val or token_val == 'SESSION_AUTH':
+                    print(f"{prefix} 未获取到有效的 zAI token，已跳过")
+                    continue
+                results[d_token] = token_val
+                cache[d_token] = token_val
+                print(f"{prefix} 转换成功，获得 token: {token_val[:12]}...{token_val[-8:]}")
+
+    # 清理已不在配置中的账号
+    configured = set(discord_tokens)
+    for d_token in list(cache):
+        if d_token not in configured:
+            cache.pop(d_token, None)
+    return {t: results[t] for t in discord_tokens if t in results}
+
+
+def push_sharded(manager: NewAPITokenManager, pairs: List[tuple], channels: List[Dict[str, Any]],
+                 strategy: str = "count", tiers: Optional[Dict[str, str]] = None) -> Dict[str, Optional[bool]]:
+    """按分片策略把 token 分配到各渠道并并发同步，返回 {channel_id: sync 结果}"""
+    # pairs 为 (discord_token, zai_token)，tier 按 Discord 账号配置
+    items = [(zai, (tiers or {}).get(d_token)) for d_token, zai in pairs]
+    assignments = shard_tokens(items, channels, strategy)
+    if len(assignments) > 1:
+        print(f"[*] 分片（{strategy}）: " + ", ".join(f"渠道 {cid}={len(t)}" for cid, t in assignments.items()))
+    return manager.sync_channels(assignments)
+
+
+def convert_and_push(discord_tokens: List[str], zai_url: str, newapi_base: str, newapi_key: str,
+                     channel_id: Optional[str] = None, expires_in: int = 10800, user_id: str = "1",
+                     concurrency: int = 4, cache: Optional[Dict[str, str]] = None, min_valid_seconds: int = 0,
+                     channels: Optional[List[Dict[str, Any]]] = None, shard_strategy: str = "count",
+                     tiers: Optional[Dict[str, str]] = None,
+                     manager: Optional[NewAPITokenManager] = None) -> None:
     if not discord_tokens:
         print("[!] 未提供 Discord Token，跳过本轮")
         return
+    if not channels:
+        channels = _parse_channels({"newapi_channel_id": channel_id})
 
     print(f"[*] 将处理 {len(discord_tokens)} 个 Discord Token")
-    handler = DiscordOAuthHandler(zai_url)
-
-    zai_tokens: List[str] = []
-    for idx, d_token in enumerate(discord_tokens, start=1):
-        print(f"\n==== {idx}/{len(discord_tokens)} 开始转换 ====")
-        res = handler.backend_login(d_token)
-        if res.get('error'):
-            print(f"[!] 转换失败: {res['error']}")
-            continue
-        token_val = res.get('token')
-        if not token_val or token_val == 'SESSION_AUTH':
-            print("[!] 未获取到有效的 zAI token，已跳过")
-            continue
-        zai_tokens.append(token_val)
-        print(f"[+] 转换成功，获得 token: {token_val[:12]}...{token_val[-8:]}")
+    converted = convert_tokens(discord_tokens, zai_url, concurrency, cache, min_valid_seconds)
 
-    if not zai_tokens:
+    if not converted:
         print("[!] 所有 Discord Token 均转换失败，停止推送")
         return
 
-    manager = NewAPITokenManager(newapi_base, newapi_key, user_id)
-    print(f"\n[*] 开始推送 {len(zai_tokens)} 个新 token 到渠道 {channel_id} (将替换旧 key)")
-    
-    # 一次性替换渠道的所有 key
-    if manager.push_tokens(channel_id, zai_tokens):
-        print(f"\n[+] 推送完成，成功 {len(zai_tokens)}/{len(zai_tokens)}")
+    manager = manager or NewAPITokenManager(newapi_base, newapi_key, user_id)
+    print(f"\n[*] 同步 {len(converted)} 个 token 到 {len(channels)} 个渠道")
+
+    # 只有 key 集合变化时才更新渠道
+    results = push_sharded(manager, list(converted.items()), channels, shard_strategy, tiers)
+    failed = [cid for cid, ok in results.items() if ok is False]
+    if failed:
+        print(f"\n[!] 推送失败的渠道: {', '.join(failed)}")
     else:
-        print(f"\n[!] 推送失败")
+        print(f"\n[+] 推送完成，有效 token {len(converted)}/{len(discord_tokens)}")
+
+
+def _settings_from_config(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    """把 JSON 配置整理为运行参数（兼容多种键名）"""
+    return {
+        "discord_tokens": _load_discord_tokens(
+            single_token=None,
+            token_file=cfg.get("discord_token_file"),
+            token_list=cfg.get("discord_tokens") or cfg.get("discord_token")
+        ),
+        "tiers": _token_tiers(cfg.get("discord_tokens")),
+        "zai_url": cfg.get("zai_url") or cfg.get("zai_base_url") or "https://zai.is",
+        "newapi_base": cfg.get("newapi_base") or cfg.get("newapi_base_url") or "https://91vip.futureppo.top",
+        "newapi_key": cfg.get("newapi_key") or cfg.get("system_token") or cfg.get("access_token"),
+        "channels": _parse_channels(cfg),
+        "shard_strategy": cfg.get("shard_strategy", "count"),
+        "user_id": str(cfg.get("newapi_user_id") or cfg.get("user_id") or "1"),
+        "expires_in": int(cfg.get("expires_in", 10800)),
+        "interval": int(cfg.get("update_interval", cfg.get("interval", 3600))),
+        "concurrency": int(cfg.get("concurrency", 4)),
+        "refresh_before": int(cfg.get("refresh_before", 600)),
+        "push_window": int(cfg.get("push_window", 30)),
+        "retry_after": int(cfg.get("retry_after", 300)),
+    }
+
+
+class TokenDaemon:
+    """
+    常驻模式：本地状态文件记录 {discord_token: {zai_token, exp}}，
+    每个账号只在自己的 token 临近过期时刷新；刷新结果在推送窗口内合并后统一同步到 NewAPI；
+    配置文件（及 discord_token_file）变化时才重新加载。
+    """
+
+    CONFIG_CHECK_INTERVAL = 5
+    MAX_SLEEP = 60
+
+    def __init__(self, config_path: str, state_path: str):
+        self.config_path = config_path
+        self.state_path = state_path
+        self.settings: Dict[str, Any] = {}
+        self.state: Dict[str, Dict[str, Any]] = self._load_state()
+        self._config_mtimes: Dict[str, float] = {}
+        self._last_config_check = 0.0
+        self._dirty = True  # 启动后先对齐一次渠道
+        self._dirty_since = 0.0
+        self._last_pushed: Optional[List[str]] = None
+        self.manager: Optional[NewAPITokenManager] = None
+
+    # --- 状态文件 ---
+    def _load_state(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except Exception as exc:
+            print(f"[!] 读取状态文件失败，将重新登录全部账号: {exc}")
+            return {}
+
+    def _save_state(self) -> None:
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # --- 配置热加载 ---
+    def _watched_files(self) -> List[str]:
+        files = [self.config_path]
+        token_file = (self.settings or {}).get("_token_file")
+        if token_file:
+            files.append(token_file)
+        return files
+
+    @staticmethod
+    def _file_mtimes(paths: List[str]) -> Dict[str, float]:
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = 0.0
+        return mtimes
+
+    def _reload_config_if_changed(self, now: float) -> bool:
+        if self.settings and now - self._last_config_check < self.CONFIG_CHECK_INTERVAL:
+            return True
+        self._last_config_check = now
+        if self.settings and self._file_mtimes(self._watched_files()) == self._config_mtimes:
+            return True
+
+        cfg = _load_config(self.config_path)
+        if not cfg:
+            return bool(self.settings)
+        settings = _settings_from_config(cfg)
+        settings["_token_file"] = cfg.get("discord_token_file")
+        if not settings["newapi_key"] or not settings["channels"]:
+            print("[!] 配置缺少 newapi_key 或 newapi_channel_id / newapi_channels")
+            return bool(self.settings)
+
+        print(f"[*] 已加载配置：{len(settings['discord_tokens'])} 个账号")
+        old = self.settings
+        if not old or (old["newapi_base"], old["newapi_key"], old["user_id"]) != \
+                (settings["newapi_base"], settings["newapi_key"], settings["user_id"]):
+            self.manager = NewAPITokenManager(settings["newapi_base"], settings["newapi_key"], settings["user_id"])
+        if old and (old["channels"], old["shard_strategy"], old["tiers"]) != \
+                (settings["channels"], settings["shard_strategy"], settings["tiers"]):
+            self._mark_dirty(now)
+        self.settings = settings
+        self._config_mtimes = self._file_mtimes(self._watched_files())
+
+        # 移除已从配置中删除的账号
+        configured = set(settings["discord_tokens"])
+        removed = [t for t in self.state if t not in configured]
+        for d_token in removed:
+            self.state.pop(d_token, None)
+        if removed:
+            self._mark_dirty(now)
+            self._save_state()
+        return True
+
+    # --- 刷新与推送 ---
+    def _next_refresh_at(self, entry: Optional[Dict[str, Any]]) -> float:
+        if not entry:
+            return 0.0
+        if entry.get("retry_at"):
+            return float(entry["retry_at"])
+        return float(entry.get("exp") or 0) - self.settings["refresh_before"]
+
+    def _mark_dirty(self, now: float) -> None:
+        if not self._dirty:
+            self._dirty_since = now
+        self._dirty = True
+
+    def _refresh_due(self, now: float) -> None:
+        due = [t for t in self.settings["discord_tokens"] if self._next_refresh_at(self.state.get(t)) <= now]
+        if not due:
+            return
+        print(f"[*] {len(due)} 个账号需要刷新（并发 {self.settings['concurrency']}）")
+        zai_url = self.settings["zai_url"]
+        with ThreadPoolExecutor(max_workers=max(1, self.settings["concurrency"])) as pool:
+            outcomes = list(pool.map(lambda t: _login_one(t, zai_url), due))
+
+        finished = time.time()
+        for d_token, res in zip(due, outcomes):
+            token_val = res.get("token")
+            if res.get("error") or not token_val or token_val == "SESSION_AUTH":
+                entry = self.state.setdefault(d_token, {})
+                entry["retry_at"] = finished + self.settings["retry_after"]
+                print(f"[!] {d_token[:12]}... 刷新失败: {res.get('error') or '未获取到有效的 zAI token'}")
+                continue
+            # JWT 没有 exp 时用配置的 expires_in 估算
+            exp = _jwt_exp(token_val) or int(finished + self.settings["expires_in"])
+            self.state[d_token] = {"zai_token": token_val, "exp": exp, "updated_at": int(finished)}
+            print(f"[+] {d_token[:12]}... 刷新成功，有效期至 {time.strftime('%H:%M:%S', time.localtime(exp))}")
+        self._mark_dirty(finished)
+        self._save_state()
+
+    def _valid_pairs(self, now: float) -> List[tuple]:
+        pairs = []
+        for d_token in self.settings["discord_tokens"]:
+            entry = self.state.get(d_token)
+            if entry and entry.get("zai_token") and float(entry.get("exp") or 0) > now:
+                pairs.append((d_token, entry["zai_token"]))
+        return pairs
+
+    def _push_if_due(self, now: float) -> None:
+        pairs = self._valid_pairs(now)
+        valid = [z for _, z in pairs]
+        if self._last_pushed is not None and set(valid) != set(self._last_pushed):
+            self._mark_dirty(now)
+        if not self._dirty or now - self._dirty_since < self.settings["push_window"]:
+            return
+        if not valid:
+            print("[!] 当前没有有效的 zAI token，跳过推送")
+            self._dirty = False
+            return
+        s = self.settings
+        results = push_sharded(self.manager, pairs, s["channels"], s["shard_strategy"], s["tiers"])
+        if False not in results.values():
+            self._last_pushed = valid
+            self._dirty = False
+
+    def _sleep_seconds(self, now: float) -> float:
+        wake = now + self.MAX_SLEEP
+        for d_token in self.settings["discord_tokens"]:
+            wake = min(wake, self._next_refresh_at(self.state.get(d_token)))
+        for entry in self.state.values():
+            # 到期时刻需要把过期 token 从渠道中移除
+            if entry.get("exp") and float(entry["exp"]) > now:
+                wake = min(wake, float(entry["exp"]))
+        if self._dirty:
+            wake = min(wake, self._dirty_since + self.settings["push_window"])
+        wake = min(wake, now + self.CONFIG_CHECK_INTERVAL)
+        return max(1.0, wake - now)
+
+    def run(self) -> None:
+        print(f"[*] 常驻模式启动，配置: {self.config_path}，状态文件: {self.state_path}")
+        while True:
+            now = time.time()
+            if not self._reload_config_if_changed(now):
+                print("[!] 无可用配置，退出")
+                return
+            self._refresh_due(now)
+            self._push_if_due(time.time())
+            time.sleep(self._sleep_seconds(time.time()))
+
 
 def main():
     parser = argparse.ArgumentParser(description='zAI Token 获取工具')
@@ -453,14 +721,23 @@ def main():
     batch_parser.add_argument('--url', default='https://zai.is', help='zAI Base URL')
     batch_parser.add_argument('--newapi-base', default='https://api.newapi.ai', help='NewAPI 基础 URL')
     batch_parser.add_argument('--newapi-key', required=True, help='NewAPI 管理密钥 (Bearer)')
-    batch_parser.add_argument('--newapi-channel-id', required=True, help='NewAPI 渠道 ID')
+    batch_parser.add_argument('--newapi-channel-id', required=True, action='append',
+                              help='NewAPI 渠道 ID，可重复（多个渠道时按数量分片）')
     batch_parser.add_argument('--expires-in', type=int, default=10800, help='新 token 有效期（秒），默认 10800 秒=3 小时')
+    batch_parser.add_argument('--concurrency', type=int, default=4, help='并发登录数，默认 4')
 
     # 读取 JSON 配置并循环运行
     loop_parser = subparsers.add_parser('run-loop', help='读取 JSON 配置并循环转换+推送')
     loop_parser.add_argument('--config', default='config.json', help='配置文件路径，JSON 格式')
+
+    # 常驻模式：按各账号过期时间刷新，批量推送
+    daemon_parser = subparsers.add_parser('daemon', help='常驻运行：仅在 token 临近过期时刷新，合并推送')
+    daemon_parser.add_argument('--config', default='config.json', help='配置文件路径，JSON 格式')
+    daemon_parser.add_argument('--state', default='token_state.json', help='本地状态文件路径')
     
     args = parser.parse_args()
+    # newapi_channels 使用 logging 输出渠道同步信息
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     
     if args.command == 'backend-login':
         handler = DiscordOAuthHandler(args.url)
@@ -480,7 +757,7 @@ def main():
             else:
                 print(f"\n{token}\n")
     elif args.command == 'batch-push':
-        discord_tokens = _load_discord_tokens(args.discord_token, args.discord_token_file)
+        discord_tokens = _load_discord_tokens(token_file=args.discord_token_file, token_list=args.discord_token)
         if not discord_tokens:
             print("[!] 未提供有效的 Discord Token，请使用 --discord-token 或 --discord-token-file")
             return
@@ -490,48 +767,57 @@ def main():
             zai_url=args.url,
             newapi_base=args.newapi_base,
             newapi_key=args.newapi_key,
-            channel_id=args.newapi_channel_id,
-            expires_in=args.expires_in
+            expires_in=args.expires_in,
+            concurrency=args.concurrency,
+            channels=_parse_channels({"newapi_channels": args.newapi_channel_id})
         )
     elif args.command == 'run-loop':
         config_path = args.config
         print(f"[*] 使用配置文件循环运行: {config_path}")
+        # 跨轮次保留 {discord_token: zai_token}，exp 仍远的 token 不重新登录
+        token_cache: Dict[str, str] = {}
+        manager: Optional[NewAPITokenManager] = None
         try:
             while True:
                 cfg = _load_config(config_path)
                 if not cfg:
                     break
 
-                discord_tokens = _load_discord_tokens(
-                    single_token=None,
-                    token_file=cfg.get("discord_token_file"),
-                    token_list=cfg.get("discord_tokens") or cfg.get("discord_token")
-                )
-                zai_url = cfg.get("zai_url") or cfg.get("zai_base_url") or "https://zai.is"
-                newapi_base = cfg.get("newapi_base") or cfg.get("newapi_base_url") or "https://91vip.futureppo.top"
-                newapi_key = cfg.get("newapi_key") or cfg.get("system_token") or cfg.get("access_token")
-                channel_id = cfg.get("newapi_channel_id") or cfg.get("channel_id")
-                user_id = str(cfg.get("newapi_user_id") or cfg.get("user_id") or "1")
-                expires_in = int(cfg.get("expires_in", 10800))
-                interval = int(cfg.get("update_interval", cfg.get("interval", 3600)))
-
-                if not newapi_key or not channel_id:
-                    print("[!] 配置缺少 newapi_key 或 newapi_channel_id，退出")
+                settings = _settings_from_config(cfg)
+                interval = settings["interval"]
+                if not settings["newapi_key"] or not settings["channels"]:
+                    print("[!] 配置缺少 newapi_key 或 newapi_channel_id / newapi_channels，退出")
                     break
+                # 跨轮次复用同一个 manager（连接池）
+                if manager is None or (manager.base_url, manager.api_key, manager.user_id) != \
+                        (settings["newapi_base"].rstrip("/"), settings["newapi_key"], settings["user_id"]):
+                    manager = NewAPITokenManager(settings["newapi_base"], settings["newapi_key"], settings["user_id"])
 
                 convert_and_push(
-                    discord_tokens=discord_tokens,
-                    zai_url=zai_url,
-                    newapi_base=newapi_base,
-                    newapi_key=newapi_key,
-                    channel_id=channel_id,
-                    expires_in=expires_in,
-                    user_id=user_id
+                    discord_tokens=settings["discord_tokens"],
+                    zai_url=settings["zai_url"],
+                    newapi_base=settings["newapi_base"],
+                    newapi_key=settings["newapi_key"],
+                    expires_in=settings["expires_in"],
+                    user_id=settings["user_id"],
+                    concurrency=settings["concurrency"],
+                    cache=token_cache,
+                    # 复用的 token 至少要撑到下一轮结束后再留 10 分钟余量
+                    min_valid_seconds=interval + 600,
+                    channels=settings["channels"],
+                    shard_strategy=settings["shard_strategy"],
+                    tiers=settings["tiers"],
+                    manager=manager
                 )
                 print(f"\n[*] 本轮结束，{interval} 秒后再次执行 ...\n")
                 time.sleep(max(1, interval))
         except KeyboardInterrupt:
             print("\n[!] 已停止循环运行")
+    elif args.command == 'daemon':
+        try:
+            TokenDaemon(args.config, args.state).run()
+        except KeyboardInterrupt:
+            print("\n[!] 已停止常驻运行")
     else:
         parser.print_help()
 